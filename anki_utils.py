@@ -1,10 +1,13 @@
 # anki_utils.py
 # This module focuses on Anki deck creation and note management.
+import hashlib
 import logging
 import random
 
 import genanki
 
+from metrics import metrics
+
 logger = logging.getLogger(__name__)
 
 # Define a global model to use across all notes
@@ -25,6 +28,16 @@ GLOBAL_MODEL = genanki.Model(
     ],
 )
 
+def deck_id_for(deck_name):
+    """
+    Derive a stable deck ID from the deck name.
+
+    The same name always gives the same ID, so a rebuilt deck updates the
+    one already imported into Anki, while differently named decks stay apart.
+    """
+    digest = hashlib.sha256(deck_name.encode("utf-8")).digest()
+    return (1 << 30) + int.from_bytes(digest[:4], "big") % (1 << 30)
+
 # Function to create an Anki deck
 def create_deck(deck_name):
     """
@@ -37,7 +50,7 @@ def create_deck(deck_name):
         genanki.Deck: Anki deck object.
     """
     try:
-        deck_id = 123456789  # Use a fixed deck ID for consistency
+        deck_id = deck_id_for(deck_name)
         logger.debug(f"Creating deck with ID: {deck_id} and name: {deck_name}")
         return genanki.Deck(deck_id, deck_name)
     except Exception as e:
@@ -72,7 +85,7 @@ def create_model():
     )
 
 # Function to add a note to an Anki deck
-def add_note_to_deck(deck, front_text, back_text, image_url):
+def add_note_to_deck(deck, front_text, back_text, image_url, guid=None):
     """
     Adds a note to the provided Anki deck.
 
@@ -81,11 +94,13 @@ def add_note_to_deck(deck, front_text, back_text, image_url):
         front_text (str): Front of the card.
         back_text (str): Back of the card.
         image_url (str): Optional image URL for the card.
+        guid (str, optional): Stable note GUID, so re-imports update the note instead of duplicating it.
     """
     try:
         note = genanki.Note(
             model=GLOBAL_MODEL,
             fields=[front_text, back_text, image_url or ""],
+            guid=guid,
         )
         deck.add_note(note)
         logger.debug(f"Note added successfully: Front='{front_text}', Back='{back_text}'")
@@ -94,18 +109,20 @@ def add_note_to_deck(deck, front_text, back_text, image_url):
         raise
 
 # Function to export the Anki deck to a file
-def export_deck(deck, output_path):
+def export_deck(deck, output_path, media_files=None):
     """
     Exports the Anki deck to a file.
 
     Args:
         deck (genanki.Deck): Anki deck to export.
         output_path (str): Path to save the exported file.
+        media_files (list, optional): Paths of media files to embed; notes refer to them by file name.
     """
     try:
-        logger.debug(f"Deck contains {len(deck.notes)} notes before export.")
-        package = genanki.Package(deck)
-        package.write_to_file(output_path)
+        logger.debug(f"Deck contains {len(deck.notes)} notes and {len(media_files or [])} media files before export.")
+        with metrics.stage("export"):
+            package = genanki.Package(deck, media_files=media_files)
+            package.write_to_file(output_path)
         logger.info(f"Deck exported successfully to {output_path}")
     except Exception as e:
         logger.error(f"Error exporting deck: {e}")
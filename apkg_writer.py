@@ -0,0 +1,215 @@
+# apkg_writer.py
+# Streams notes straight into an .apkg collection database, for decks too large to hold in memory.
+import hashlib
+import html
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+import genanki
+from genanki.apkg_col import APKG_COL
+from genanki.apkg_schema import APKG_SCHEMA
+
+from anki_utils import GLOBAL_MODEL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000  # Notes buffered before one executemany
+_IMG_SRC_RE = re.compile(r"<img[^>]*?src=[\"']?([^\"'>\s]+)[^>]*>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]*>")
+# Indexes are built once after the bulk insert rather than updated row by row
+_SCHEMA_STATEMENTS = [statement.strip() for statement in APKG_SCHEMA.split(";") if statement.strip()]
+_TABLE_STATEMENTS = [statement for statement in _SCHEMA_STATEMENTS if not statement.startswith("CREATE INDEX")]
+_INDEX_STATEMENTS = [statement for statement in _SCHEMA_STATEMENTS if statement.startswith("CREATE INDEX")]
+
+
+def field_checksum(text):
+    """
+    Compute Anki's duplicate-check checksum of a field.
+
+    Like Anki, images are replaced by their file names and other HTML is
+    stripped before hashing, so notes differing only in markup count as
+    duplicates.
+
+    Returns:
+        int: The first 32 bits of the SHA-1 of the stripped text.
+    """
+    if "<" not in text and "&" not in text:
+        return int(hashlib.sha1(text.strip().encode("utf-8")).hexdigest()[:8], 16)
+    stripped = html.unescape(_TAG_RE.sub("", _IMG_SRC_RE.sub(r" \1 ", text))).strip()
+    return int(hashlib.sha1(stripped.encode("utf-8")).hexdigest()[:8], 16)
+
+
+class ApkgWriter:
+    """
+    Writes one deck to an ``.apkg`` without building a ``genanki.Note`` per row.
+
+    Notes are buffered in batches of ``batch_size`` and inserted, together
+    with their cards, with ``executemany`` inside a single transaction, so
+    memory stays flat however many rows the deck has. The database is laid
+    out exactly as ``genanki.Package`` lays it out, with the checksums Anki
+    uses for duplicate detection filled in. Nothing touches ``output_path``
+    until ``finish``, which zips the collection next to it and renames it
+    into place; ``abort`` leaves any existing file alone.
+
+    Only front/back models are supported; cloze models need genanki.
+    """
+
+    def __init__(self, output_path, deck_name, deck_id, model=GLOBAL_MODEL, batch_size=DEFAULT_BATCH_SIZE, timestamp=None):
+        if model.model_type != genanki.Model.FRONT_BACK:
+            raise ValueError(f"Model '{model.name}' is not a front/back model.")
+        self.output_path = output_path
+        self.deck_id = deck_id
+        self.model = model
+        self.batch_size = batch_size
+        self.notes = 0
+        self.cards = 0
+        self._closed = False
+        self._timestamp = time.time() if timestamp is None else timestamp
+        self._ids = itertools.count(int(self._timestamp * 1000))
+        self._pending_notes = []
+        self._pending_cards = []
+        self._requirements = [
+            (card_ord, all if any_or_all == "all" else any, field_ords)
+            for card_ord, any_or_all, field_ords in model._req
+        ]
+
+        fd, self._db_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or ".", suffix=".anki2")
+        os.close(fd)
+        self._conn = sqlite3.connect(self._db_path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        for statement in _TABLE_STATEMENTS:
+            self._conn.execute(statement)
+        self._conn.executescript(APKG_COL)
+        self._conn.execute("BEGIN")
+        decks = json.loads(self._conn.execute("SELECT decks FROM col").fetchone()[0])
+        decks[str(deck_id)] = genanki.Deck(deck_id, deck_name).to_json()
+        models = json.loads(self._conn.execute("SELECT models FROM col").fetchone()[0])
+        models[str(model.model_id)] = model.to_json(self._timestamp, deck_id)
+        self._conn.execute("UPDATE col SET decks = ?, models = ?", (json.dumps(decks), json.dumps(models)))
+
+    def add_note(self, fields, guid=None, tags=()):
+        """
+        Queue a note and its cards, writing the queue once it holds ``batch_size`` notes.
+
+        Args:
+            fields (list): Field values, in the model's field order.
+            guid (str, optional): Note GUID. Defaults to one derived from the fields, as genanki does.
+            tags (iterable): Tags without spaces.
+        """
+        fields = [field or "" for field in fields]
+        if len(fields) != len(self.model.fields):
+            raise ValueError(f"Expected {len(self.model.fields)} fields, got {len(fields)}.")
+        note_id = next(self._ids)
+        sort_field = fields[self.model.sort_field_index]
+        self._pending_notes.append((
+            note_id,
+            guid or genanki.guid_for(*fields),
+            self.model.model_id,
+            int(self._timestamp),
+            -1,
+            " " + " ".join(tags) + " ",
+            "\x1f".join(fields),
+            sort_field,
+            field_checksum(sort_field),
+            0,
+            "",
+        ))
+        for card_ord, requirement, field_ords in self._requirements:
+            if requirement(fields[ord_] for ord_ in field_ords):
+                self._pending_cards.append(
+                    (next(self._ids), note_id, self.deck_id, card_ord, int(self._timestamp), -1,
+                     0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, "")
+                )
+        self.notes += 1
+        if len(self._pending_notes) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert the queued notes and cards."""
+        if self._pending_notes:
+            self._conn.executemany("INSERT INTO notes VALUES (?,?,?,?,?,?,?,?,?,?,?)", self._pending_notes)
+            self._conn.executemany("INSERT INTO cards VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", self._pending_cards)
+            self.cards += len(self._pending_cards)
+            self._pending_notes.clear()
+            self._pending_cards.clear()
+
+    def replace_field(self, index, replacements):
+        """
+        Rewrite one field of the written notes, e.g. image URLs to embedded file names.
+
+        Notes are read back page by page, so this too runs in constant memory.
+
+        Args:
+            index (int): Field to rewrite. Must not be the sort field, whose checksum is already stored.
+            replacements (dict): Maps old values to new ones; other values are kept.
+        """
+        if index == self.model.sort_field_index:
+            raise ValueError("The sort field cannot be rewritten.")
+        if not replacements:
+            return
+        self.flush()
+        last_id = -1
+        while True:
+            page = self._conn.execute(
+                "SELECT id, flds FROM notes WHERE id > ? ORDER BY id LIMIT ?", (last_id, self.batch_size)
+            ).fetchall()
+            if not page:
+                return
+            updates = []
+            for note_id, flds in page:
+                fields = flds.split("\x1f")
+                if fields[index] in replacements:
+                    fields[index] = replacements[fields[index]]
+                    updates.append(("\x1f".join(fields), note_id))
+            self._conn.executemany("UPDATE notes SET flds = ? WHERE id = ?", updates)
+            last_id = page[-1][0]
+
+    def finish(self, media_files=None):
+        """
+        Commit the collection and package it with ``media_files`` into ``output_path``.
+
+        Args:
+            media_files (list, optional): Paths of media files to embed; notes refer to them by file name.
+        """
+        self.flush()
+        for statement in _INDEX_STATEMENTS:
+            self._conn.execute(statement)
+        self._conn.execute("COMMIT")
+        self._conn.close()
+        self._closed = True
+        temp_path = f"{self.output_path}.tmp"
+        try:
+            with zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED) as archive:
+                archive.write(self._db_path, "collection.anki2")
+                media_files = list(media_files or [])
+                archive.writestr("media", json.dumps({str(idx): os.path.basename(path) for idx, path in enumerate(media_files)}))
+                for idx, path in enumerate(media_files):
+                    archive.write(path, str(idx))
+            os.replace(temp_path, self.output_path)
+        finally:
+            os.remove(self._db_path)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        logger.info(f"Wrote {self.notes} notes and {self.cards} cards to {self.output_path}")
+
+    def abort(self):
+        """Discard everything written so far."""
+        if not self._closed:
+            self._closed = True
+            self._conn.close()
+            os.remove(self._db_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A writer left without finish() is discarded
+        self.abort()
@@ -0,0 +1,280 @@
+# benchmark.py
+# Offline throughput benchmarks for the parse, enrich and export stages, with a baseline regression gate.
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import query_refiner
+import utils
+from anki_utils import add_note_to_deck, create_deck, deck_id_for, export_deck
+from apkg_writer import ApkgWriter
+from file_utils import parse_input_file
+from image_cache import ImageCache
+from main import build_row_query
+from synonym_index import SynonymIndex
+
+logger = logging.getLogger(__name__)
+
+RESULTS_VERSION = 1
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.25  # Slowdown over the baseline that counts as a regression
+MIN_REGRESSION_SECONDS = 0.005  # Smaller slowdowns are timer noise
+DEFAULT_OUTPUT = "benchmark_results.json"
+MEANING_VERBS = (
+    "bake", "begin", "bite", "deceive", "bend", "offer", "bind", "ask", "blow", "stay", "roast", "break", "burn",
+    "bring", "think", "push", "receive", "recommend", "extinguish", "frighten", "eat", "drive", "fall", "catch",
+    "find", "fly", "flee", "flow", "freeze", "give", "go", "succeed", "enjoy", "happen", "win", "pour", "resemble",
+    "slide", "dig", "grab", "have", "hold", "hang", "lift", "help", "know", "sound", "come", "creep", "load", "let",
+    "run", "suffer", "lend", "read", "lie", "lose", "measure", "like", "take", "name", "whistle", "praise",
+    "advise", "rub", "tear", "ride", "smell", "call", "create", "drink", "shine", "shoot", "sleep", "hit", "close",
+    "cut", "write", "scream", "swim", "see", "send", "sing", "sink", "sit", "speak", "jump", "sting", "stand",
+    "steal", "climb", "die", "stroke", "argue", "carry", "meet", "step", "forget", "grow", "wash", "turn", "weigh",
+    "want", "draw", "force", "grind", "shut",
+)
+
+
+def generate_table(path, rows, seed=0):
+    """
+    Write a synthetic vocabulary table shaped like ``WichtigsteVerben.md``.
+
+    About half the meanings repeat across rows and the rest combine two verbs,
+    roughly the mix of a real deck, so caches and memos see realistic hit rates.
+
+    Args:
+        path (str): Markdown file to write.
+        rows (int): Number of data rows.
+        seed (int): Seed for the generator, so runs are comparable.
+    """
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("| WORD | CONJUGATIONS | MEANING | EXAMPLE SENTENCE (GERMAN) |\n")
+        f.write("| ----- | ----- | ----- | ----- |\n")
+        for i in range(rows):
+            verb = rng.choice(MEANING_VERBS)
+            meaning = f"to {verb}" if rng.random() < 0.5 else f"to {verb}/{rng.choice(MEANING_VERBS)}"
+            word = f"verb{i}en"
+            f.write(
+                f"| **{word}** | {word[:-2]}t, {word[:-2]}te, **hat ge{word[:-2]}t** | {meaning} "
+                f"| *Ich {word[:-1]} jeden Tag, weil ich {verb} muss.* |\n"
+            )
+
+
+def synthetic_synonyms():
+    """Return a synonym dictionary with an entry for every generated meaning verb."""
+    return {f"to {verb}": [f"to {MEANING_VERBS[(i + 1) % len(MEANING_VERBS)]}"] for i, verb in enumerate(MEANING_VERBS)}
+
+
+def best_of(repeat, func, setup=None):
+    """
+    Time ``func`` ``repeat`` times and keep the fastest run, the one least disturbed by the machine.
+
+    Args:
+        repeat (int): Timed runs.
+        func (callable): Work to time; its last result is returned too.
+        setup (callable, optional): Untimed preparation before every run, e.g. clearing a cache.
+
+    Returns:
+        tuple: ``(seconds, result)``.
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_size(rows, repeat=DEFAULT_REPEAT, workdir=None):
+    """
+    Run every stage over a generated table of ``rows`` rows.
+
+    Args:
+        rows (int): Table size.
+        repeat (int): Timed runs per stage; the fastest is reported.
+        workdir (str, optional): Scratch directory. Defaults to a temporary one.
+
+    Returns:
+        dict: Maps each stage name to ``{"seconds", "items", "per_second"}``.
+    """
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+        table_path = os.path.join(tmpdir, f"bench_{rows}.md")
+        generate_table(table_path, rows)
+        results = {}
+
+        def record(stage, seconds, items):
+            results[stage] = {"seconds": seconds, "items": items, "per_second": items / seconds if seconds else None}
+            logger.info(f"{rows:>7} rows  {stage:<17} {seconds * 1000:10.1f} ms  {items / seconds if seconds else 0:12.0f}/s")
+
+        seconds, parsed = best_of(repeat, lambda: parse_input_file(table_path))
+        record("parse", seconds, len(parsed))
+        queries = [build_row_query(row) for row in parsed]
+
+        synonym_dict = synthetic_synonyms()
+
+        def expand(synonyms):
+            return [utils.expand_with_synonyms(query, synonyms) for query in queries]
+
+        # A new index starts with an empty memo; the warm pass reuses one
+        seconds, _ = best_of(repeat, lambda: expand(SynonymIndex(synonym_dict)))
+        record("expand_cold", seconds, len(queries))
+        synonym_index = SynonymIndex(synonym_dict)
+        seconds, _ = best_of(repeat, lambda: expand(synonym_index))
+        record("expand_warm", seconds, len(queries))
+
+        distinct = list(dict.fromkeys(queries))
+        query_refiner.get_resources()  # Loading NLTK is a one-off cost, not per-query work
+        seconds, refined = best_of(repeat, lambda: query_refiner.refine_queries(distinct), setup=query_refiner.clear_memo)
+        record("refine_cold", seconds, len(distinct))
+        seconds, _ = best_of(repeat, lambda: query_refiner.refine_queries(distinct))
+        record("refine_warm", seconds, len(distinct))
+
+        keys = list(dict.fromkeys(refined[query] for query in distinct))
+        entries = {key: {"image_url": f"https://cdn.example/{i}.jpg", "image_credit": "benchmark"} for i, key in enumerate(keys)}
+        cache_path = os.path.join(tmpdir, "cache.sqlite3")
+
+        def fresh_cache():
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(cache_path + suffix):
+                    os.remove(cache_path + suffix)
+
+        def cold_lookup():
+            cache = ImageCache(cache_path, max_entries=len(keys) + 1)
+            found = cache.get_many(keys)
+            cache.set_many({key: value for key, value in entries.items() if key not in found})
+            cache.close()
+
+        seconds, _ = best_of(repeat, cold_lookup, setup=fresh_cache)
+        record("cache_cold", seconds, len(keys))
+
+        def warm_lookup():
+            cache = ImageCache(cache_path, max_entries=len(keys) + 1)
+            found = cache.get_many(keys)
+            cache.close()
+            return found
+
+        seconds, found = best_of(repeat, warm_lookup)
+        if len(found) != len(keys):
+            raise RuntimeError(f"Warm cache returned {len(found)} of {len(keys)} entries.")
+        record("cache_warm", seconds, len(keys))
+
+        notes = [(row.get("WORD", ""), row.get("MEANING", ""), f"https://cdn.example/{i}.jpg") for i, row in enumerate(parsed)]
+        deck_name = f"Benchmark {rows}"
+        deck_id = deck_id_for(deck_name)
+
+        def create_notes():
+            deck = create_deck(deck_name)
+            for note in notes:
+                add_note_to_deck(deck, *note)
+            return deck
+
+        seconds, deck = best_of(repeat, create_notes)
+        record("notes", seconds, len(notes))
+        output_path = os.path.join(tmpdir, "bench.apkg")
+        seconds, _ = best_of(repeat, lambda: export_deck(deck, output_path))
+        record("export", seconds, len(notes))
+
+        def stream_notes():
+            with ApkgWriter(output_path, deck_name, deck_id) as writer:
+                for note in notes:
+                    writer.add_note(note)
+                writer.finish()
+
+        seconds, _ = best_of(repeat, stream_notes)
+        record("export_streaming", seconds, len(notes))
+        return results
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=DEFAULT_REPEAT, workdir=None):
+    """
+    Benchmark every stage at every size.
+
+    Returns:
+        dict: ``version``, ``meta`` describing the machine and run, and
+              ``results`` mapping each size (as a string) to its stages.
+    """
+    results = {str(rows): benchmark_size(rows, repeat, workdir) for rows in sizes}
+    return {
+        "version": RESULTS_VERSION,
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare_results(current, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Find stages that got slower than the baseline allows.
+
+    Only sizes and stages present in both runs are compared, and slowdowns
+    under ``MIN_REGRESSION_SECONDS`` are ignored as noise.
+
+    Args:
+        current (dict): Result of ``run_benchmarks``.
+        baseline (dict): An earlier result, e.g. loaded from a stored file.
+        tolerance (float): Allowed slowdown, e.g. ``0.25`` for 25%.
+
+    Returns:
+        list: ``(size, stage, baseline_seconds, current_seconds)`` for every regression.
+    """
+    regressions = []
+    for size, stages in current["results"].items():
+        for stage, measured in stages.items():
+            before = baseline.get("results", {}).get(size, {}).get(stage)
+            slowdown = measured["seconds"] - before["seconds"] if before else 0
+            if slowdown > MIN_REGRESSION_SECONDS and measured["seconds"] > before["seconds"] * (1 + tolerance):
+                regressions.append((size, stage, before["seconds"], measured["seconds"]))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the parse, enrich and export stages offline.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES), help="Table sizes in rows.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Timed runs per stage; the fastest counts.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Where to write the results as JSON.")
+    parser.add_argument("--baseline", help="Earlier results to compare against; regressions exit with status 1.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed slowdown, e.g. 0.25 for 25%%.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_benchmarks(args.sizes, args.repeat)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Results saved to {args.output}")
+    if not args.baseline:
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare_results(results, baseline, args.tolerance)
+    for size, stage, before, after in regressions:
+        logger.error(f"Regression at {size} rows in {stage}: {before * 1000:.1f} ms -> {after * 1000:.1f} ms")
+    if regressions:
+        return 1
+    logger.info(f"No stage is more than {args.tolerance:.0%} slower than {args.baseline}.")
+    return 0
+
+
+if __name__ == "__main__":
+    # Per-row log lines of the benchmarked modules would be timed along with the work
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    logger.setLevel(logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,317 @@
+# fake_api_server.py
+# Local stand-in for the Pixabay, Pexels and Datamuse APIs, for load tests without network or quota.
+import argparse
+import asyncio
+import hashlib
+import io
+import logging
+import random
+import time
+from collections import Counter
+from functools import lru_cache
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+DEFAULT_RATE_LIMIT = 100000  # Requests per window reported to clients
+PIXABAY_PATH = "/api/"
+PEXELS_PATH = "/v1/search"
+DATAMUSE_PATH = "/words"
+SYNONYM_WORDS = ("alter", "shift", "render", "convey", "handle", "manage", "yield", "grant", "hold", "keep")
+
+
+class FakeApiProfile:
+    """
+    How the fake APIs behave.
+
+    Args:
+        latency (float): Typical response time, in seconds.
+        jitter (float): Spread of the response time: the half-width for
+            ``uniform``, the sigma of the underlying normal for ``lognormal``.
+        latency_distribution (str): One of ``LATENCY_DISTRIBUTIONS``.
+        hits (int): Results per search.
+        empty_rate (float): Share of queries with no results at all, so fallbacks
+            are exercised. The same query is always empty or never.
+        rate_limit (int, optional): Requests allowed per ``rate_window`` seconds, reported
+            in ``X-RateLimit-*`` headers; requests over it get a 429. The generous
+            default lets clients' rate limiters speed up to what is being tested.
+        rate_window (float): Length of the rate-limit window, in seconds.
+        burst_every (int): After this many requests, answer the next ``burst_length``
+            with 429s. 0 disables bursts.
+        burst_length (int): Length of each 429 burst.
+        retry_after (float): ``Retry-After`` seconds sent with every 429.
+        timeout_rate (float): Share of requests that hang for ``hang_seconds`` before
+            answering, long enough for the client to time out.
+        hang_seconds (float): How long a hanging request takes.
+        error_rate (float): Share of requests answered with a 503.
+        seed (int, optional): Seed for the random choices, for repeatable runs.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.02, latency_distribution="uniform", hits=10, empty_rate=0.0,
+                 rate_limit=DEFAULT_RATE_LIMIT, rate_window=60, burst_every=0, burst_length=1, retry_after=1,
+                 timeout_rate=0.0, hang_seconds=120, error_rate=0.0, seed=None):
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution '{latency_distribution}'. "
+                             f"Use one of: {', '.join(LATENCY_DISTRIBUTIONS)}.")
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_distribution = latency_distribution
+        self.hits = hits
+        self.empty_rate = empty_rate
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.retry_after = retry_after
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.error_rate = error_rate
+        self.seed = seed
+
+    def sample_latency(self, rng):
+        """Draw one response time, in seconds."""
+        if self.latency_distribution == "fixed":
+            return self.latency
+        if self.latency_distribution == "uniform":
+            return max(0.0, rng.uniform(self.latency - self.jitter, self.latency + self.jitter))
+        return rng.lognormvariate(0, self.jitter) * self.latency if self.latency > 0 else 0.0
+
+
+def _query_seed(query):
+    return int.from_bytes(hashlib.sha256(query.strip().lower().encode("utf-8")).digest()[:6], "big")
+
+
+@lru_cache(maxsize=2048)
+def render_image(image_id, width):
+    """
+    Draw a small JPEG that is the same for an ID at every size and differs between IDs.
+
+    A coarse random grid, seeded by the ID, is scaled to ``width``, so
+    perceptual hashes match across sizes like those of a real photo would.
+    """
+    from PIL import Image
+
+    rng = random.Random(image_id)
+    grid = Image.new("L", (6, 4))
+    grid.putdata([rng.randrange(256) for _ in range(24)])
+    image = grid.resize((width, max(1, width * 2 // 3)), Image.BILINEAR).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=70)
+    return buffer.getvalue()
+
+
+class FakeApi:
+    """
+    The handlers of the fake server and what they have been asked.
+
+    Searches return the same images for the same query every time, so
+    caches and de-duplication behave as against the real APIs. Image URLs
+    point back at this server, which renders them on request. ``stats``
+    counts requests, 429s, errors and hangs; ``GET /_stats`` returns it.
+    """
+
+    def __init__(self, profile=None):
+        self.profile = profile or FakeApiProfile()
+        self.stats = Counter()
+        self._rng = random.Random(self.profile.seed)
+        self._requests = Counter()  # Searches per endpoint; each API has its own limits
+        self._windows = {}  # Endpoint -> [window start, requests served in it]
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get(PIXABAY_PATH, self.pixabay_search)
+        app.router.add_get(PEXELS_PATH, self.pexels_search)
+        app.router.add_get(DATAMUSE_PATH, self.datamuse_words)
+        app.router.add_get("/images/{name}", self.image)
+        app.router.add_get("/_stats", self.stats_handler)
+        return app
+
+    def _rate_limit_headers(self, endpoint):
+        profile = self.profile
+        if not profile.rate_limit:
+            return {}
+        window_start, served = self._windows[endpoint]
+        reset = max(0.0, window_start + profile.rate_window - time.monotonic())
+        return {
+            "X-RateLimit-Limit": str(profile.rate_limit),
+            "X-RateLimit-Remaining": str(max(0, profile.rate_limit - served)),
+            "X-RateLimit-Reset": str(int(reset + 0.999)),
+        }
+
+    def _admit(self, endpoint):
+        """
+        Decide how to answer the next search: None to serve it, or an error response.
+
+        Bursts and the window are counted before any waiting, so concurrent
+        requests see the limits in arrival order.
+        """
+        profile = self.profile
+        self._requests[endpoint] += 1
+        now = time.monotonic()
+        window = self._windows.setdefault(endpoint, [now, 0])
+        if now - window[0] >= profile.rate_window:
+            window[:] = [now, 0]
+        # Each cycle serves burst_every requests, then rejects burst_length
+        cycle = profile.burst_every + profile.burst_length
+        in_burst = profile.burst_every and (self._requests[endpoint] - 1) % cycle >= profile.burst_every
+        if in_burst or (profile.rate_limit and window[1] >= profile.rate_limit):
+            self.stats["rate_limited"] += 1
+            headers = {"Retry-After": str(profile.retry_after), **self._rate_limit_headers(endpoint)}
+            return web.json_response({"error": "Too Many Requests"}, status=429, headers=headers)
+        window[1] += 1
+        if self._rng.random() < profile.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response({"error": "Service Unavailable"}, status=503)
+        return None
+
+    async def _search(self, request, endpoint, query, build):
+        self.stats[f"{endpoint}_requests"] += 1
+        rejected = self._admit(endpoint)
+        if rejected is not None:
+            return rejected
+        if self._rng.random() < self.profile.timeout_rate:
+            self.stats["hangs"] += 1
+            await asyncio.sleep(self.profile.hang_seconds)
+        else:
+            await asyncio.sleep(self.profile.sample_latency(self._rng))
+        seed = _query_seed(query)
+        empty = random.Random(seed).random() < self.profile.empty_rate
+        ids = [] if empty else [seed * 100 + rank for rank in range(self.profile.hits)]
+        base = f"{request.scheme}://{request.host}/images"
+        return web.json_response(build(ids, base), headers=self._rate_limit_headers(endpoint))
+
+    async def pixabay_search(self, request):
+        def build(ids, base):
+            hits = [
+                {
+                    "id": image_id,
+                    "pageURL": f"https://pixabay.example/photos/{image_id}/",
+                    "tags": request.query.get("q", ""),
+                    "previewURL": f"{base}/{image_id}_150.jpg",
+                    "previewWidth": 150,
+                    "previewHeight": 100,
+                    "webformatURL": f"{base}/{image_id}_640.jpg",
+                    "webformatWidth": 640,
+                    "webformatHeight": 427,
+                    "largeImageURL": f"{base}/{image_id}_1280.jpg",
+                    "imageWidth": 4000,
+                    "imageHeight": 2667,
+                    # Ranked in ID order, all above the default metadata filters
+                    "views": 10000 - rank,
+                    "downloads": 5000 - rank,
+                    "likes": 500 - rank,
+                    "comments": 50,
+                    "user": f"fake_user_{image_id % 97}",
+                }
+                for rank, image_id in enumerate(ids)
+            ]
+            return {"total": len(hits), "totalHits": len(hits), "hits": hits}
+
+        return await self._search(request, "pixabay", request.query.get("q", ""), build)
+
+    async def pexels_search(self, request):
+        def build(ids, base):
+            photos = [
+                {
+                    "id": image_id,
+                    "url": f"https://pexels.example/photo/{image_id}/",
+                    "photographer": f"Fake Photographer {image_id % 97}",
+                    "src": {
+                        "original": f"{base}/{image_id}_1600.jpg",
+                        "large": f"{base}/{image_id}_940.jpg",
+                        "medium": f"{base}/{image_id}_350.jpg",
+                        "small": f"{base}/{image_id}_130.jpg",
+                        "tiny": f"{base}/{image_id}_100.jpg",
+                    },
+                }
+                for image_id in ids
+            ]
+            return {"page": 1, "per_page": len(photos), "total_results": len(photos), "photos": photos}
+
+        return await self._search(request, "pexels", request.query.get("query", ""), build)
+
+    async def datamuse_words(self, request):
+        def build(ids, base):
+            return [{"word": SYNONYM_WORDS[image_id % len(SYNONYM_WORDS)], "score": 1000 - rank}
+                    for rank, image_id in enumerate(ids[:int(request.query.get("max", 5))])]
+
+        return await self._search(request, "datamuse", request.query.get("rel_syn", ""), build)
+
+    async def image(self, request):
+        self.stats["image_requests"] += 1
+        stem = request.match_info["name"].rsplit(".", 1)[0]
+        try:
+            image_id, width = (int(part) for part in stem.split("_"))
+        except ValueError:
+            raise web.HTTPNotFound()
+        await asyncio.sleep(self.profile.sample_latency(self._rng))
+        return web.Response(body=render_image(image_id, min(width, 1600)), content_type="image/jpeg")
+
+    async def stats_handler(self, request):
+        return web.json_response(dict(self.stats))
+
+
+async def start_fake_api_server(profile=None, host=DEFAULT_HOST, port=0):
+    """
+    Start the fake APIs on the running event loop.
+
+    Args:
+        profile (FakeApiProfile, optional): Behaviour of the APIs.
+        host (str): Interface to listen on.
+        port (int): Port to listen on; 0 picks a free one.
+
+    Returns:
+        tuple: The ``FakeApi``, its ``web.AppRunner`` (call ``cleanup()`` to stop it)
+               and the base URL, e.g. ``http://127.0.0.1:8765``.
+    """
+    api = FakeApi(profile)
+    runner = web.AppRunner(api.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return api, runner, f"http://{host}:{port}"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve fake Pixabay, Pexels and Datamuse APIs for load tests.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.05, help="Typical response time, in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Spread of the response time.")
+    parser.add_argument("--distribution", choices=LATENCY_DISTRIBUTIONS, default="uniform")
+    parser.add_argument("--hits", type=int, default=10, help="Results per search.")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="Share of queries with no results.")
+    parser.add_argument("--rate-limit", type=int, default=DEFAULT_RATE_LIMIT,
+                        help="Requests allowed per --rate-window seconds; 0 sends no rate-limit headers.")
+    parser.add_argument("--rate-window", type=float, default=60)
+    parser.add_argument("--burst-every", type=int, default=0, help="Requests between 429 bursts; 0 disables them.")
+    parser.add_argument("--burst-length", type=int, default=1, help="429s per burst.")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After seconds sent with 429s.")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Share of requests that hang.")
+    parser.add_argument("--hang-seconds", type=float, default=120, help="How long hanging requests take.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 503.")
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profile = FakeApiProfile(
+        latency=args.latency, jitter=args.jitter, latency_distribution=args.distribution, hits=args.hits,
+        empty_rate=args.empty_rate, rate_limit=args.rate_limit, rate_window=args.rate_window,
+        burst_every=args.burst_every, burst_length=args.burst_length, retry_after=args.retry_after,
+        timeout_rate=args.timeout_rate, hang_seconds=args.hang_seconds, error_rate=args.error_rate, seed=args.seed,
+    )
+    logger.info(f"Fake APIs on http://{args.host}:{args.port}. Point the app at them with "
+                f"`python main.py --fake-api http://{args.host}:{args.port}`.")
+    web.run_app(FakeApi(profile).create_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    main()
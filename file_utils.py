@@ -3,9 +3,20 @@ import csv
 import json
 import os
 import logging
+import re
 
 logger = logging.getLogger(__name__)
 
+MAX_REPORTED_ERRORS = 1000  # Problems kept per ParseReport; the rest are only counted
+_CELL_SPLIT_RE = re.compile(r"(?<!\\)\|")
+_SEPARATOR_CELL_RE = re.compile(r"^:?-{3,}:?$")
+_MARKDOWN_SNIFF_RE = re.compile(r"^\s*\|?.*\|.*\n\s*\|?\s*:?-{3,}", re.MULTILINE)
+_BLOCK_WORD_RE = re.compile(r"^\s*(?:[-*]\s+)?Word\s*:", re.MULTILINE | re.IGNORECASE)
+_KEY_VALUE_RE = re.compile(r"^\s*(?:[-*]\s+)?([^:]+?)\s*:\s*(.*)$")
+SNIFF_SIZE = 8192  # Bytes read to detect the format of a file without a known extension
+
+INPUT_FORMATS = {}  # Format name -> (reader, extensions, sniff), see register_input_format
+
 def save_config(config_file, config_data):
     """
     Save the configuration data to a JSON file.
@@ -29,84 +40,301 @@ def ensure_directories_exist():
     os.makedirs("ANKI", exist_ok=True)
     os.makedirs("input_files", exist_ok=True)
 
-def get_default_input_files():
+def get_default_input_files(input_dir=None):
     """
-    List all input files in the 'input_files/' directory.
+    List all input files in the 'input_files/' directory, or in ``input_dir`` if given.
     """
-    input_dir = os.path.join(os.getcwd(), "input_files")
+    input_dir = input_dir or os.path.join(os.getcwd(), "input_files")
     files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
     logger.debug(f"Found input files: {files}")
     return files
 
-def parse_input_file(input_file):
+class ParseReport:
     """
-    Parse the input file and return a list of rows.
-    Handles Markdown pipe tables and skips non-table lines.
+    Outcome of streaming an input file: row counts and the problems found, by line number.
+
+    Only the first ``MAX_REPORTED_ERRORS`` problems are kept, so a badly
+    broken file cannot grow the report without bound; ``error_count``
+    still counts all of them.
     """
-    rows = []
-    try:
-        with open(input_file, "r", encoding="utf-8") as f:
-            lines = f.readlines()
 
-        headers = None
-        for line in lines:
-            line = line.strip()
-            if not line or "|" not in line:
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.headers = None
+        self.rows = 0
+        self.error_count = 0
+        self.errors = []  # (line_number, message) pairs
+
+    def add_error(self, line_number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line_number, message))
+
+    @property
+    def ok(self):
+        return self.headers is not None and self.error_count == 0
+
+    def summary(self):
+        """Return a one-line description of the parse, for logging."""
+        return f"{self.input_file}: {self.rows} rows, {self.error_count} rejected lines."
+
+    def log(self):
+        """Log the summary and every kept problem."""
+        for line_number, message in self.errors:
+            logger.warning(f"{self.input_file}:{line_number}: {message}")
+        if self.error_count > len(self.errors):
+            logger.warning(f"{self.input_file}: {self.error_count - len(self.errors)} more problems not shown.")
+        logger.info(self.summary())
+
+def split_table_row(line):
+    """
+    Split a Markdown table line into stripped cells.
+
+    Leading and trailing pipes are optional and ``\\|`` is kept as a literal pipe.
+    """
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    return [cell.strip().replace("\\|", "|") for cell in _CELL_SPLIT_RE.split(line)]
+
+def register_input_format(name, extensions=(), sniff=None):
+    """
+    Register a row reader for an input format.
+
+    A reader is a generator ``reader(input_file, report)`` yielding row
+    dicts and recording problems in the ``ParseReport``. Formats are tried
+    by file extension first, then by ``sniff(sample)`` on the start of the
+    file, in registration order.
+
+    Args:
+        name (str): Format name, e.g. ``"csv"``.
+        extensions (tuple): Lower-case file extensions handled by the format.
+        sniff (callable, optional): Returns True if a text sample looks like this format.
+    """
+    def decorator(reader):
+        INPUT_FORMATS[name] = (reader, tuple(extensions), sniff)
+        return reader
+    return decorator
+
+def detect_input_format(input_file):
+    """
+    Pick the input format of a file from its extension or, failing that, its content.
+
+    Returns:
+        str: A key of ``INPUT_FORMATS``. Files nothing recognises are read as Markdown.
+    """
+    extension = os.path.splitext(input_file)[1].lower()
+    for name, (_, extensions, _) in INPUT_FORMATS.items():
+        if extension in extensions:
+            return name
+
+    with open(input_file, "r", encoding="utf-8", errors="replace") as f:
+        sample = f.read(SNIFF_SIZE)
+    for name, (_, _, sniff) in INPUT_FORMATS.items():
+        if sniff is not None and sniff(sample):
+            logger.debug(f"Detected {name} input in {input_file}.")
+            return name
+    return "markdown"
+
+def iter_input_rows(input_file, report=None, input_format=None):
+    """
+    Stream the rows of an input file in any registered format.
+
+    Every reader yields the same kind of rows - dicts of column name to
+    value - and reads lazily, so memory use does not depend on file size.
+
+    Args:
+        input_file (str): Path to the input file.
+        report (ParseReport, optional): Collects row counts and problems.
+        input_format (str, optional): Format name; detected when omitted.
+
+    Returns:
+        iterator: The rows, see ``iter_markdown_rows``.
+    """
+    if report is None:
+        report = ParseReport(input_file)
+    reader = INPUT_FORMATS[input_format or detect_input_format(input_file)][0]
+    return reader(input_file, report)
+
+@register_input_format("markdown", extensions=(".md", ".markdown"),
+                       sniff=lambda sample: bool(_MARKDOWN_SNIFF_RE.search(sample)))
+def iter_markdown_rows(input_file, report):
+    """
+    Stream the rows of a Markdown pipe table, validating them as they are read.
+
+    The file is read lazily, line by line, so memory use does not depend on
+    its size. Lines without a pipe are skipped. The first table line is the
+    header and separator lines are ignored. A row whose cell count does not
+    match the header is left out and recorded in ``report`` with its line
+    number, and parsing carries on.
+
+    Args:
+        input_file (str): Path to the input file.
+        report (ParseReport): Collects row counts and problems.
+
+    Yields:
+        dict: One row, mapping header names to cell values.
+    """
+    headers = None
+    with open(input_file, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if "|" not in line or not line.strip():
+                continue
+            cells = split_table_row(line)
+            if all(_SEPARATOR_CELL_RE.match(cell) for cell in cells):
                 continue
 
             if headers is None:
-                headers = [h.strip() for h in line.split("|") if h.strip()]
+                headers = [h for h in cells if h]
                 if not headers:
-                    raise ValueError("No valid headers found in the input file.")
+                    report.add_error(line_number, "Header row has no column names.")
+                    return
+                report.headers = headers
                 continue
 
-            if "---" in line:
+            if len(cells) != len(headers):
+                report.add_error(line_number, f"Expected {len(headers)} cells, found {len(cells)}.")
                 continue
+            report.rows += 1
+            yield dict(zip(headers, cells))
+
+    if headers is None:
+        report.add_error(0, "No table header found.")
+
+@register_input_format("blocks", sniff=lambda sample: bool(_BLOCK_WORD_RE.search(sample)))
+def iter_block_rows(input_file, report):
+    """
+    Stream entries written as ``Key: value`` blocks, as in ``input_files/template.txt``.
 
-            values = [v.strip() for v in line.split("|")[1:-1]]
-            if len(values) == len(headers):
-                rows.append(dict(zip(headers, values)))
-            else:
-                logger.warning(f"Mismatched row length: {values}")
+    Each entry starts with a ``Word:`` line, optionally as a ``-`` list item,
+    and ends at a blank line, a heading or the next ``Word:``. Key-value
+    lines outside an entry, such as a settings section, are ignored. Keys are
+    upper-cased to match the column names of the table formats, so
+    ``Word``/``Meaning`` become ``WORD``/``MEANING``.
+
+    Args:
+        input_file (str): Path to the input file.
+        report (ParseReport): Collects row counts and problems.
+
+    Yields:
+        dict: One entry, mapping keys to values.
+    """
+    entry = None
+    entry_line = 0
+
+    def finish():
+        if not entry["WORD"]:
+            report.add_error(entry_line, "Entry has an empty 'Word:' value.")
+            return None
+        if report.headers is None:
+            report.headers = list(entry)
+        report.rows += 1
+        return entry
+
+    with open(input_file, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#"):
+                if entry is not None and finish() is not None:
+                    yield entry
+                entry = None
+                continue
+
+            match = _KEY_VALUE_RE.match(line)
+            if match is None:
+                if entry is not None:
+                    report.add_error(line_number, "Expected a 'Key: value' line inside an entry.")
+                continue
+            key, value = match.group(1).strip().upper(), match.group(2).strip()
+            if key == "WORD":
+                if entry is not None and finish() is not None:
+                    yield entry
+                entry, entry_line = {"WORD": value}, line_number
+            elif entry is not None:
+                entry[key] = value
+
+    if entry is not None and finish() is not None:
+        yield entry
+    if report.headers is None and not report.error_count:
+        report.add_error(0, "No 'Word:' entries found.")
+
+def _iter_delimited_rows(input_file, report, delimiter):
+    """Stream rows of a delimited file with a header line, using the C ``csv`` reader."""
+    with open(input_file, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        headers = None
+        for cells in reader:
+            if not any(cell.strip() for cell in cells):
+                continue
+            cells = [cell.strip() for cell in cells]
+            if headers is None:
+                headers = report.headers = cells
+                continue
+            if len(cells) != len(headers):
+                report.add_error(reader.line_num, f"Expected {len(headers)} cells, found {len(cells)}.")
+                continue
+            report.rows += 1
+            yield dict(zip(headers, cells))
+
+    if headers is None:
+        report.add_error(0, "No header row found.")
+
+@register_input_format("csv", extensions=(".csv",), sniff=lambda sample: _sniff_delimiter(sample) == ",")
+def iter_csv_rows(input_file, report):
+    """Stream the rows of a comma-separated file whose first line holds the column names."""
+    return _iter_delimited_rows(input_file, report, ",")
+
+@register_input_format("tsv", extensions=(".tsv", ".tab"), sniff=lambda sample: _sniff_delimiter(sample) == "\t")
+def iter_tsv_rows(input_file, report):
+    """Stream the rows of a tab-separated file whose first line holds the column names."""
+    return _iter_delimited_rows(input_file, report, "\t")
+
+def _sniff_delimiter(sample):
+    """Return the delimiter ``csv.Sniffer`` finds in a sample, or None."""
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=",\t;").delimiter
+    except csv.Error:
+        return None
+
+def parse_input_file(input_file):
+    """
+    Parse the input file and return a list of rows.
+    Handles every registered input format, see ``iter_input_rows``.
+
+    Loads every row into memory; stream large files with ``iter_input_rows``.
+    """
+    report = ParseReport(input_file)
+    try:
+        rows = list(iter_input_rows(input_file, report))
     except Exception as e:
         logger.error(f"Error parsing input file: {e}")
+        return []
+    report.log()
     return rows
 
 def validate_input_file(input_file):
     """
-    Validate if the input file exists, is readable, and contains valid Markdown table formatting.
+    Validate if the input file exists, is readable, and contains rows in a supported format.
+
+    Only reads up to the first valid row. Malformed rows further down do not
+    fail validation; ``iter_input_rows`` skips and reports them.
 
     Args:
         input_file (str): Path to the input file.
 
     Returns:
-        bool: True if the file is valid, False otherwise.
+        bool: True if the file has at least one valid row, False otherwise.
     """
     if not os.path.exists(input_file):
         raise FileNotFoundError(f"Input file {input_file} does not exist.")
     if not os.access(input_file, os.R_OK):
         raise PermissionError(f"Input file {input_file} is not readable.")
 
-    # Check for valid Markdown table formatting
-    with open(input_file, "r", encoding="utf-8") as file:
-        lines = file.readlines()
-        if len(lines) < 2:
-            # A valid table needs at least a header and one row
-            return False
-
-        headers = lines[0].strip()
-        separator = lines[1].strip()
-
-        # Validate header and separator
-        if "|" not in headers or "---" not in separator:
-            return False
-
-        # Ensure rows have consistent pipe-separated values
-        header_columns = [col.strip() for col in headers.split("|") if col.strip()]
-        for line in lines[2:]:
-            row_columns = [col.strip() for col in line.split("|") if col.strip()]
-            if len(row_columns) != len(header_columns):
-                return False
-
+    report = ParseReport(input_file)
+    first_row = next(iter_input_rows(input_file, report), None)
+    if first_row is None:
+        report.log()
+        return False
     return True
-
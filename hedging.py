@@ -0,0 +1,113 @@
+# hedging.py
+# Latency tracking, adaptive timeouts and hedged calls across image providers.
+import asyncio
+import logging
+import math
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+LATENCY_WINDOW = 200  # Recent calls kept per provider
+MIN_SAMPLES = 20  # Calls needed before percentiles are trusted
+DEFAULT_TIMEOUT = 5  # Seconds, used until enough calls have been observed
+MIN_TIMEOUT = 1.5
+MAX_TIMEOUT = 15
+TIMEOUT_PERCENTILE = 95
+TIMEOUT_MULTIPLIER = 2  # Headroom over the observed percentile
+DEFAULT_HEDGE_PERCENTILE = 90
+
+
+class LatencyTracker:
+    """
+    Rolling window of call latencies per provider.
+
+    Feeds the per-provider request timeout (twice the recent p95, clamped)
+    and the delay before a hedged request is sent to a second provider.
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+
+    def record(self, provider, seconds):
+        self._samples.setdefault(provider, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, provider, pct):
+        """
+        Return the ``pct`` percentile of recent latencies for ``provider``.
+
+        Returns:
+            float: Latency in seconds, or None until ``MIN_SAMPLES`` calls were seen.
+        """
+        samples = self._samples.get(provider)
+        if not samples or len(samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1)
+        return ordered[max(0, index)]
+
+    def timeout_for(self, provider):
+        """Return the request timeout for ``provider``, adapted from its observed p95."""
+        p95 = self.percentile(provider, TIMEOUT_PERCENTILE)
+        if p95 is None:
+            return DEFAULT_TIMEOUT
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, p95 * TIMEOUT_MULTIPLIER))
+
+
+latency = LatencyTracker()
+
+
+async def hedged_call(primary, secondary, hedge_delay, accept, release=None):
+    """
+    Run ``primary`` and, if it is slow, race it against ``secondary``.
+
+    ``secondary`` starts once ``primary`` has been running for
+    ``hedge_delay`` seconds, or straight away if ``primary`` finishes
+    without an acceptable result. The first acceptable result wins and the
+    other call is cancelled.
+
+    Args:
+        primary (coroutine): The preferred call.
+        secondary (callable): Returns the fallback coroutine when invoked.
+        hedge_delay (float): Seconds to wait for ``primary`` before hedging.
+        accept (callable): Returns True for a usable result.
+        release (callable, optional): Called with ``(task_name, result)`` for an
+            acceptable result that lost the race, so it can be given back.
+
+    Returns:
+        The winning result, or the primary's result if neither was acceptable.
+    """
+    primary_task = asyncio.create_task(primary, name="primary")
+    tasks = {primary_task}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+        primary_ok = primary_task in done and primary_task.exception() is None
+        if primary_ok and accept(primary_task.result()):
+            return primary_task.result()
+
+        if primary_task not in done:
+            logger.debug("Primary provider slower than %.2fs, sending hedged request.", hedge_delay)
+        tasks.add(asyncio.create_task(secondary(), name="secondary"))
+        fallback = primary_task.result() if primary_ok else None
+        pending = {task for task in tasks if not task.done()}
+        winner = None
+
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda t: t.get_name() != "primary"):
+                if task.exception() is not None:
+                    logger.error("Hedged %s call failed: %s", task.get_name(), task.exception())
+                    continue
+                result = task.result()
+                if task is primary_task and fallback is None:
+                    fallback = result
+                if not accept(result):
+                    continue
+                if winner is None:
+                    winner = result
+                elif release is not None:
+                    release(task.get_name(), result)
+        return winner if winner is not None else fallback
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,244 @@
+# http_client.py
+# Process-wide HTTP clients shared by the image API modules.
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from hedging import latency
+from metrics import metrics
+from rate_limiter import DEFAULT_RETRY_AFTER, MAX_RATE_LIMIT_RETRIES, MAX_RETRIES, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONNECTION_LIMIT = 100  # Open connections across all hosts
+DEFAULT_LIMIT_PER_HOST = 10  # Open connections to a single API host
+DNS_CACHE_TTL = 300  # Seconds a resolved host is reused
+KEEPALIVE_TIMEOUT = 30  # Seconds an idle connection is kept for reuse
+REQUEST_TIMEOUT = 5  # Default total timeout per request, in seconds
+DEFAULT_MAX_CONCURRENCY = 8  # Image lookups in flight at the same time, per run (``max_concurrency``)
+DOWNLOAD_TIMEOUT = 30  # Total timeout for downloading one media file, in seconds
+RETRY_STATUSES = {500, 502, 503, 504}
+
+_session = None
+_session_loop = None
+_sync_session = None
+
+
+def _create_session(config=None):
+    """
+    Create the pooled aiohttp session.
+
+    Args:
+        config (dict, optional): May override ``http_connection_limit`` and ``http_limit_per_host``.
+
+    Returns:
+        aiohttp.ClientSession: A session with keep-alive and DNS caching enabled.
+    """
+    config = config or {}
+    connector = aiohttp.TCPConnector(
+        limit=config.get("http_connection_limit", DEFAULT_CONNECTION_LIMIT),
+        limit_per_host=config.get("http_limit_per_host", DEFAULT_LIMIT_PER_HOST),
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    logger.debug("Opened shared HTTP session.")
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+    )
+
+
+def get_session():
+    """
+    Return the shared aiohttp session, creating it on first use.
+
+    Must be called from inside a running event loop. A session left over
+    from an earlier event loop is replaced, since aiohttp sessions cannot be
+    shared across loops.
+
+    Returns:
+        aiohttp.ClientSession: The process-wide session.
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = _create_session()
+        _session_loop = loop
+    return _session
+
+
+async def close_session():
+    """Close the shared aiohttp session and release its pooled connections."""
+    global _session, _session_loop
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.debug("Closed shared HTTP session.")
+    _session = None
+    _session_loop = None
+
+
+@asynccontextmanager
+async def session_scope(config=None):
+    """
+    Tie the shared aiohttp session's lifetime to a block of work.
+
+    Args:
+        config (dict, optional): Connection pool settings, see ``_create_session``.
+
+    Yields:
+        aiohttp.ClientSession: The process-wide session.
+    """
+    global _session, _session_loop
+    await close_session()
+    _session = _create_session(config)
+    _session_loop = asyncio.get_running_loop()
+    try:
+        yield _session
+    finally:
+        await close_session()
+
+
+def parse_retry_after(value):
+    """Return the seconds requested by a ``Retry-After`` header, falling back to the default."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+async def get_json(url, limiter, params=None, headers=None):
+    """
+    GET a JSON document, paced by a rate limiter and retried on failure.
+
+    On a 429 the limiter is blocked for ``Retry-After`` seconds, which pauses
+    every caller of that API, and the request is sent again, up to
+    ``MAX_RATE_LIMIT_RETRIES`` times. Timeouts, connection errors and 5xx responses are retried with
+    jittered exponential backoff, up to ``MAX_RETRIES`` times and while the
+    limiter's retry budget lasts. Each attempt's timeout adapts to the
+    provider's recently observed latency.
+
+    Args:
+        url (str): Endpoint to call.
+        limiter (RateLimiter): Limiter for the API behind ``url``.
+        params (dict, optional): Query parameters.
+        headers (dict, optional): Request headers.
+
+    Returns:
+        The decoded JSON body.
+
+    Raises:
+        aiohttp.ClientError, asyncio.TimeoutError: When retries are exhausted
+            or the error is not worth retrying.
+    """
+    attempt = rate_limited = 0
+    while True:
+        await limiter.acquire()
+        timeout = latency.timeout_for(limiter.name)
+        started = time.monotonic()
+        metrics.inc("api_requests_total", provider=limiter.name)
+        try:
+            async with get_session().get(
+                url, params=params, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                metrics.inc("api_responses_total", provider=limiter.name, status=response.status)
+                await limiter.aupdate_from_headers(response.headers)
+                if response.status == 429:
+                    metrics.inc("api_rate_limited_total", provider=limiter.name)
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    await limiter.ablock_for(retry_after)
+                    if rate_limited >= MAX_RATE_LIMIT_RETRIES:
+                        response.raise_for_status()  # 429 is not retried below
+                    rate_limited += 1
+                    logger.warning("Rate limit exceeded for %s. Retrying after %s seconds...", limiter.name, retry_after)
+                    continue
+                response.raise_for_status()
+                data = await response.json()
+            elapsed = time.monotonic() - started
+            latency.record(limiter.name, elapsed)
+            metrics.observe("api_latency_seconds", elapsed, provider=limiter.name)
+            return data
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                latency.record(limiter.name, timeout)  # Lets a too-tight timeout widen itself
+            retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in RETRY_STATUSES
+            if not retryable or attempt >= MAX_RETRIES or not limiter.retry_budget.try_spend():
+                metrics.inc("api_errors_total", provider=limiter.name)
+                raise
+            metrics.inc("api_retries_total", provider=limiter.name)
+            delay = backoff_delay(attempt)
+            attempt += 1
+            logger.warning("Request to %s failed (%r). Retry %d in %.1fs.", limiter.name, e, attempt, delay)
+            await asyncio.sleep(delay)
+
+
+async def get_bytes(url, retry_budget, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Download a file over the shared session, retrying transient failures.
+
+    Used for media on CDNs, which are not paced by an API rate limiter.
+    Timeouts, connection errors and 5xx responses are retried with jittered
+    exponential backoff, up to ``MAX_RETRIES`` times and while
+    ``retry_budget`` lasts.
+
+    Args:
+        url (str): File to download.
+        retry_budget (RetryBudget): Shared by all downloads of a run.
+        timeout (float): Total seconds allowed per attempt.
+
+    Returns:
+        tuple: The body as bytes and the response's content type.
+
+    Raises:
+        aiohttp.ClientError, asyncio.TimeoutError: When retries are exhausted
+            or the error is not worth retrying.
+    """
+    attempt = 0
+    while True:
+        retry_budget.record_request()
+        try:
+            async with get_session().get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                response.raise_for_status()
+                return await response.read(), response.content_type
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in RETRY_STATUSES
+            if not retryable or attempt >= MAX_RETRIES or not retry_budget.try_spend():
+                raise
+            delay = backoff_delay(attempt)
+            attempt += 1
+            logger.warning("Download of %s failed (%r). Retry %d in %.1fs.", url, e, attempt, delay)
+            await asyncio.sleep(delay)
+
+
+def get_sync_session():
+    """
+    Return the shared blocking ``requests`` session for synchronous callers.
+
+    Returns:
+        requests.Session: A pooled session that retries transient failures.
+    """
+    global _sync_session
+    if _sync_session is None:
+        retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(
+            pool_connections=DEFAULT_LIMIT_PER_HOST,
+            pool_maxsize=DEFAULT_LIMIT_PER_HOST,
+            max_retries=retries,
+        )
+        _sync_session = requests.Session()
+        _sync_session.mount("https://", adapter)
+        _sync_session.mount("http://", adapter)
+    return _sync_session
+
+
+def close_sync_session():
+    """Close the shared blocking session."""
+    global _sync_session
+    if _sync_session is not None:
+        _sync_session.close()
+        _sync_session = None
@@ -0,0 +1,300 @@
+# image_cache.py
+# SQLite-backed cache for resolved image lookups.
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 24 * 60 * 60  # 24 hours in seconds
+DEFAULT_MAX_ENTRIES = 50000
+DEFAULT_MEMORY_ENTRIES = 1024  # Entries kept in the in-memory LRU tier
+EVICTION_INTERVAL = 500  # Writes between size-limit checks
+BULK_CHUNK_SIZE = 500  # Keys per query in get_many, below SQLite's variable limit
+BUSY_TIMEOUT = 30  # Seconds to wait for another process holding the write lock
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_cache (
+    key TEXT PRIMARY KEY,
+    image_url TEXT NOT NULL,
+    image_credit TEXT,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_image_cache_expires_at ON image_cache (expires_at);
+CREATE INDEX IF NOT EXISTS idx_image_cache_last_access ON image_cache (last_access);
+"""
+
+
+class ImageCache:
+    """
+    Key/value cache of image lookups stored in a WAL-mode SQLite database.
+
+    Lookups go through the primary key, expiry through the ``expires_at``
+    index and LRU eviction through the ``last_access`` index, so no operation
+    scans the whole cache. WAL mode lets several processes read while one
+    writes. The ``a*`` methods run the blocking calls in a worker thread so
+    they can be awaited from the event loop.
+
+    Recently used entries are also kept in an in-memory LRU tier, an
+    ``OrderedDict`` whose lookups, promotions and evictions are all O(1).
+    Hits and misses are counted for run summaries, and in the run metrics
+    under ``name`` with the tier that answered.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, memory_entries=DEFAULT_MEMORY_ENTRIES,
+                 name=None):
+        self.path = path
+        self.name = name or os.path.splitext(os.path.basename(path))[0]
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._touched = {}  # In-memory hits not yet written back to last_access
+        self._memory_lock = threading.Lock()
+        self._lock = threading.Lock()  # Guards the SQLite connection
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def get(self, key):
+        """
+        Look up a live entry and mark it as recently used.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            dict: ``{"image_url", "image_credit", "timestamp"}``, or None on a miss.
+        """
+        now = time.time()
+        entry = self._memory_get(key, now)
+        if entry is not None:
+            return entry
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT image_url, image_credit, created_at, expires_at FROM image_cache WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE image_cache SET last_access = ? WHERE key = ?", (now, key))
+
+        with self._memory_lock:
+            if row is None:
+                self._memory.pop(key, None)
+                self.misses += 1
+                metrics.inc("cache_lookups_total", cache=self.name, tier="sqlite", result="miss")
+                return None
+            entry = {"image_url": row[0], "image_credit": row[1], "timestamp": row[2]}
+            self._remember(key, entry, row[3])
+            self.hits += 1
+        metrics.inc("cache_lookups_total", cache=self.name, tier="sqlite", result="hit")
+        return dict(entry)
+
+    def get_many(self, keys):
+        """
+        Look up several keys with one query per chunk of ``BULK_CHUNK_SIZE``.
+
+        Args:
+            keys (iterable): Cache keys.
+
+        Returns:
+            dict: Maps each key that is a live hit to its entry.
+        """
+        now = time.time()
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            entry = self._memory_get(key, now)
+            if entry is not None:
+                found[key] = entry
+            else:
+                missing.append(key)
+
+        rows = []
+        with self._lock:
+            for start in range(0, len(missing), BULK_CHUNK_SIZE):
+                chunk = missing[start:start + BULK_CHUNK_SIZE]
+                placeholders = ", ".join("?" * len(chunk))
+                rows.extend(self._conn.execute(
+                    "SELECT key, image_url, image_credit, created_at, expires_at FROM image_cache "
+                    f"WHERE key IN ({placeholders}) AND expires_at > ?",
+                    (*chunk, now),
+                ).fetchall())
+            if rows:
+                with self._conn:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    self._conn.executemany(
+                        "UPDATE image_cache SET last_access = ? WHERE key = ?", [(now, row[0]) for row in rows]
+                    )
+
+        with self._memory_lock:
+            for key, image_url, image_credit, created_at, expires_at in rows:
+                entry = {"image_url": image_url, "image_credit": image_credit, "timestamp": created_at}
+                self._remember(key, entry, expires_at)
+                found[key] = dict(entry)
+            self.hits += len(rows)
+            self.misses += len(missing) - len(rows)
+        if rows:
+            metrics.inc("cache_lookups_total", len(rows), cache=self.name, tier="sqlite", result="hit")
+        if len(missing) > len(rows):
+            metrics.inc("cache_lookups_total", len(missing) - len(rows), cache=self.name, tier="sqlite", result="miss")
+        return found
+
+    def _memory_get(self, key, now):
+        """Look up the in-memory tier only. Returns None when the entry is absent or expired."""
+        with self._memory_lock:
+            cached = self._memory.get(key)
+            if cached is None or cached[1] <= now:
+                return None
+            self._memory.move_to_end(key)
+            self._touched[key] = now
+            self.hits += 1
+        metrics.inc("cache_lookups_total", cache=self.name, tier="memory", result="hit")
+        return dict(cached[0])
+
+    def _remember(self, key, entry, expires_at):
+        """Put an entry in the in-memory tier, evicting the least recently used one if full. Hold ``_memory_lock``."""
+        self._memory[key] = (entry, expires_at)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def set(self, key, image_url, image_credit):
+        """Store or replace an entry."""
+        self.set_many({key: {"image_url": image_url, "image_credit": image_credit}})
+
+    def set_many(self, entries):
+        """
+        Store several entries in one transaction.
+
+        Args:
+            entries (dict): Maps cache keys to dicts with ``image_url`` and ``image_credit``,
+                and optionally ``created_at`` for entries made earlier, which then expire earlier.
+        """
+        if not entries:
+            return
+        now = time.time()
+        rows = [
+            (key, entry["image_url"], entry.get("image_credit"), created_at, created_at + self.ttl, now)
+            for key, entry in entries.items()
+            for created_at in (entry.get("created_at", now),)
+        ]
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO image_cache "
+                    "(key, image_url, image_credit, created_at, expires_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+            self._writes += len(rows)
+            check_size = self._writes >= EVICTION_INTERVAL
+            if check_size:
+                self._writes = 0
+        with self._memory_lock:
+            for key, image_url, image_credit, created_at, expires_at, _ in rows:
+                self._remember(key, {"image_url": image_url, "image_credit": image_credit, "timestamp": created_at},
+                               expires_at)
+        if check_size:
+            self.enforce_size_limit()
+
+    def purge_expired(self):
+        """
+        Delete expired entries using the ``expires_at`` index.
+
+        Returns:
+            int: Number of entries removed.
+        """
+        now = time.time()
+        with self._lock:
+            removed = self._conn.execute("DELETE FROM image_cache WHERE expires_at <= ?", (now,)).rowcount
+        with self._memory_lock:
+            for key in [key for key, (_, expires_at) in self._memory.items() if expires_at <= now]:
+                del self._memory[key]
+        logger.debug("Cache cleaned. Removed %d expired entries.", removed)
+        return removed
+
+    def enforce_size_limit(self):
+        """
+        Evict the least recently used entries beyond ``max_entries``.
+
+        Returns:
+            int: Number of entries removed.
+        """
+        self._flush_touched()
+        with self._lock:
+            removed = self._conn.execute(
+                "DELETE FROM image_cache WHERE key IN "
+                "(SELECT key FROM image_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        if removed:
+            with self._memory_lock:
+                self._memory.clear()
+            logger.debug("Cache size limit enforced. Removed %d least recently used entries.", removed)
+        return removed
+
+    def _flush_touched(self):
+        """Write the recency of in-memory hits back to ``last_access`` in one batch."""
+        with self._memory_lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            with self._lock, self._conn:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.executemany(
+                    "UPDATE image_cache SET last_access = ? WHERE key = ?",
+                    [(accessed, key) for key, accessed in touched.items()],
+                )
+
+    def maintain(self):
+        """Run expiry and size housekeeping once."""
+        self.purge_expired()
+        self.enforce_size_limit()
+
+    def stats(self):
+        """
+        Return hit/miss counters for this process.
+
+        Returns:
+            dict: ``hits``, ``misses`` and ``hit_ratio``.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        self._flush_touched()
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM image_cache").fetchone()[0]
+
+    async def aget(self, key):
+        # In-memory hits are answered without a thread hop
+        entry = self._memory_get(key, time.time())
+        if entry is not None:
+            return entry
+        return await asyncio.to_thread(self.get, key)
+
+    async def aget_many(self, keys):
+        return await asyncio.to_thread(self.get_many, list(keys))
+
+    async def aset_many(self, entries):
+        await asyncio.to_thread(self.set_many, entries)
+
+    async def amaintain(self):
+        await asyncio.to_thread(self.maintain)
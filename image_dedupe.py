@@ -0,0 +1,269 @@
+# image_dedupe.py
+# Perceptual hashes and a BK-tree to keep near-identical images out of a deck.
+import asyncio
+import io
+import logging
+import sqlite3
+import threading
+import time
+
+import aiohttp
+
+import http_client
+from rate_limiter import RetryBudget
+
+logger = logging.getLogger(__name__)
+
+HASH_FILE = "image_hashes.sqlite3"
+HASH_SIZE = 8  # dHash grid; gives 64-bit hashes
+DEFAULT_MAX_DISTANCE = 6  # Differing bits up to which two images count as the same photo
+BUSY_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_hashes (
+    url TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    hashed_at REAL NOT NULL
+);
+"""
+
+
+def dhash(data, size=HASH_SIZE):
+    """
+    Compute the difference hash of an encoded image.
+
+    The image is reduced to a ``(size + 1) x size`` grayscale grid and each
+    bit records whether a pixel is brighter than its right-hand neighbour.
+    The hash survives resizing and re-encoding, so the same photo served at
+    different sizes or by different providers gets the same or a very
+    close hash.
+
+    Args:
+        data (bytes): Encoded image.
+
+    Returns:
+        int: The ``size * size``-bit hash.
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = image.convert("L").resize((size + 1, size), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(size):
+        for column in range(size):
+            offset = row * (size + 1) + column
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    return value
+
+
+def hamming(a, b):
+    """Number of differing bits between two hashes."""
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over Hamming distance.
+
+    Each child hangs off its parent under its distance to it, so by the
+    triangle inequality a search only descends into children whose edge
+    distance is within ``max_distance`` of the query's distance to the
+    parent. For small radii this visits a small fraction of the tree rather
+    than comparing against every hash.
+    """
+
+    def __init__(self):
+        self._root = None  # [hash, item, {distance: child}]; item is None once removed
+        self._size = 0
+
+    def add(self, value, item):
+        self._size += 1
+        if self._root is None:
+            self._root = [value, item, {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, item, {}]
+                return
+            node = child
+
+    def remove(self, value, item):
+        """
+        Remove ``item``, stored under hash ``value``.
+
+        The node stays in the tree to route searches to its children; only
+        its item is dropped.
+
+        Returns:
+            bool: True if the item was in the tree.
+        """
+        node = self._root
+        while node is not None:
+            if node[0] == value and node[1] == item:
+                node[1] = None
+                self._size -= 1
+                return True
+            node = node[2].get(hamming(value, node[0]))
+        return False
+
+    def search(self, value, max_distance):
+        """
+        Find every stored hash within ``max_distance`` bits of ``value``.
+
+        Returns:
+            list: ``(distance, item)`` pairs, closest first.
+        """
+        matches = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance and node[1] is not None:
+                matches.append((distance, node[1]))
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches, key=lambda match: match[0])
+
+    def __len__(self):
+        return self._size
+
+
+class ImageHashCache:
+    """Persists the hash of every image URL, so no image is downloaded twice just to be hashed."""
+
+    def __init__(self, path=HASH_FILE):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def get_many(self, urls):
+        """Return ``{url: hash}`` for the URLs hashed before."""
+        urls = list(dict.fromkeys(urls))
+        found = {}
+        with self._lock:
+            for start in range(0, len(urls), 500):
+                chunk = urls[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT url, hash FROM image_hashes WHERE url IN ({', '.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update((url, int(value, 16)) for url, value in rows)
+        return found
+
+    def set(self, url, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO image_hashes (url, hash, hashed_at) VALUES (?, ?, ?)",
+                (url, format(value, "x"), time.time()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SimilarImageIndex:
+    """
+    The perceptual hashes of the images chosen for the current deck.
+
+    Image providers ``claim`` a candidate before choosing it: a candidate
+    within ``max_distance`` bits of an image already in the deck is
+    rejected, so the provider moves on to its next candidate. Hashing
+    uses a small rendition where one exists, such as Pixabay's preview,
+    and hashes persist across runs in an ``ImageHashCache``.
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, hash_cache=None):
+        self.enabled = False
+        self.max_distance = max_distance
+        self.rejected = 0
+        self._hash_cache = hash_cache
+        self._tree = BKTree()
+        self._hashes = {}  # url -> hash of every image in the tree
+        self._retry_budget = RetryBudget()
+
+    def configure(self, config):
+        """Start a new deck: apply ``dedupe_similar_images``/``similar_image_distance`` and forget earlier images."""
+        self.enabled = bool(config.get("dedupe_similar_images"))
+        self.max_distance = config.get("similar_image_distance", DEFAULT_MAX_DISTANCE)
+        self.rejected = 0
+        self._tree = BKTree()
+        self._hashes = {}
+
+    def _cache(self):
+        if self._hash_cache is None:
+            self._hash_cache = ImageHashCache()
+        return self._hash_cache
+
+    async def hash_of(self, url):
+        """
+        Return the perceptual hash of the image at ``url``, downloading it only if it was never hashed.
+
+        Returns:
+            int: The hash, or None if the image could not be downloaded or decoded.
+        """
+        cached = (await asyncio.to_thread(self._cache().get_many, [url])).get(url)
+        if cached is not None:
+            return cached
+        try:
+            data, _ = await http_client.get_bytes(url, self._retry_budget)
+            value = await asyncio.to_thread(dhash, data)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            logger.debug("Could not hash image %s: %r", url, e)
+            return None
+        await asyncio.to_thread(self._cache().set, url, value)
+        return value
+
+    async def claim(self, url, hash_url=None):
+        """
+        Add an image to the deck unless a near-identical one is already in it.
+
+        Args:
+            url (str): The image that would be used.
+            hash_url (str, optional): A smaller rendition of the same image to hash instead.
+
+        Returns:
+            bool: True if the image may be used. Images that cannot be hashed are accepted.
+        """
+        if not self.enabled:
+            return True
+        value = await self.hash_of(hash_url or url)
+        if value is None:
+            return True
+        # Search and add without awaiting in between, so concurrent claims see each other
+        matches = self._tree.search(value, self.max_distance)
+        if matches:
+            self.rejected += 1
+            logger.info("Rejected %s: %d bits from %s, already in the deck.", url, matches[0][0], matches[0][1])
+            return False
+        self._add(url, value)
+        if hash_url and hash_url != url:
+            # Lets seed() find the hash by the URL the note keeps
+            await asyncio.to_thread(self._cache().set, url, value)
+        return True
+
+    async def seed(self, urls):
+        """Add images already in the deck, e.g. from reused notes, using only hashes known from earlier runs."""
+        if not self.enabled or not urls:
+            return
+        for url, value in (await asyncio.to_thread(self._cache().get_many, urls)).items():
+            self._add(url, value)
+
+    def release(self, url):
+        """Take back an image claimed for a lookup whose result will not be used."""
+        value = self._hashes.pop(url, None)
+        if value is not None:
+            self._tree.remove(value, url)
+
+    def _add(self, url, value):
+        if url in self._hashes:
+            self._tree.remove(self._hashes[url], url)
+        self._hashes[url] = value
+        self._tree.add(value, url)
+
+
+similar_images = SimilarImageIndex()
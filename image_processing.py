@@ -0,0 +1,137 @@
+# image_processing.py
+# Resizes and re-encodes embedded images in worker processes.
+import asyncio
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IMAGE_FORMAT = "webp"
+DEFAULT_IMAGE_QUALITY = 80
+IMAGE_FORMATS = {"webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg")}  # Name -> (Pillow format, extension)
+PARALLEL_THRESHOLD = 4  # Images in one call before a process pool is used
+
+
+def image_settings(config):
+    """
+    Read the transcode settings from the config.
+
+    Returns:
+        dict: ``width``, ``format`` and ``quality``, or None if ``image_width`` is not set.
+
+    Raises:
+        ValueError: If ``image_format`` is not one of ``IMAGE_FORMATS``.
+    """
+    width = config.get("image_width")
+    if not width:
+        return None
+    image_format = config.get("image_format", DEFAULT_IMAGE_FORMAT).lower()
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image_format '{image_format}'. Use one of: {', '.join(IMAGE_FORMATS)}.")
+    return {"width": int(width), "format": image_format, "quality": int(config.get("image_quality", DEFAULT_IMAGE_QUALITY))}
+
+
+def settings_key(settings):
+    """Return the key transcodes made with ``settings`` are cached under, e.g. ``webp-480-q80``."""
+    return f"{settings['format']}-{settings['width']}-q{settings['quality']}"
+
+
+def transcode_image(source_path, width, image_format, quality):
+    """
+    Shrink an image to at most ``width`` pixels wide and re-encode it.
+
+    Runs in worker processes. Images are never scaled up. JPEG output is
+    progressive and has transparency flattened onto white.
+
+    Args:
+        source_path (str): Image to read.
+        width (int): Largest width of the result, in pixels.
+        image_format (str): A key of ``IMAGE_FORMATS``.
+        quality (int): Encoder quality, 1-100.
+
+    Returns:
+        bytes: The encoded image.
+    """
+    from PIL import Image, ImageOps
+
+    pillow_format = IMAGE_FORMATS[image_format][0]
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        buffer = io.BytesIO()
+        if pillow_format == "JPEG":
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, "white")
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+            image.save(buffer, "JPEG", quality=quality, optimize=True, progressive=True)
+        else:
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() or image.mode == "P" else "RGB")
+            image.save(buffer, "WEBP", quality=quality, method=6)
+    return buffer.getvalue()
+
+
+async def transcode_media(paths, store, settings, workers=None):
+    """
+    Resize and re-encode stored images, reusing earlier results.
+
+    Transcodes are cached in the media store by source hash and settings, so
+    each image is only processed once per setting across decks and runs.
+    Larger batches are spread over a process pool. An image that cannot be
+    decoded is logged and kept as it is.
+
+    Args:
+        paths (iterable): Paths of source images in ``store``.
+        store (MediaStore): Where the sources live and the results go.
+        settings (dict): Result of ``image_settings``.
+        workers (int, optional): Worker processes. Defaults to the CPU count.
+
+    Returns:
+        dict: Maps each source path to the path to package instead.
+    """
+    sources = list(dict.fromkeys(paths))
+    key = settings_key(settings)
+    results = await asyncio.to_thread(store.lookup_transcodes, sources, key)
+    missing = [source for source in sources if source not in results]
+    if not missing:
+        return results
+
+    args = (settings["width"], settings["format"], settings["quality"])
+    workers = min(workers or os.cpu_count() or 1, len(missing))
+    if len(missing) > PARALLEL_THRESHOLD and workers > 1:
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            encoded = await asyncio.gather(
+                *(loop.run_in_executor(pool, transcode_image, source, *args) for source in missing),
+                return_exceptions=True,
+            )
+    else:
+        encoded = [
+            await asyncio.to_thread(_transcode_or_error, source, args) for source in missing
+        ]
+
+    extension = IMAGE_FORMATS[settings["format"]][1]
+    saved = 0
+    for source, data in zip(missing, encoded):
+        if isinstance(data, Exception):
+            logger.warning("Could not transcode %s, embedding it unchanged: %r", source, data)
+            results[source] = source
+            continue
+        results[source] = await asyncio.to_thread(store.put_transcode, source, key, data, extension)
+        saved += os.path.getsize(source) - len(data)
+    logger.info("Transcoded %d images to %s, saving %.0f KiB.", len(missing), key, saved / 1024)
+    return results
+
+
+def _transcode_or_error(source, args):
+    try:
+        return transcode_image(source, *args)
+    except Exception as e:
+        return e
@@ -1,34 +1,188 @@
+import atexit
 import logging
+import logging.handlers
+import multiprocessing.util
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 
-def setup_logging(log_dir="logs"):
+DEFAULT_LEVEL = "INFO"
+DEFAULT_REPEAT_INTERVAL = 60  # Seconds during which a repeated warning is logged only once
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+CONSOLE_FORMAT = LOG_FORMAT + '%(repeats)s'  # Set by RepeatedWarningFilter
+
+_listener = None
+_options = {}  # Arguments of the last setup_logging call, for batch worker processes
+
+
+class RepeatedWarningFilter(logging.Filter):
+    """
+    Lets each warning through once per ``interval`` seconds.
+
+    Meant for the console: the log file keeps every record. Warnings are
+    told apart by logger and message template, so with lazy ``%``-style
+    arguments every "No results for query %r" counts as the same warning.
+    When a suppressed warning is next let through, its ``repeats``
+    attribute tells how many were dropped; ``CONSOLE_FORMAT`` shows it.
+    The record itself is left alone, as other handlers share it. Errors
+    and more severe records always pass.
+    """
+
+    def __init__(self, interval=DEFAULT_REPEAT_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._seen = {}  # (logger, template) -> [last logged at, suppressed since]
+
+    def filter(self, record):
+        record.repeats = ""
+        if record.levelno != logging.WARNING or self.interval <= 0:
+            return True
+        key = (record.name, str(getattr(record, "template", record.msg)))
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self.interval:
+                seen[1] += 1
+                return False
+            suppressed = seen[1] if seen is not None else 0
+            self._seen[key] = [now, 0]
+        if suppressed:
+            record.repeats = f" (repeated {suppressed} more times in the last {self.interval:g}s)"
+        return True
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records without formatting them, so messages are built on the listener thread."""
+
+    def prepare(self, record):
+        if record.exc_info:
+            # Tracebacks refer to live frames; render them now
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if record.args and not all(isinstance(arg, (str, int, float, type(None))) for arg in _args_of(record)):
+            # Mutable arguments may change before the listener gets to them
+            record.template = record.msg
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def _args_of(record):
+    return record.args.values() if isinstance(record.args, dict) else record.args
+
+
+def parse_level(level):
+    """Turn a level name such as ``"debug"`` or a number into a logging level."""
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).upper())
+    if not isinstance(value, int):
+        raise ValueError(f"Unknown log level: {level}")
+    return value
+
+
+def parse_module_levels(specs):
+    """
+    Parse ``NAME=LEVEL`` pairs, e.g. from ``--log-module pixabay_api=DEBUG``.
+
+    Returns:
+        dict: Maps logger names to levels.
+    """
+    levels = {}
+    for spec in specs or []:
+        name, sep, level = spec.partition("=")
+        if not sep or not name:
+            raise ValueError(f"Expected NAME=LEVEL, got '{spec}'.")
+        levels[name.strip()] = parse_level(level.strip())
+    return levels
+
+
+def _start_listener(handlers):
+    global _listener
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # Pool workers leave through os._exit, which skips atexit but runs these finalizers
+    multiprocessing.util.Finalize(None, stop_logging, exitpriority=0)
+    return log_queue
+
+
+def _restart_listener_in_child():
+    # A forked worker inherits the queue handler but not the listener thread
+    if _listener is not None:
+        log_queue = _start_listener(_listener.handlers)
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, _DeferredQueueHandler):
+                handler.queue = log_queue
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_listener_in_child)
+
+
+def setup_logging(log_dir="logs", level=DEFAULT_LEVEL, module_levels=None, repeat_interval=DEFAULT_REPEAT_INTERVAL):
     """
     Configures and sets up logging for the application.
 
+    Records go through a queue to a background thread that formats them and
+    writes them to the log file and the console, so logging calls never
+    wait on disk or terminal I/O. The file gets every record; the console
+    shows a repeated warning once per ``repeat_interval``.
+
     Args:
         log_dir (str): Directory to save log files.
+        level (str or int): Level of the root logger, e.g. ``"DEBUG"``.
+        module_levels (dict, optional): Levels of individual loggers, e.g. ``{"pixabay_api": "DEBUG"}``.
+        repeat_interval (float): Seconds during which the console shows a repeated warning only once; 0 shows them all.
 
     Returns:
         Logger: Configured logger instance.
     """
+    global _options
+    _options = {"log_dir": log_dir, "level": level, "module_levels": module_levels, "repeat_interval": repeat_interval}
+    stop_logging()
     os.makedirs(log_dir, exist_ok=True)
 
     log_filename = os.path.join(log_dir, f"anki_processing_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
 
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_filename),
-            logging.StreamHandler()
-        ]
-    )
+    file_handler = logging.FileHandler(log_filename)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    console_handler.addFilter(RepeatedWarningFilter(repeat_interval))
+
+    queue_handler = _DeferredQueueHandler(_start_listener([file_handler, console_handler]))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(parse_level(level))
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(parse_level(module_level))
 
     logger = logging.getLogger(__name__)
-    logger.info(f"Logging initialized. Logs will be saved to: {log_filename}")
+    logger.info("Logging initialized. Logs will be saved to: %s", log_filename)
     return logger
 
+def logging_options():
+    """Return the arguments ``setup_logging`` was last called with, to repeat them in another process."""
+    return dict(_options)
+
+def stop_logging():
+    """Write out every queued record and stop the background writer."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+atexit.register(stop_logging)
+
 def log_error(logger, message, exc_info=True):
     """
     Logs an error message.
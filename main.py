@@ -1,24 +1,34 @@
+import argparse
+import glob
 import logging
 import os
 import re
-from datetime import datetime
-from tkinter import filedialog
+import shutil
+import time
+from collections import Counter, deque
 import asyncio
 import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import http_client
 import pixabay_api
 import pexels_api
 
 from tqdm import tqdm
 
-from anki_utils import create_deck, add_note_to_deck, export_deck
-from file_utils import get_default_input_files, parse_input_file, validate_input_file, save_config
+from anki_utils import deck_id_for
+from apkg_writer import DEFAULT_BATCH_SIZE, ApkgWriter
+from hedging import DEFAULT_HEDGE_PERCENTILE, hedged_call, latency
+from http_client import DEFAULT_MAX_CONCURRENCY
+from file_utils import ParseReport, get_default_input_files, iter_input_rows, validate_input_file, save_config
+from image_dedupe import similar_images
+from image_processing import image_settings, transcode_media
+from logging_utils import DEFAULT_LEVEL, DEFAULT_REPEAT_INTERVAL, logging_options, parse_module_levels, setup_logging
+from manifest import EXPORT_KEYS, BuildManifest, RowKeys, config_fingerprint, manifest_path_for
+from media_store import DEFAULT_DOWNLOAD_CONCURRENCY, download_media, get_media_store
+from metrics import METRICS_DIR, metrics
 from pixabay_api import fetch_pixabay_image
-from utils import load_synonym_dict, get_synonyms, load_config
-
-if hasattr(pixabay_api, "requests"):
-    print("Requests module is available in pixabay_api.")
-else:
-    print("Requests module is NOT available in pixabay_api.")
+from synonym_fetcher import DEFAULT_CONCURRENCY
+from utils import get_synonym_index, get_synonyms, load_config, prefetch_synonyms
 
 # Constants
 LOG_DIR = os.path.join(os.getcwd(), "logs")
@@ -26,55 +36,78 @@ CONFIG_FILE_PATH = os.path.join(os.getcwd(), "config.json")
 SYNONYM_DICT_PATH = "synonyms.json"
 INPUT_FILES_DIR = os.path.join(os.getcwd(), "input_files")
 OUTPUT_DIR = os.path.join(os.getcwd(), "ANKI")
+FAKE_API_STATE_DIR = "fake_api_state"  # Working directory of --fake-api runs, so fake results stay out of real ones
+DEFAULT_ROW_TIMEOUT = 120  # Seconds allowed for one row's image lookup
+REORDER_WINDOW_FACTOR = 4  # Rows buffered per concurrency slot to keep input order
+_batch_worker = False  # Set in batch worker processes, whose metrics go back to the parent
+_fake_api_state = None  # State directory while the fake APIs are in use
+
+logger = logging.getLogger(__name__)
 
-# Configure Logging
 def ensure_directories():
     """Ensure necessary directories exist."""
     os.makedirs(LOG_DIR, exist_ok=True)
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-ensure_directories()
-
-log_filename = os.path.join(LOG_DIR, f"anki_processing_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),  # Logs to a file with a timestamped name
-        logging.StreamHandler()            # Logs to the console
-    ]
-)
-logger = logging.getLogger(__name__)
-logging.info("Script started.")
+# Configure Logging
+def configure_logging(level=DEFAULT_LEVEL, module_levels=None, repeat_interval=DEFAULT_REPEAT_INTERVAL):
+    """Create the run's directories and start logging to a timestamped file and the console."""
+    ensure_directories()
+    setup_logging(LOG_DIR, level, module_levels, repeat_interval)
+    logger.info("Script started.")
 
 def save_config(file_path, config):
     with open(file_path, 'w') as f:
         json.dump(config, f, indent=4)
 
-def fetch_image(query, config):
+async def fetch_image(query, config, synonym_dict=None):
     """
     Attempt to fetch an image using Pixabay, then fallback to Pexels.
+
+    With ``hedge_requests`` enabled, Pexels is queried as soon as Pixabay has
+    been slower than its recent ``hedge_percentile`` latency, and whichever
+    provider answers first with an image wins.
     """
     cache_key = f"image-{query}"
-
-    # Try Pixabay first
-    image_url, image_credit = pixabay_api.fetch_pixabay_images(query, cache_key, pixabay_api.cache, config)
-    if image_url:
-        return image_url, image_credit
-
-    # Fallback to Pexels
-    logger.info(f"Falling back to Pexels for query '{query}'.")
-    image_url, image_credit = pexels_api.fetch_pexels_images(query, cache_key, pexels_api.cache)
-    if image_url:
-        return image_url, image_credit
-
-    logger.warning(f"No image found for query '{query}' using both APIs.")
-    return None, None
+    pixabay_lookup = fetch_pixabay_image(query, synonym_dict=synonym_dict, config=config)
+
+    if not pexels_api.get_api_key():
+        return await pixabay_lookup
+
+    if config.get("hedge_requests"):
+        hedge_percentile = config.get("hedge_percentile", DEFAULT_HEDGE_PERCENTILE)
+        hedge_delay = latency.percentile("pixabay", hedge_percentile) or latency.timeout_for("pixabay")
+        def fall_back():
+            metrics.inc("fallbacks_total", source="pixabay", target="pexels")
+            return pexels_api.fetch_pexels_images_async(query, cache_key)
+
+        image_url, image_credit = await hedged_call(
+            pixabay_lookup,
+            fall_back,
+            hedge_delay,
+            accept=lambda result: bool(result[0]),
+            release=release_image,
+        )
+    else:
+        image_url, image_credit = await pixabay_lookup
+        if not image_url:
+            # Fallback to Pexels
+            logger.info("Falling back to Pexels for query '%s'.", query)
+            metrics.inc("fallbacks_total", source="pixabay", target="pexels")
+            image_url, image_credit = await pexels_api.fetch_pexels_images_async(query, cache_key)
+
+    if not image_url:
+        logger.warning("No image found for query '%s' using both APIs.", query)
+    return image_url, image_credit
+
+def release_image(provider_call, result):
+    """Give back an image reserved by the losing side of a hedged lookup."""
+    provider = pixabay_api if provider_call == "primary" else pexels_api
+    provider.release_image(result[0])
 
 def get_pixabay_api_key(config):
     """Load or prompt for the Pixabay API key."""
-    api_key = config.get("pixabay_api_key")
+    api_key = config.get("pixabay_api_key") or os.getenv("PIXABAY_API_KEY")
     if not api_key:
         api_key = input("Enter your Pixabay API Key: ").strip()
         if api_key:
@@ -90,7 +123,7 @@ def get_pixabay_api_key(config):
 
 def select_input_file():
     """Select the input file."""
-    input_files = get_default_input_files()
+    input_files = get_default_input_files(INPUT_FILES_DIR)
     if input_files:
         print("Available input files in 'input_files/':")
         for idx, file in enumerate(input_files, start=1):
@@ -98,6 +131,7 @@ def select_input_file():
         file_choice = input("Enter the number of the file to process (or press Enter to choose manually): ").strip()
         if file_choice.isdigit() and 1 <= int(file_choice) <= len(input_files):
             return os.path.join(INPUT_FILES_DIR, input_files[int(file_choice) - 1])
+    from tkinter import filedialog  # Loaded only when the dialog is needed
     selected_file = filedialog.askopenfilename(
         title="Select your Markdown/CSV input file",
         initialdir=INPUT_FILES_DIR,
@@ -120,13 +154,505 @@ def get_deck_name():
         exit(1)
     return deck_name
 
+def build_row_query(row):
+    """Build the normalized image search query for a row."""
+    raw_query = row.get("MEANING", "").strip()
+    query = re.sub(r"[^\w\s]", " ", raw_query).strip()
+    return re.sub(r"\s+", " ", query)  # Normalize spaces
+
+def collect_row_queries(rows):
+    """
+    Count the normalized query of every usable row.
+
+    Returns:
+        Counter: Maps each distinct query to the number of rows using it.
+    """
+    query_counts = Counter(
+        build_row_query(row) for row in rows
+        if isinstance(row, dict) and (row.get("WORD") or row.get("Front"))
+    )
+    query_counts.pop("", None)
+    return query_counts
+
+async def resolve_row_image(query, config, synonym_dict):
+    """Try the query and its synonyms until one of the image APIs returns an image."""
+    synonyms = get_synonyms(query, fetch_online=False)  # Online misses were resolved by prefetch_synonyms
+    expanded_queries = [query] + synonyms
+
+    for expanded_query in expanded_queries:
+        image_url, image_credit = await fetch_image(expanded_query, config, synonym_dict=synonym_dict)
+        if image_url:
+            return image_url, image_credit
+    return None, None
+
+async def enrich_row(idx, row, config, synonym_dict):
+    """
+    Build the note fields for a single row.
+
+    Image lookup is bounded by the configured per-row deadline; a row that
+    runs out of time still becomes a note, just without an image.
+
+    Returns:
+        tuple: (front_text, back_text, image_url), or None if the row is unusable.
+    """
+    if not isinstance(row, dict):
+        logger.error(f"Invalid row format at index {idx + 1}: {row}")
+        return None
+
+    front_text = row.get("WORD") or row.get("Front")
+    if not front_text:
+        return None
+    front_text = front_text.strip()
+
+    query = build_row_query(row)
+    row_timeout = config.get("row_timeout", DEFAULT_ROW_TIMEOUT)
+    try:
+        image_url, image_credit = await asyncio.wait_for(
+            resolve_row_image(query, config, synonym_dict), timeout=row_timeout
+        )
+    except asyncio.TimeoutError:
+        logger.warning("Image lookup for row %d ('%s') exceeded %ss. Continuing without image.", idx + 1, query, row_timeout)
+        image_url, image_credit = None, None
+
+    if not image_url:
+        logger.warning("No suitable image found for any query of row %d.", idx + 1)
+
+    back_parts = [f"<b>{k}:</b> {v.strip()}" for k, v in row.items() if k.lower() not in ["word", "front"] and v]
+    if image_credit:
+        back_parts.append(f"<b>Image Credit:</b> {image_credit}")
+
+    return front_text, "<br>".join(back_parts), image_url
+
+async def enrich_rows(rows, config, synonym_dict, reuse=None):
+    """
+    Enrich rows concurrently while yielding results in input order.
+
+    At most ``max_concurrency`` rows are looked up at once. Finished rows are
+    held in a small reorder window until every row before them is done.
+
+    Args:
+        rows (iterable): Parsed input rows.
+        config (dict): Configuration settings.
+        synonym_dict (dict or SynonymIndex): Synonyms for query expansion.
+        reuse (callable, optional): Returns a previously built note for a row,
+            or None if the row has to be enriched.
+
+    Yields:
+        tuple: (row, note) where note is the result of ``enrich_row`` or None.
+    """
+    max_concurrency = max(1, int(config.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    window = deque()
+
+    async def run(idx, row):
+        if reuse is not None:
+            note = reuse(row)
+            if note is not None:
+                return note
+        async with semaphore:
+            try:
+                return await enrich_row(idx, row, config, synonym_dict)
+            except Exception as e:
+                logger.error(f"Error processing row {idx + 1}: {e}")
+                return None
+
+    try:
+        for idx, row in enumerate(rows):
+            window.append((row, asyncio.create_task(run(idx, row))))
+            if len(window) >= max_concurrency * REORDER_WINDOW_FACTOR:
+                row, task = window.popleft()
+                yield row, await task
+        while window:
+            row, task = window.popleft()
+            yield row, await task
+    finally:
+        for _, task in window:
+            task.cancel()
+
+async def embed_note_media(urls, config):
+    """
+    Download note images into the media store, so the deck can carry local copies.
+
+    With ``image_width`` set, the images are also resized and re-encoded
+    to ``image_format``. Notes keep the remote URL if its download fails.
+
+    Args:
+        urls (iterable): Image URLs used by the deck's notes.
+        config (dict): Configuration settings.
+
+    Returns:
+        tuple: A dict mapping each available URL to its media file name, and
+               the sorted paths of the stored files to package with the deck.
+    """
+    urls = {url for url in urls if url.startswith(("http://", "https://"))}
+    concurrency = config.get("download_concurrency", DEFAULT_DOWNLOAD_CONCURRENCY)
+    store = get_media_store(config)
+    paths = await download_media(urls, store, concurrency=concurrency)
+    settings = image_settings(config)
+    if settings and paths:
+        transcoded = await transcode_media(paths.values(), store, settings, workers=config.get("image_workers"))
+        paths = {url: transcoded.get(path, path) for url, path in paths.items()}
+    names = {url: os.path.basename(path) for url, path in paths.items()}
+    return names, sorted(set(paths.values()))
+
+def deck_name_for(input_file):
+    """Derive a deck name from an input file name, e.g. ``input_files/Top Verbs.md`` -> ``Top Verbs``."""
+    stem = os.path.splitext(os.path.basename(input_file))[0]
+    return re.sub(r"[^\w\s]", "", stem).strip() or "Deck"
+
+async def build_deck(input_file, deck_name, config, show_progress=True):
+    """
+    Build one input file into an ``.apkg`` under ``OUTPUT_DIR``.
+
+    The rows are streamed twice: once to validate them and collect the
+    run's distinct queries, then again while cards are built. Rows recorded
+    in the deck's build manifest with the same content and settings reuse
+    their previous note and cost no API calls; when nothing changed, the
+    existing ``.apkg`` is kept as is. Notes are streamed into the package's
+    database as they are built, so memory does not grow with the deck.
+
+    Args:
+        input_file (str): Path to the input file.
+        deck_name (str): Name of the deck and of the ``.apkg`` file.
+        config (dict): Configuration settings.
+        show_progress (bool): Show a progress bar while rows are processed.
+
+    Returns:
+        dict: ``input_file``, ``deck_name``, ``output_path``, ``rows``, ``notes``,
+              ``skipped``, ``reused``, ``rejected`` and ``seconds``.
+
+    Raises:
+        ValueError: If the file has no valid rows.
+    """
+    started = time.perf_counter()
+    output_path = os.path.join(OUTPUT_DIR, f"{deck_name}.apkg")
+    deck_id = deck_id_for(deck_name)
+    fingerprint = config_fingerprint(config)
+    export_fingerprint = config_fingerprint(config, EXPORT_KEYS)
+    manifest_path = manifest_path_for(output_path)
+    previous = BuildManifest.load(manifest_path)
+    manifest = BuildManifest(manifest_path, export=export_fingerprint)
+
+    def reused_note(key):
+        entry = previous.get(key)
+        return tuple(entry["fields"]) if entry is not None else None
+
+    similar_images.configure(config)
+    reused_images = []
+    parse_keys = RowKeys(fingerprint)
+
+    def needs_lookup(row):
+        note = reused_note(parse_keys(row))
+        if note is None:
+            return True
+        if note[2]:
+            reused_images.append(note[2])
+        return False
+
+    logger.info("Parsing input file %s...", input_file)
+    report = ParseReport(input_file)
+    # Only rows the manifest does not know need synonyms and images
+    with metrics.stage("parse"):
+        query_counts = collect_row_queries(row for row in iter_input_rows(input_file, report) if needs_lookup(row))
+    report.log()
+    if not report.rows:
+        raise ValueError(f"No valid rows found in {input_file}.")
+
+    # The shared index also picks up the synonyms prefetched below
+    synonym_dict = get_synonym_index(SYNONYM_DICT_PATH)
+    notes = skipped_rows = reused = 0
+    # Images are kept unique per deck
+    pixabay_api.response_memo.clear()
+    pixabay_api.used_images.clear()
+    pexels_api.used_images.clear()
+    # Images kept from the previous build are taken, whichever provider found them
+    pixabay_api.used_images.update(reused_images)
+    pexels_api.used_images.update(reused_images)
+    embed_media = config.get("embed_media")
+    image_urls = set()
+    row_keys = RowKeys(fingerprint)
+    keys = {}  # id(row) -> manifest key, for rows between input and output
+
+    def keyed_rows():
+        for row in iter_input_rows(input_file):
+            keys[id(row)] = row_keys(row)
+            yield row
+
+    def reuse(row):
+        return reused_note(keys[id(row)])
+    logger.info("Creating Anki deck '%s'...", deck_name)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    batch_size = config.get("export_batch_size", DEFAULT_BATCH_SIZE)
+    with ApkgWriter(output_path, deck_name, deck_id, batch_size=batch_size) as writer:
+        async with http_client.session_scope(config):
+            # ...and so are their near-duplicates
+            await similar_images.seed(reused_images)
+            # Opening the caches purges expired entries; keep that off the event loop
+            await pixabay_api.aget_cache(config)
+            await pexels_api.aget_cache(config)
+            if query_counts:
+                logger.info("Resolving online synonyms for new queries...")
+                with metrics.stage("expand"):
+                    await prefetch_synonyms(query_counts, concurrency=config.get("synonym_concurrency", DEFAULT_CONCURRENCY))
+            with metrics.stage("fetch"):
+                if query_counts and config.get("prefetch", True):
+                    logger.info("Prefetching images for distinct queries...")
+                    await pixabay_api.prefetch_pixabay_responses(query_counts, synonym_dict, config)
+                with tqdm(total=report.rows, desc="Processing rows", disable=not show_progress) as progress:
+                    async for row, note in enrich_rows(keyed_rows(), config, synonym_dict, reuse=reuse):
+                        progress.update(1)
+                        key = keys.pop(id(row))
+                        if note is None:
+                            skipped_rows += 1
+                            continue
+                        entry = previous.get(key)
+                        if entry is not None and not manifest.has_guid(entry["guid"]):
+                            guid = entry["guid"]
+                            reused += 1
+                        else:
+                            guid = manifest.new_guid(deck_id, note[0], key)
+                        manifest.record(key, guid, note)
+                        writer.add_note(note, guid=guid)
+                        if embed_media and note[2]:
+                            image_urls.add(note[2])
+                        notes += 1
+
+            logger.info("Reused %d of %d notes from the previous build.", reused, notes)
+            unchanged = reused == notes and manifest.entries.keys() == previous.entries.keys()
+            export = not (unchanged and manifest.export == previous.export and os.path.exists(output_path))
+            media_files = None
+            if not export:
+                logger.info("Nothing changed since the last build. Keeping %s", output_path)
+            elif embed_media:
+                with metrics.stage("media"):
+                    media_names, media_files = await embed_note_media(image_urls, config)
+                    writer.replace_field(2, media_names)
+
+        if export:
+            logger.info("Exporting Anki deck...")
+            with metrics.stage("export"):
+                writer.finish(media_files)
+            manifest.save()
+            logger.info("Anki deck created successfully! Saved to %s", output_path)
+    for provider in (pixabay_api, pexels_api):
+        if provider.cache is not None:
+            logger.info("%s cache: %s", provider.__name__, provider.cache.stats())
+    if similar_images.rejected:
+        logger.info("Rejected %d near-duplicate images.", similar_images.rejected)
+    if skipped_rows:
+        logger.warning("Skipped %d rows. Check logs for details.", skipped_rows)
+    metrics.inc("rows_total", report.rows)
+    metrics.inc("notes_total", notes)
+    metrics.inc("rows_skipped_total", skipped_rows)
+    metrics.inc("rows_reused_total", reused)
+    return {
+        "input_file": input_file,
+        "deck_name": deck_name,
+        "output_path": output_path,
+        "rows": report.rows,
+        "notes": notes,
+        "skipped": skipped_rows,
+        "reused": reused,
+        "rejected": report.error_count,
+        "seconds": time.perf_counter() - started,
+    }
+
+def build_deck_file(input_file, config):
+    """
+    Build one deck in a batch worker process.
+
+    Errors are returned rather than raised, so one bad file does not stop the batch.
+    In a worker process, the file's run metrics are returned under ``metrics``
+    for the parent to merge.
+
+    Returns:
+        dict: The result of ``build_deck``, or ``input_file`` and ``error``.
+    """
+    if _batch_worker:
+        metrics.reset()
+    try:
+        result = asyncio.run(build_deck(input_file, deck_name_for(input_file), config, show_progress=False))
+    except ValueError as e:
+        logger.error(str(e))
+        result = {"input_file": input_file, "error": str(e)}
+    except Exception as e:
+        logger.error(f"Failed to build a deck from {input_file}: {e}", exc_info=True)
+        result = {"input_file": input_file, "error": str(e)}
+    if _batch_worker:
+        result["metrics"] = metrics.snapshot()
+    return result
+
+def init_batch_worker(log_options=None):
+    """Set up logging and metrics in a batch worker, unless it inherited the parent's logging handlers."""
+    global _batch_worker
+    _batch_worker = True
+    if not logging.getLogger().handlers:
+        log_options = dict(log_options or {})
+        log_options.pop("log_dir", None)
+        configure_logging(**log_options)
+
+def resolve_batch_files(patterns):
+    """
+    Expand batch patterns into input files.
+
+    Args:
+        patterns (list): Glob patterns or paths. Empty means every file in ``INPUT_FILES_DIR``.
+
+    Returns:
+        list: Sorted, distinct file paths.
+    """
+    if not patterns:
+        return [os.path.join(INPUT_FILES_DIR, name) for name in sorted(get_default_input_files(INPUT_FILES_DIR))]
+    files = dict.fromkeys(path for pattern in patterns for path in sorted(glob.glob(pattern)) if os.path.isfile(path))
+    return list(files)
+
+def run_batch(input_files, config, workers=None):
+    """
+    Build every input file into its own deck, spreading the files over a process pool.
+
+    The workers share the SQLite image caches and rate limiters, so together
+    they stay under each API's quota and reuse each other's lookups.
+
+    Args:
+        input_files (list): Files to build.
+        config (dict): Configuration settings.
+        workers (int, optional): Worker processes. Defaults to ``batch_workers``
+            from the config, or the CPU count, capped at the number of files.
+
+    Returns:
+        dict: ``results``, one per file in input order, and ``summary`` totals.
+    """
+    started = time.perf_counter()
+    workers = workers or config.get("batch_workers") or os.cpu_count() or 1
+    workers = max(1, min(int(workers), len(input_files)))
+    logger.info(f"Building {len(input_files)} decks with {workers} worker processes.")
+    results = []
+    if input_files:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker, initargs=(logging_options(),)) as pool:
+            futures = [pool.submit(build_deck_file, input_file, config) for input_file in input_files]
+            for future in as_completed(futures):
+                result = future.result()
+                metrics.merge(result.pop("metrics", {}))
+                if "error" in result:
+                    logger.error(f"[batch] {result['input_file']}: failed: {result['error']}")
+                else:
+                    logger.info(
+                        f"[batch] {result['input_file']}: {result['notes']} notes ({result['reused']} reused), "
+                        f"{result['skipped']} skipped, "
+                        f"{result['rejected']} rejected lines in {result['seconds']:.1f}s -> {result['output_path']}"
+                    )
+            results = [future.result() for future in futures]
+
+    built = [result for result in results if "error" not in result]
+    summary = {
+        "files": len(results),
+        "built": len(built),
+        "failed": len(results) - len(built),
+        "rows": sum(result["rows"] for result in built),
+        "notes": sum(result["notes"] for result in built),
+        "skipped": sum(result["skipped"] for result in built),
+        "seconds": time.perf_counter() - started,
+    }
+    logger.info(
+        f"Batch finished: {summary['built']} of {summary['files']} decks built, {summary['notes']} notes "
+        f"from {summary['rows']} rows, {summary['skipped']} rows skipped, in {summary['seconds']:.1f}s."
+    )
+    return {"results": results, "summary": summary}
+
+def use_fake_api(base_url, state_dir=FAKE_API_STATE_DIR):
+    """
+    Point the image and synonym APIs at a ``fake_api_server`` instead of the real services.
+
+    Sets the endpoint overrides and placeholder API keys in the environment,
+    so batch workers inherit them. Everything a run persists - the image,
+    synonym and hash caches, rate-limit state, synonyms.json, media, decks
+    and their manifests - lives in the working directory, so the process
+    moves into ``state_dir`` and fake results never reach real builds.
+    synonyms.json is copied there on first use. Input files and logs stay
+    where they are.
+    """
+    global OUTPUT_DIR, _fake_api_state
+    base_url = base_url.rstrip("/")
+    os.environ["PIXABAY_API_URL"] = f"{base_url}/api/"
+    os.environ["PEXELS_API_URL"] = f"{base_url}/v1/search"
+    os.environ["DATAMUSE_API_URL"] = f"{base_url}/words"
+    os.environ["PIXABAY_API_KEY"] = "fake"
+    os.environ["PEXELS_API_KEY"] = "fake"
+
+    state_dir = os.path.abspath(state_dir)
+    os.makedirs(state_dir, exist_ok=True)
+    synonyms_copy = os.path.join(state_dir, SYNONYM_DICT_PATH)
+    if os.path.exists(SYNONYM_DICT_PATH) and not os.path.exists(synonyms_copy):
+        shutil.copyfile(SYNONYM_DICT_PATH, synonyms_copy)
+    os.chdir(state_dir)
+    OUTPUT_DIR = os.path.join(state_dir, "ANKI")
+    _fake_api_state = state_dir
+    logger.warning(f"Using the fake APIs at {base_url}. Caches, synonyms, media and decks are kept in {state_dir}.")
+
+def isolate_fake_api_config(config):
+    """With the fake APIs in use, point ``media_dir`` and ``metrics_dir`` into their state directory."""
+    if _fake_api_state is None:
+        return config
+    return dict(
+        config,
+        media_dir=os.path.join(_fake_api_state, "media"),
+        metrics_dir=os.path.join(_fake_api_state, "metrics"),
+    )
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Create Anki decks with images from vocabulary files.")
+    parser.add_argument(
+        "--batch", nargs="*", metavar="PATTERN",
+        help="Build every matching file into its own deck without prompts. "
+             "With no patterns, every file in input_files/ is built.",
+    )
+    parser.add_argument("--workers", type=int, help="Worker processes for --batch.")
+    parser.add_argument("--fake-api", metavar="URL", help="Send API requests to a fake_api_server.py at URL.")
+    parser.add_argument(
+        "--fake-api-state", default=FAKE_API_STATE_DIR, metavar="DIR",
+        help="Where --fake-api runs keep their caches, media and decks.",
+    )
+    parser.add_argument(
+        "--log-level", default=DEFAULT_LEVEL, type=str.upper,
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], help="Level of the log file and console.",
+    )
+    parser.add_argument(
+        "--log-module", action="append", default=[], metavar="NAME=LEVEL",
+        help="Level of one module's logger, e.g. pixabay_api=DEBUG. Can be repeated.",
+    )
+    parser.add_argument(
+        "--log-repeat-interval", type=float, default=DEFAULT_REPEAT_INTERVAL, metavar="SECONDS",
+        help="Show a repeated warning on the console only once per this many seconds; 0 shows every one.",
+    )
+    args = parser.parse_args(argv)
+    try:
+        args.log_module = parse_module_levels(args.log_module)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+def batch_main(patterns, workers=None):
+    """Headless entry point for ``--batch``. Returns the process exit code."""
+    ensure_directories()
+    config = isolate_fake_api_config(load_config(CONFIG_FILE_PATH))
+    if not (os.getenv("PIXABAY_API_KEY") or config.get("pixabay_api_key")):
+        logger.error("Batch mode needs a Pixabay API key in config.json or PIXABAY_API_KEY.")
+        return 1
+    input_files = resolve_batch_files(patterns)
+    if not input_files:
+        logger.error("No input files matched.")
+        return 1
+    summary = run_batch(input_files, config, workers)["summary"]
+    metrics.write(config.get("metrics_dir", METRICS_DIR))
+    return 1 if summary["failed"] else 0
+
 async def main():
     """Main script function."""
     try:
         logger.info("Starting Anki deck creation process.")
         ensure_directories()
 
-        config = load_config(CONFIG_FILE_PATH)
+        config = isolate_fake_api_config(load_config(CONFIG_FILE_PATH))
         if not isinstance(config, dict):
             logger.error(f"Invalid config type: Expected dict, got {type(config).__name__}. Exiting.")
             exit(1)
@@ -142,69 +668,24 @@ async def main():
             exit(1)
 
         deck_name = get_deck_name()
-
-        logger.info("Creating Anki deck...")
-        my_deck = create_deck(deck_name)
-
-        logger.info("Parsing input file...")
-        rows = parse_input_file(input_file)
-        if not rows:
-            logger.error("No valid rows found in the input file. Exiting.")
+        try:
+            await build_deck(input_file, deck_name, config)
+        except ValueError as e:
+            logger.error(f"{e} Exiting.")
             exit(1)
-
-        synonym_dict = load_synonym_dict(SYNONYM_DICT_PATH)
-        skipped_rows = []
-        for idx, row in enumerate(tqdm(rows, desc="Processing rows")):
-            try:
-                if not isinstance(row, dict):
-                    logger.error(f"Invalid row format at index {idx + 1}: {row}")
-                    skipped_rows.append(row)
-                    continue
-
-                front_text = row.get("WORD") or row.get("Front")
-                if not front_text:
-                    skipped_rows.append(row)
-                    continue
-
-                front_text = front_text.strip()
-                raw_query = row.get("MEANING", "").strip()
-                query = re.sub(r"[^\w\s]", " ", raw_query).strip()
-                query = re.sub(r"\s+", " ", query)  # Normalize spaces
-                synonyms = get_synonyms(query)
-                expanded_queries = [query] + synonyms
-
-                image_url, image_credit = None, None
-                for expanded_query in expanded_queries:
-                    logger.debug(f"Config before calling fetch_pixabay_image: {config}")
-                    image_url, image_credit = await fetch_pixabay_image(expanded_query, synonym_dict=synonym_dict, config=config)
-                    if image_url:
-                        break
-
-                if not image_url:
-                    logging.warning("No suitable image found for any query.")
-
-                back_parts = [f"<b>{k}:</b> {v.strip()}" for k, v in row.items() if k.lower() not in ["word", "front"] and v]
-                if image_credit:
-                    back_parts.append(f"<b>Image Credit:</b> {image_credit}")
-
-                back_text = "<br>".join(back_parts)
-                add_note_to_deck(my_deck, front_text, back_text, image_url)
-
-            except Exception as e:
-                logger.error(f"Error processing row {idx + 1}: {e}")
-                skipped_rows.append(row)
-
-        output_path = os.path.join(OUTPUT_DIR, f"{deck_name}.apkg")
-        logger.info("Exporting Anki deck...")
-        export_deck(my_deck, output_path)
-
-        logger.info(f"Anki deck created successfully! Saved to {output_path}")
-        if skipped_rows:
-            logger.warning(f"Skipped {len(skipped_rows)} rows. Check logs for details.")
+        metrics.write(config.get("metrics_dir", METRICS_DIR))
 
     except Exception as e:
         logger.critical(f"Unexpected error: {e}", exc_info=True)
         exit(1)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    args = parse_args()
+    configure_logging(args.log_level, args.log_module, args.log_repeat_interval)
+    if args.batch:
+        args.batch = [os.path.abspath(pattern) for pattern in args.batch]
+    if args.fake_api:
+        use_fake_api(args.fake_api, args.fake_api_state)
+    if args.batch is not None:
+        exit(batch_main(args.batch, args.workers))
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+# manifest.py
+# Per-deck build manifest, so rebuilds only look up images for rows that changed.
+import hashlib
+import json
+import logging
+import os
+from collections import Counter
+
+import genanki
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+# Settings that change which image or text a row gets; changing any of them rebuilds every row
+CONFIG_KEYS = (
+    "use_synonyms", "apply_nlp", "strict_filters", "tags", "metadata_filter", "rank_by_metadata", "image_width",
+    "dedupe_similar_images", "similar_image_distance",
+)
+# Settings that only change how notes are packaged; changing any of them re-exports without new lookups
+EXPORT_KEYS = ("embed_media", "image_format", "image_quality")
+
+
+def manifest_path_for(output_path):
+    """Return the manifest path stored next to an ``.apkg``, e.g. ``ANKI/Verbs.manifest.json``."""
+    return os.path.splitext(output_path)[0] + ".manifest.json"
+
+
+def config_fingerprint(config, keys=CONFIG_KEYS):
+    """Hash the settings in ``keys``, so rows built under other settings are not reused."""
+    relevant = {key: config.get(key) for key in keys}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def row_hash(row, fingerprint):
+    """
+    Hash a row's content together with the config fingerprint.
+
+    Args:
+        row (dict): Parsed input row.
+        fingerprint (str): Result of ``config_fingerprint``.
+
+    Returns:
+        str: Hex digest identifying this row under these settings.
+    """
+    payload = json.dumps([fingerprint, row], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RowKeys:
+    """
+    Gives each row of a pass over the input its manifest key.
+
+    The key is the row's hash; repeats of an identical row get the hash with
+    their occurrence number, e.g. ``"<hash>:1"``, so every row keeps an entry
+    and a GUID of its own across rebuilds.
+    """
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self._seen = Counter()
+
+    def __call__(self, row):
+        key = row_hash(row, self.fingerprint)
+        occurrence = self._seen[key]
+        self._seen[key] += 1
+        return f"{key}:{occurrence}" if occurrence else key
+
+
+class BuildManifest:
+    """
+    Maps row hashes to the note built for them: its GUID and fields.
+
+    A rebuild reuses the entry of every row whose hash is unchanged, with no
+    API calls, and keeps the note's GUID so Anki updates notes in place
+    rather than importing duplicates. ``export`` is the fingerprint of the
+    ``EXPORT_KEYS`` settings the ``.apkg`` was written with.
+    """
+
+    def __init__(self, path, entries=None, export=None):
+        self.path = path
+        self.entries = entries or {}
+        self.export = export
+        self._guids = {entry["guid"] for entry in self.entries.values()}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a manifest, or start an empty one if it is missing, unreadable or from another version.
+        """
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable build manifest {path}: {e}")
+            return cls(path)
+        if not isinstance(data, dict) or data.get("version") != MANIFEST_VERSION:
+            logger.info(f"Build manifest {path} is from another version. Rebuilding every row.")
+            return cls(path)
+        return cls(path, data.get("rows", {}), data.get("export"))
+
+    def get(self, key):
+        """Return the entry for a row hash, a dict with ``guid`` and ``fields``, or None."""
+        return self.entries.get(key)
+
+    def record(self, key, guid, fields):
+        """Store the note built for a row hash."""
+        self.entries[key] = {"guid": guid, "fields": list(fields)}
+        self._guids.add(guid)
+
+    def new_guid(self, deck_id, front_text, key):
+        """
+        Pick a GUID for a row without an entry.
+
+        Derived from the deck and the card front, so editing a row's other
+        columns keeps its note. A front already used in this manifest falls
+        back to the row hash.
+        """
+        guid = genanki.guid_for(deck_id, front_text)
+        if guid in self._guids:
+            guid = genanki.guid_for(deck_id, front_text, key)
+        return guid
+
+    def has_guid(self, guid):
+        return guid in self._guids
+
+    def save(self):
+        """Write the manifest atomically, so an interrupted build leaves the previous one intact."""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "export": self.export, "rows": self.entries}, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,251 @@
+# media_store.py
+# Content-addressed store of downloaded note images, shared by every deck and run.
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+
+import http_client
+from rate_limiter import RetryBudget
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DIR = "media"
+INDEX_FILE = "index.sqlite3"
+DEFAULT_DOWNLOAD_CONCURRENCY = 8  # Downloads in flight at once
+BUSY_TIMEOUT = 30  # Seconds to wait for another process holding the write lock
+CONTENT_TYPE_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+# Content types servers send when they do not know; such bodies are accepted if they start like an image
+UNTYPED_CONTENT_TYPES = {"", "application/octet-stream", "binary/octet-stream"}
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media_urls (
+    url TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    stored_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS media_transcodes (
+    source TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (source, settings)
+);
+"""
+
+
+def media_extension(url, content_type=None):
+    """Pick a file extension from the content type, falling back to the URL and then to ``.jpg``."""
+    extension = CONTENT_TYPE_EXTENSIONS.get(content_type or "")
+    if extension is None:
+        extension = os.path.splitext(urlparse(url).path)[1].lower() or mimetypes.guess_extension(content_type or "")
+    return extension or ".jpg"
+
+
+def is_image_response(data, content_type):
+    """
+    Tell whether a downloaded body is an image worth storing.
+
+    Error pages and captive-portal responses often come with a 2xx status,
+    so the body must be non-empty and typed ``image/*``, or be untyped and
+    start with a JPEG, PNG, GIF or WebP signature.
+    """
+    if not data:
+        return False
+    content_type = (content_type or "").lower()
+    if content_type.startswith("image/"):
+        return True
+    if content_type not in UNTYPED_CONTENT_TYPES:
+        return False
+    return data.startswith(IMAGE_SIGNATURES) or (data[:4] == b"RIFF" and data[8:12] == b"WEBP")
+
+
+class MediaStore:
+    """
+    Directory of media files named by the SHA-256 of their bytes.
+
+    Identical images are stored once, however many URLs, decks or runs use
+    them, and the file name doubles as the Anki media name, which is unique
+    by construction. A WAL-mode SQLite index remembers which file each URL
+    resolved to, so a URL is only downloaded the first time any deck needs
+    it. Files are written to a temporary name and renamed into place, so
+    concurrent batch workers never see a partial file.
+    """
+
+    def __init__(self, root=MEDIA_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(root, INDEX_FILE), timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def path_for(self, filename):
+        """Return where a stored file lives, fanned out by the first two hex digits."""
+        return os.path.join(self.root, filename[:2], filename)
+
+    def lookup(self, urls):
+        """
+        Find the stored files of URLs downloaded before.
+
+        Returns:
+            dict: Maps each known URL whose file still exists to its path.
+        """
+        urls = list(dict.fromkeys(urls))
+        found = {}
+        with self._lock:
+            for start in range(0, len(urls), 500):
+                chunk = urls[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT url, filename FROM media_urls WHERE url IN ({', '.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update((url, self.path_for(filename)) for url, filename in rows)
+        return {url: path for url, path in found.items() if os.path.exists(path)}
+
+    def store_bytes(self, data, extension):
+        """
+        Store bytes under their SHA-256.
+
+        Returns:
+            str: Path of the stored file. Bytes already in the store are not written again.
+        """
+        path = self.path_for(hashlib.sha256(data).hexdigest() + extension)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        return path
+
+    def put(self, url, data, content_type=None):
+        """
+        Store downloaded bytes and remember the URL they came from.
+
+        Returns:
+            str: Path of the stored file.
+        """
+        path = self.store_bytes(data, media_extension(url, content_type))
+        filename = os.path.basename(path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO media_urls (url, filename, stored_at) VALUES (?, ?, ?)",
+                (url, filename, time.time()),
+            )
+        return path
+
+    def lookup_transcodes(self, sources, settings):
+        """
+        Find earlier transcodes of stored files made with the same settings.
+
+        Args:
+            sources (iterable): Paths of stored source files.
+            settings (str): Transcode settings key.
+
+        Returns:
+            dict: Maps each source path with a live transcode to the transcode's path.
+        """
+        by_name = {os.path.basename(source): source for source in sources}
+        names = list(by_name)
+        found = {}
+        with self._lock:
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT source, filename FROM media_transcodes WHERE settings = ? "
+                    f"AND source IN ({', '.join('?' * len(chunk))})",
+                    (settings, *chunk),
+                ).fetchall()
+                found.update((by_name[source], self.path_for(filename)) for source, filename in rows)
+        return {source: path for source, path in found.items() if os.path.exists(path)}
+
+    def put_transcode(self, source, settings, data, extension):
+        """
+        Store a transcode of a stored file and remember it for these settings.
+
+        Returns:
+            str: Path of the stored transcode.
+        """
+        path = self.store_bytes(data, extension)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO media_transcodes (source, settings, filename) VALUES (?, ?, ?)",
+                (os.path.basename(source), settings, os.path.basename(path)),
+            )
+        return path
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_stores = {}
+
+
+def get_media_store(config=None):
+    """Return the process-wide store for the configured ``media_dir``, opening it on first use."""
+    root = (config or {}).get("media_dir", MEDIA_DIR)
+    store = _stores.get(root)
+    if store is None:
+        store = _stores[root] = MediaStore(root)
+    return store
+
+
+async def download_media(urls, store=None, concurrency=DEFAULT_DOWNLOAD_CONCURRENCY):
+    """
+    Make sure every URL's file is in the store, downloading the missing ones concurrently.
+
+    Downloads share the pooled HTTP session, at most ``concurrency`` at a
+    time. A URL that cannot be downloaded, or whose response is not an image,
+    is logged and left out of the result.
+
+    Args:
+        urls (iterable): Media URLs.
+        store (MediaStore, optional): Defaults to the shared store.
+        concurrency (int): Most downloads in flight at once.
+
+    Returns:
+        dict: Maps each available URL to its stored file path.
+    """
+    if store is None:
+        store = get_media_store()
+    urls = [url for url in dict.fromkeys(urls) if url]
+    paths = await asyncio.to_thread(store.lookup, urls)
+    missing = [url for url in urls if url not in paths]
+    if not missing:
+        return paths
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    retry_budget = RetryBudget()
+
+    async def fetch(url):
+        async with semaphore:
+            try:
+                data, content_type = await http_client.get_bytes(url, retry_budget)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Could not download media %s: %r", url, e)
+                return url, None
+        if not is_image_response(data, content_type):
+            logger.warning("Not storing media %s: got %d bytes of %s, not an image.", url, len(data), content_type)
+            return url, None
+        return url, await asyncio.to_thread(store.put, url, data, content_type)
+
+    downloaded = {url: path for url, path in await asyncio.gather(*(fetch(url) for url in missing)) if path}
+    logger.info("Downloaded %d of %d new media files; %d were already stored.", len(downloaded), len(missing), len(paths))
+    paths.update(downloaded)
+    return paths
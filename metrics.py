@@ -0,0 +1,280 @@
+# metrics.py
+# Run metrics: counters, latency histograms and stage timings, written as JSON and Prometheus text.
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = "metrics"
+PROMETHEUS_FILE = "txt_to_anki.prom"  # Fixed name, for node_exporter's textfile collector
+NAMESPACE = "txt_to_anki"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds, for API calls
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)  # Seconds, for whole stages
+
+METRIC_HELP = {
+    "rows_total": "Input rows parsed.",
+    "notes_total": "Notes written to decks.",
+    "rows_skipped_total": "Rows that produced no note.",
+    "rows_reused_total": "Notes reused from the build manifest without lookups.",
+    "cache_lookups_total": "Image cache lookups by cache, tier and result.",
+    "api_requests_total": "API requests sent, including retries.",
+    "api_responses_total": "API responses by provider and HTTP status.",
+    "api_rate_limited_total": "429 responses received.",
+    "api_retries_total": "Requests retried after a timeout, connection error or 5xx.",
+    "api_errors_total": "Requests that failed after all retries.",
+    "fallbacks_total": "Lookups that fell back from one image provider to another.",
+    "api_latency_seconds": "Latency of successful API requests.",
+    "stage_seconds": "Wall time of each build stage.",
+}
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and histograms for one run.
+
+    Metrics are identified by a name and keyword labels, e.g.
+    ``inc("api_requests_total", provider="pixabay")``. Updates take a lock,
+    so threads and the event loop can record concurrently. Batch workers
+    send a ``snapshot`` back to the parent, which ``merge``s it, so the
+    written files cover the whole run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> {"buckets", "counts", "sum", "count"}
+        self.started_at = time.time()
+
+    def inc(self, name, amount=1, **labels):
+        """Add ``amount`` to a counter."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """Record one observation in a histogram."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "buckets": list(buckets), "counts": [0] * len(buckets), "sum": 0.0, "count": 0,
+                }
+            for i, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def stage(self, name):
+        """Time a build stage, e.g. ``with metrics.stage("parse"):``. Works across awaits."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, buckets=STAGE_BUCKETS, stage=name)
+
+    def counter(self, name, **labels):
+        """Return a counter's value, 0 if it was never incremented."""
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+    def snapshot(self):
+        """
+        Return every metric as plain data, e.g. to send from a worker process.
+
+        Returns:
+            dict: ``counters`` and ``histograms``, lists of dicts with ``name`` and ``labels``.
+        """
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                "histograms": [
+                    {"name": name, "labels": dict(labels), "buckets": list(histogram["buckets"]),
+                     "counts": list(histogram["counts"]), "sum": histogram["sum"], "count": histogram["count"]}
+                    for (name, labels), histogram in sorted(self._histograms.items())
+                ],
+            }
+
+    def merge(self, snapshot):
+        """Add a ``snapshot`` from another registry, e.g. a batch worker's, to this one."""
+        with self._lock:
+            for counter in snapshot.get("counters", []):
+                key = (counter["name"], _label_key(counter["labels"]))
+                self._counters[key] = self._counters.get(key, 0) + counter["value"]
+            for other in snapshot.get("histograms", []):
+                key = (other["name"], _label_key(other["labels"]))
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    self._histograms[key] = {
+                        "buckets": list(other["buckets"]), "counts": list(other["counts"]),
+                        "sum": other["sum"], "count": other["count"],
+                    }
+                    continue
+                histogram["counts"] = [a + b for a, b in zip(histogram["counts"], other["counts"])]
+                histogram["sum"] += other["sum"]
+                histogram["count"] += other["count"]
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started_at = time.time()
+
+    def summary(self):
+        """
+        Summarize the run for people: stage times, cache hit ratios, API calls and latencies.
+
+        Returns:
+            dict: JSON-serializable summary, with the raw ``snapshot`` under ``metrics``.
+        """
+        snapshot = self.snapshot()
+        counters = snapshot["counters"]
+
+        def total(name, **match):
+            return sum(
+                counter["value"] for counter in counters
+                if counter["name"] == name and all(counter["labels"].get(k) == v for k, v in match.items())
+            )
+
+        caches = {}
+        for counter in counters:
+            if counter["name"] == "cache_lookups_total":
+                cache = caches.setdefault(counter["labels"]["cache"], {"hits": {}, "misses": 0})
+                if counter["labels"]["result"] == "hit":
+                    cache["hits"][counter["labels"]["tier"]] = cache["hits"].get(counter["labels"]["tier"], 0) + counter["value"]
+                else:
+                    cache["misses"] += counter["value"]
+        for cache in caches.values():
+            lookups = sum(cache["hits"].values()) + cache["misses"]
+            cache["hit_ratio"] = sum(cache["hits"].values()) / lookups if lookups else 0.0
+
+        histograms = snapshot["histograms"]
+        providers = sorted({counter["labels"]["provider"] for counter in counters if "provider" in counter["labels"]})
+        return {
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+            "seconds": time.time() - self.started_at,
+            "rows": total("rows_total"),
+            "notes": total("notes_total"),
+            "skipped": total("rows_skipped_total"),
+            "reused": total("rows_reused_total"),
+            "stages": {
+                h["labels"]["stage"]: {"seconds": h["sum"], "runs": h["count"]}
+                for h in histograms if h["name"] == "stage_seconds"
+            },
+            "caches": caches,
+            "apis": {
+                provider: {
+                    "requests": total("api_requests_total", provider=provider),
+                    "rate_limited": total("api_rate_limited_total", provider=provider),
+                    "retries": total("api_retries_total", provider=provider),
+                    "errors": total("api_errors_total", provider=provider),
+                    "latency": next(
+                        (_latency_summary(h) for h in histograms
+                         if h["name"] == "api_latency_seconds" and h["labels"].get("provider") == provider),
+                        None,
+                    ),
+                }
+                for provider in providers
+            },
+            "fallbacks": total("fallbacks_total"),
+            "metrics": snapshot,
+        }
+
+    def to_prometheus(self):
+        """Render every metric in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {NAMESPACE}_{name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {NAMESPACE}_{name} {kind}")
+
+        for counter in snapshot["counters"]:
+            header(counter["name"], "counter")
+            labels = _label_key(counter["labels"])
+            lines.append(f"{NAMESPACE}_{counter['name']}{_format_labels(labels)} {_format_number(counter['value'])}")
+        for histogram in snapshot["histograms"]:
+            name = histogram["name"]
+            header(name, "histogram")
+            labels = _label_key(histogram["labels"])
+            cumulative = 0
+            for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                cumulative += count
+                lines.append(f"{NAMESPACE}_{name}_bucket{_format_labels(labels, [('le', _format_number(float(bound)))])} {cumulative}")
+            lines.append(f"{NAMESPACE}_{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{NAMESPACE}_{name}_sum{_format_labels(labels)} {_format_number(float(histogram['sum']))}")
+            lines.append(f"{NAMESPACE}_{name}_count{_format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory=METRICS_DIR):
+        """
+        Write the run's JSON summary and the Prometheus file.
+
+        The summary gets a timestamped name so runs can be compared; the
+        Prometheus file is replaced atomically, ready for a textfile collector.
+
+        Returns:
+            tuple: Paths of the JSON summary and the Prometheus file.
+        """
+        os.makedirs(directory, exist_ok=True)
+        json_path = os.path.join(directory, f"run_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+        prometheus_path = os.path.join(directory, PROMETHEUS_FILE)
+        with open(f"{prometheus_path}.tmp", "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(f"{prometheus_path}.tmp", prometheus_path)
+        logger.info(f"Run metrics saved to {json_path} and {prometheus_path}")
+        return json_path, prometheus_path
+
+
+def _latency_summary(histogram):
+    """Count, mean and bucket-estimated percentiles of a latency histogram."""
+    count = histogram["count"]
+    if not count:
+        return None
+
+    def percentile(p):
+        target = count * p / 100
+        cumulative = 0
+        for bound, bucket_count in zip(histogram["buckets"], histogram["counts"]):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return bound
+        return None  # Above the largest bucket
+
+    return {"count": count, "mean": histogram["sum"] / count, "p50": percentile(50), "p95": percentile(95), "p99": percentile(99)}
+
+
+metrics = MetricsRegistry()
@@ -1,6 +1,15 @@
-import requests
-import time
+import asyncio
 import logging
+import os
+import threading
+
+import aiohttp
+
+import http_client
+from image_cache import ImageCache, DEFAULT_MAX_ENTRIES
+from image_dedupe import similar_images
+from rate_limiter import get_rate_limiter
+from singleflight import SingleFlight, canonical_key
 
 # Initialize logger
 logger = logging.getLogger(__name__)
@@ -8,76 +17,159 @@ logger = logging.getLogger(__name__)
 # Set for tracking used image URLs
 used_images = set()
 
-# Define cache to store results and avoid redundant API calls
-cache = {}
+def release_image(image_url):
+    """Give back an image reserved by a lookup whose result will not be used."""
+    used_images.discard(image_url)
+    similar_images.release(image_url)
+
+# Persistent cache of resolved lookups, opened lazily by get_cache()
+CACHE_FILE = "pexels_cache.sqlite3"
+CACHE_EXPIRATION = 24 * 60 * 60  # 24 hours in seconds
+cache = None
+_cache_lock = threading.Lock()
+
+# Coalesces identical Pexels requests that run at the same time
+inflight_requests = SingleFlight("pexels")
 
-# Load Pexels API Key from the config file
+# Load Pexels API Key from the environment or the config file
 def load_api_key():
     import json
-    with open("config.json", "r") as file:
-        config = json.load(file)
+    if os.getenv("PEXELS_API_KEY"):
+        return os.getenv("PEXELS_API_KEY")
+    try:
+        with open("config.json", "r") as file:
+            config = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        logger.warning(f"Could not read the Pexels API key from config.json: {e}")
+        return ""
     return config.get("pexels_api_key", "")
 
-PEXELS_API_KEY = load_api_key()
+def get_api_key():
+    """
+    Return the Pexels API key, reading config.json on first use.
+    """
+    global PEXELS_API_KEY
+    if PEXELS_API_KEY is None:
+        PEXELS_API_KEY = load_api_key()
+    return PEXELS_API_KEY
+
+PEXELS_API_KEY = None  # Loaded by get_api_key()
 PEXELS_API_URL = "https://api.pexels.com/v1/search"
 
-def enforce_cache_size_limit(cache2, max_size=1000):
+def get_api_url():
+    """Return the search endpoint, which ``PEXELS_API_URL`` in the environment overrides, e.g. for a fake server."""
+    return os.getenv("PEXELS_API_URL") or PEXELS_API_URL
+
+def get_cache(config=None):
+    """
+    Return the process-wide Pexels image cache, opening it on first use.
+
+    Args:
+        config (dict, optional): May set ``cache_max_entries``.
+
+    Returns:
+        ImageCache: The shared cache.
     """
-    Ensure the cache does not exceed the specified size.
+    global cache
+    with _cache_lock:
+        if cache is None:
+            max_entries = (config or {}).get("cache_max_entries", DEFAULT_MAX_ENTRIES)
+            opened = ImageCache(CACHE_FILE, ttl=CACHE_EXPIRATION, max_entries=max_entries, name="pexels")
+            opened.maintain()
+            cache = opened
+    return cache
+
+async def aget_cache(config=None):
+    """Like ``get_cache``, but opens and maintains the cache in a worker thread, off the event loop."""
+    if cache is not None:
+        return cache
+    return await asyncio.to_thread(get_cache, config)
+
+async def request_pexels_photos_async(params):
+    """
+    Query Pexels once and return the decoded response.
+
+    Uses the shared aiohttp session and the Pexels rate limiter, so timeouts,
+    retries and cancellation behave as on the Pixabay path.
     """
-    while len(cache2) > max_size:
-        oldest_key = min(cache2, key=lambda k: cache2[k]["timestamp"])
-        del cache2[oldest_key]
+    headers = {"Authorization": get_api_key()}
+    return await http_client.get_json(get_api_url(), get_rate_limiter("pexels"), params=params, headers=headers)
 
-def fetch_pexels_images(query, cache_key, cache2):
+async def fetch_pexels_images_async(query, cache_key, cache2=None):
     """
     Fetch images from Pexels API based on the query.
+
+    Args:
+        query (str): The search term for the image.
+        cache_key (str): Key for caching the result.
+        cache2 (ImageCache, optional): Cache to use instead of the shared Pexels cache.
+
+    Returns:
+        tuple: Image URL and image credit string if found, otherwise (None, None).
     """
-    if cache_key in cache2:
-        cached_entry = cache2[cache_key]
-        if cached_entry["image_url"] not in used_images:
+    if cache2 is None:
+        cache2 = await aget_cache()
+    reserved = []  # Images this lookup took, to give back if it is cancelled
+
+    try:
+        cached_entry = await cache2.aget(cache_key)
+        if cached_entry and cached_entry["image_url"] not in used_images:
             used_images.add(cached_entry["image_url"])
-            return cached_entry["image_url"], cached_entry["image_credit"]
+            reserved.append(cached_entry["image_url"])
+            if await similar_images.claim(cached_entry["image_url"]):
+                return cached_entry["image_url"], cached_entry["image_credit"]
 
-    headers = {"Authorization": PEXELS_API_KEY}
-    params = {"query": query, "per_page": 15}
+        params = {"query": query, "per_page": 15}
 
-    try:
-        response = requests.get(PEXELS_API_URL, headers=headers, params=params, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-    except requests.RequestException as e:
-        logger.error(f"Pexels API request failed: {e}")
-        return None, None
-
-    hits = data.get("photos", [])
-    if not hits:
-        logger.warning(f"No results for query '{query}' on Pexels.")
-        return None, None
-
-    filtered_images = [
-        img for img in hits
-        if img.get("src", {}).get("medium") not in used_images
-    ]
-
-    if not filtered_images:
-        logger.warning(f"No suitable image found for query '{query}' on Pexels.")
-        return None, None
-
-    # Select the first valid image
-    selected_image = filtered_images[0]
-    image_url = selected_image.get("src", {}).get("medium")
-    photographer = selected_image.get("photographer")
-    photo_url = selected_image.get("url")
-    image_credit = f"Photo by {photographer} on <a href='{photo_url}'>Pexels</a>"
-
-    used_images.add(image_url)
-    cache2[cache_key] = {
-        "image_url": image_url,
-        "image_credit": image_credit,
-        "timestamp": time.time(),
-    }
-    enforce_cache_size_limit(cache2)
-
-    logger.debug(f"Fetched and cached result for '{query}' from Pexels.")
-    return image_url, image_credit
+        # Identical queries already in flight share one API call; each caller
+        # still picks its own unique image from the shared photos.
+        try:
+            data = await inflight_requests.do(canonical_key("pexels", params), request_pexels_photos_async, params)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Pexels API request failed: {e}")
+            return None, None
+
+        hits = data.get("photos", [])
+        if not hits:
+            logger.warning("No results for query '%s' on Pexels.", query)
+            return None, None
+
+        # Select the first valid image that is not a near-duplicate of one already in the deck
+        selected_image = None
+        for img in hits:
+            image_url = img.get("src", {}).get("medium")
+            if image_url in used_images:
+                continue
+            used_images.add(image_url)
+            reserved.append(image_url)
+            if await similar_images.claim(image_url, img.get("src", {}).get("tiny")):
+                selected_image = img
+                break
+
+        if selected_image is None:
+            logger.warning("No suitable image found for query '%s' on Pexels.", query)
+            return None, None
+
+        photographer = selected_image.get("photographer")
+        photo_url = selected_image.get("url")
+        image_credit = f"Photo by {photographer} on <a href='{photo_url}'>Pexels</a>"
+
+        await cache2.aset_many({cache_key: {"image_url": image_url, "image_credit": image_credit}})
+
+        logger.debug("Fetched and cached result for '%s' from Pexels.", query)
+        return image_url, image_credit
+    except asyncio.CancelledError:
+        # E.g. the losing side of a hedged lookup
+        for image_url in reserved:
+            release_image(image_url)
+        raise
+
+def fetch_pexels_images(query, cache_key, cache2=None):
+    """
+    Blocking wrapper around ``fetch_pexels_images_async`` for code without an event loop.
+    """
+    async def run():
+        async with http_client.session_scope():
+            return await fetch_pexels_images_async(query, cache_key, cache2)
+
+    return asyncio.run(run())
@@ -1,25 +1,38 @@
 import requests
-import shelve
 import time
 import os
 import json
 import logging
+import threading
 from hashlib import sha256
-from utils import apply_nlp_refinement, expand_with_synonyms
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from query_refiner import refine_queries
+from utils import expand_with_synonyms
 import aiohttp
 import asyncio
+import http_client
+from image_cache import ImageCache, DEFAULT_MAX_ENTRIES
+from image_dedupe import similar_images
+from metrics import metrics
+from rate_limiter import get_rate_limiter
+from singleflight import SingleFlight, canonical_key
 
 used_images = set()
 
 logger = logging.getLogger(__name__)
 logger.debug("Execution started in pixabay_api.py")
-logger.debug(f"Requests module loaded: {requests}")
+logger.debug("Requests module loaded: %s", requests)
 
 CONFIG_FILE = "config.json"
-CACHE_FILE = "pixabay_cache.db"
+CACHE_FILE = "pixabay_cache.sqlite3"
+LEGACY_CACHE_FILE = "pixabay_cache.db"  # shelve cache of earlier versions, imported once
 CACHE_EXPIRATION = 24 * 60 * 60  # 24 hours in seconds
+cache = None  # Opened lazily by get_cache()
+_cache_lock = threading.Lock()
+inflight_requests = SingleFlight("pixabay")
+response_memo = {}  # Responses already fetched this run, by canonical request key; cleared per run
+PIXABAY_API_URL = "https://pixabay.com/api/"
+WEBFORMAT_SIZES = (180, 340, 640, 960)  # Longest sides of the webformatURL variants Pixabay serves
+LARGE_IMAGE_SIZE = 1280  # Longest side of largeImageURL
 logger = logging.getLogger(__name__)
 
 
@@ -33,64 +46,160 @@ def add_image_to_note(image_url, note):
         # Handle the case where the image is a duplicate
         print(f"Duplicate image found: {image_url}")
 
+def release_image(image_url):
+    """Give back an image reserved by a lookup whose result will not be used."""
+    used_images.discard(image_url)
+    similar_images.release(image_url)
+
 class PixabayAPIError(Exception):
     pass
 
-async def perform_pixabay_request_async(url, params, expanded_query, cache_key, cache, config):
-    async with aiohttp.ClientSession() as session:
-        try:
-            if not isinstance(params, dict):
-                logger.error(f"Invalid params type: Expected dict, got {type(params).__name__}. Content: {params}")
-                return None, None
-
-            async with session.get(url, params=params, timeout=5) as response:
-                if response.status == 429:
-                    retry_after = int(response.headers.get("Retry-After", 60))
-                    logger.warning(f"Rate limit exceeded. Retrying after {retry_after} seconds...")
-                    await asyncio.sleep(retry_after)
-                    return None, None
-
-                response.raise_for_status()
-                data = await response.json()
-                if not isinstance(data, dict):
-                    logger.error(f"Unexpected response type: {type(data).__name__}. Content: {data}")
-                    return None, None
-                logger.debug(f"Query '{params['q']}' returned {len(data.get('hits', []))} results.")
-
-                if len(data.get("hits", [])) < 3 and config["strict_filters"]:
-                    logger.warning("Few results found. Relaxing strict filters...")
-                    params.pop("editors_choice", None)
-                    async with session.get(url, params=params, timeout=5) as response:
-                        response.raise_for_status()
-                        data = await response.json()
-
-                if data.get("hits"):
-                    return process_pixabay_hits(data, expanded_query, cache_key, cache, config)
-                else:
-                    logger.warning(f"No results for query '{expanded_query}' after trying synonyms.")
-                    return None, None
-
-        except aiohttp.ClientError as e:
-            logger.error(f"Error fetching image for query '{expanded_query}': {e}")
+async def request_pixabay_hits_async(url, params, config):
+    """
+    Query Pixabay once and return the decoded response.
+
+    Requests are paced by the shared Pixabay rate limiter and retried on
+    throttling and transient errors. Relaxes ``editors_choice`` when strict
+    filtering returns too few hits. Works on a copy of ``params`` so the
+    result depends only on the request, which lets concurrent identical
+    requests share it.
+
+    Returns:
+        dict: The response data, or None if the request failed.
+    """
+    params = dict(params)
+    limiter = get_rate_limiter("pixabay")
+    data = await http_client.get_json(url, limiter, params=params)
+    if not isinstance(data, dict):
+        logger.error(f"Unexpected response type: {type(data).__name__}. Content: {data}")
+        return None
+    logger.debug("Query '%s' returned %d results.", params["q"], len(data.get("hits", [])))
+
+    if len(data.get("hits", [])) < 3 and config["strict_filters"]:
+        logger.warning("Few results found. Relaxing strict filters...")
+        params.pop("editors_choice", None)
+        data = await http_client.get_json(url, limiter, params=params)
+    return data
+
+async def get_pixabay_response(url, params, config):
+    """
+    Return the Pixabay response for a request, calling the API at most once per run.
+
+    Responses are kept in ``response_memo`` for the rest of the run, and
+    identical requests already in flight share one API call. Each caller
+    still picks its own unique image from the shared hits.
+    """
+    request_key = canonical_key("pixabay", {**params, "strict_filters": config["strict_filters"]})
+    data = response_memo.get(request_key)
+    metrics.inc("cache_lookups_total", cache="pixabay_responses", tier="run_memo", result="miss" if data is None else "hit")
+    if data is None:
+        data = await inflight_requests.do(request_key, request_pixabay_hits_async, url, params, config)
+        if data:
+            response_memo[request_key] = data
+    return data
+
+async def perform_pixabay_request_async(url, params, expanded_query, cache_key, cache, config, reserved=None):
+    try:
+        if not isinstance(params, dict):
+            logger.error(f"Invalid params type: Expected dict, got {type(params).__name__}. Content: {params}")
+            return None, None
+
+        data = await get_pixabay_response(url, params, config)
+        if not data:
+            return None, None
+
+        if data.get("hits"):
+            while True:
+                image_url, image_credit = process_pixabay_hits(data, expanded_query, cache_key, cache, config)
+                if image_url and reserved is not None:
+                    reserved.append(image_url)
+                if not image_url or await similar_images.claim(image_url, preview_url_for(data, image_url, config)):
+                    return image_url, image_credit
+                # A near-duplicate stays in used_images, so the next pass picks the next-ranked hit
+                cache.pop(cache_key, None)
+        else:
+            logger.warning("No results for query '%s' after trying synonyms.", expanded_query)
             return None, None
 
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error fetching image for query '%s': %s", expanded_query, e)
+        return None, None
+
 def generate_cache_key(query, params):
     serialized = f"{query}-{json.dumps(params, sort_keys=True)}"
     return sha256(serialized.encode()).hexdigest()
 
-def clear_expired_cache_entries(cache):
-    keys_to_delete = [key for key, entry in cache.items() if time.time() - entry["timestamp"] >= CACHE_EXPIRATION]
-    for key in keys_to_delete:
-        del cache[key]
-    logger.debug(f"Cache cleaned. Removed {len(keys_to_delete)} expired entries.")
+def get_cache(config=None):
+    """
+    Return the process-wide Pixabay image cache, opening it on first use.
+
+    Expired and surplus entries are purged once when the cache is opened
+    rather than on every lookup.
 
-def enforce_cache_size_limit(cache, max_size=100):
-    if len(cache) > max_size:
-        sorted_cache = sorted(cache.items(), key=lambda item: item[1]["timestamp"])
-        keys_to_delete = [key for key, _ in sorted_cache[:len(cache) - max_size]]
-        for key in keys_to_delete:
-            del cache[key]
-        logger.debug(f"Cache size limit enforced. Removed {len(keys_to_delete)} oldest entries.")
+    Args:
+        config (dict, optional): May set ``cache_max_entries``.
+
+    Returns:
+        ImageCache: The shared cache.
+    """
+    global cache
+    with _cache_lock:
+        if cache is None:
+            max_entries = (config or {}).get("cache_max_entries", DEFAULT_MAX_ENTRIES)
+            opened = ImageCache(CACHE_FILE, ttl=CACHE_EXPIRATION, max_entries=max_entries, name="pixabay")
+            migrate_legacy_cache(opened)
+            opened.maintain()
+            cache = opened
+    return cache
+
+def migrate_legacy_cache(target, path=LEGACY_CACHE_FILE):
+    """
+    Import the unexpired entries of the shelve cache used by earlier versions.
+
+    The shelve files are renamed to ``*.migrated`` afterwards, so the import
+    runs once. Entries keep their age, and their keys match the current
+    ones, so a cache warmed by an earlier version stays warm.
+
+    Args:
+        target (ImageCache): Cache to import into.
+        path (str): Name the shelve was opened with; dbm backends add their own suffixes.
+
+    Returns:
+        int: Number of entries imported.
+    """
+    legacy_files = [path + suffix for suffix in ("", ".db", ".dat", ".dir", ".bak") if os.path.exists(path + suffix)]
+    if not legacy_files:
+        return 0
+    import dbm
+    import shelve
+    try:
+        with shelve.open(path, "r") as legacy:
+            entries = dict(legacy.items())
+    except (ImportError, *dbm.error) as e:
+        logger.info("Could not read the old Pixabay cache %s (%s). Starting with an empty cache.", path, e)
+        return 0
+
+    now = time.time()
+    fresh = {
+        key: {"image_url": entry["image_url"], "image_credit": entry.get("image_credit"), "created_at": entry["timestamp"]}
+        for key, entry in entries.items()
+        if isinstance(entry, dict) and entry.get("image_url") and now - entry.get("timestamp", 0) < CACHE_EXPIRATION
+    }
+    target.set_many(fresh)
+    for legacy_file in legacy_files:
+        os.replace(legacy_file, f"{legacy_file}.migrated")
+    logger.info("Imported %d of %d entries from the old Pixabay cache %s.", len(fresh), len(entries), path)
+    return len(fresh)
+
+async def aget_cache(config=None):
+    """Like ``get_cache``, but opens and maintains the cache in a worker thread, off the event loop."""
+    if cache is not None:
+        return cache
+    return await asyncio.to_thread(get_cache, config)
+
+def get_api_url():
+    """Return the search endpoint, which ``PIXABAY_API_URL`` in the environment overrides, e.g. for a fake server."""
+    return os.getenv("PIXABAY_API_URL") or PIXABAY_API_URL
 
 def load_api_key():
     if os.path.exists(CONFIG_FILE):
@@ -100,31 +209,10 @@ def load_api_key():
     logger.error("Config file not found or API key is missing.")
     return None
 
-async def fetch_pixabay_image(query, synonym_dict=None, config=None):
+def resolve_config(config):
     """
-    Fetches an image URL and credit from Pixabay, using query expansion with synonyms if provided.
-
-    Args:
-        query (str): The search term for the image.
-        synonym_dict (dict, optional): Dictionary of synonyms for query expansion.
-        config (dict, optional): Configuration for feature toggles and settings.
-
-    Returns:
-        tuple: Image URL and image credit string if found, otherwise (None, None).
+    Merge the provided configuration over the default Pixabay settings.
     """
-    api_key = os.getenv("PIXABAY_API_KEY") or load_api_key()
-    if not isinstance(query, str):
-        logger.error(f"Invalid query type: Expected string, got {type(query).__name__}")
-        return None, None
-
-    if not isinstance(config, dict):
-        logger.error(f"Invalid config type: Expected dict, got {type(config).__name__}")
-        return None, None
-
-    if not api_key:
-        logger.error("Pixabay API Key is missing.")
-        return None, None
-
     #Default configuration
     default_config = config or {
         "use_synonyms": True,
@@ -140,13 +228,22 @@ async def fetch_pixabay_image(query, synonym_dict=None, config=None):
         }
     }
     # Merge the default configuration with the provided config
-    config = {**default_config, **(config or {})}
+    return {**default_config, **(config or {})}
+
+def build_lookup_plan(query, api_key, synonym_dict, config):
+    """
+    Work out the request parameters and the lookups tried for a query.
 
-    logger.debug(f"Effective configuration: {config}")
-    import json
-    logger.debug(f"Configuration: {json.dumps(config, indent=2)}")
+    Args:
+        query (str): The search term for the image.
+        api_key (str): Pixabay API key.
+        synonym_dict (dict or SynonymIndex, optional): Synonyms for query expansion.
+        config (dict): Effective configuration, see ``resolve_config``.
 
-    url = "https://pixabay.com/api/"
+    Returns:
+        tuple: The base request params and a list of ``(expanded_query, cache_key)``
+               pairs in the order they should be tried.
+    """
     params = {
         "key": api_key,
         "q": query,
@@ -157,7 +254,6 @@ async def fetch_pixabay_image(query, synonym_dict=None, config=None):
         "per_page": 10,
         "order": "popular",
     }
-    logger.info(f"Fetching images for query: {query}")
 
     if config["strict_filters"]:
         params["editors_choice"] = "true"
@@ -168,49 +264,147 @@ async def fetch_pixabay_image(query, synonym_dict=None, config=None):
     queries_to_try = expand_with_synonyms(query, synonym_dict) if config["use_synonyms"] else [query]
 
     if config["apply_nlp"]:
-        queries_to_try = [apply_nlp_refinement(q) for q in queries_to_try]
+        refined = refine_queries(queries_to_try)
+        queries_to_try = [refined[q] for q in queries_to_try]
 
     cache_key_base = generate_cache_key(query, params)
+    if config.get("image_width"):
+        # Lookups made for another display width picked a different image size
+        cache_key_base = f"{cache_key_base}-w{config['image_width']}"
+    return params, [(expanded_query, f"{cache_key_base}-{expanded_query}") for expanded_query in queries_to_try]
+
+async def fetch_pixabay_image(query, synonym_dict=None, config=None):
+    """
+    Fetches an image URL and credit from Pixabay, using query expansion with synonyms if provided.
+
+    Args:
+        query (str): The search term for the image.
+        synonym_dict (dict or SynonymIndex, optional): Synonyms for query expansion.
+        config (dict, optional): Configuration for feature toggles and settings.
+
+    Returns:
+        tuple: Image URL and image credit string if found, otherwise (None, None).
+    """
+    api_key = os.getenv("PIXABAY_API_KEY") or load_api_key()
+    if not isinstance(query, str):
+        logger.error(f"Invalid query type: Expected string, got {type(query).__name__}")
+        return None, None
+
+    if not isinstance(config, dict):
+        logger.error(f"Invalid config type: Expected dict, got {type(config).__name__}")
+        return None, None
+
+    if not api_key:
+        logger.error("Pixabay API Key is missing.")
+        return None, None
+
+    config = resolve_config(config)
+
+    logger.debug("Effective configuration: %s", config)
+    logger.info("Fetching images for query: %s", query)
+    params, lookups = build_lookup_plan(query, api_key, synonym_dict, config)
 
-    async with aiohttp.ClientSession() as session:
-         with shelve.open(CACHE_FILE) as cache:
-            clear_expired_cache_entries(cache)
-
-            for expanded_query in queries_to_try:
-                params["q"] = expanded_query
-                cache_key = f"{cache_key_base}-{expanded_query}"
-
-                # Check cache for existing entry
-                if cache_key in cache:
-                    cached_entry = cache[cache_key]
-                    if cached_entry["image_url"] not in used_images:
-                        used_images.add(cached_entry["image_url"])
-                        return cached_entry["image_url"], cached_entry["image_credit"]
-
-                # Fetch new images
-                try:
-                    image_url, image_credit = await perform_pixabay_request_async(
-                        url, params, expanded_query, cache_key, cache, config
-                    )
-                    if image_url and image_url not in used_images:
-                        used_images.add(image_url)  # Avoid duplicates
-                        enforce_cache_size_limit(cache)  # Keep cache size within limits
-                        return image_url, image_credit
-                except Exception as e:
-                    logger.error(f"Error processing query '{expanded_query}': {e}")
+    cache = await aget_cache(config)
+    reserved = []  # Images this lookup took, to give back if it is cancelled
+
+    try:
+        for expanded_query, cache_key in lookups:
+            params["q"] = expanded_query
+
+            # Check cache for existing entry
+            cached_entry = await cache.aget(cache_key)
+            if cached_entry and cached_entry["image_url"] not in used_images:
+                used_images.add(cached_entry["image_url"])
+                reserved.append(cached_entry["image_url"])
+                if await similar_images.claim(cached_entry["image_url"]):
+                    return cached_entry["image_url"], cached_entry["image_credit"]
+
+            # Fetch new images; process_pixabay_hits reserves the chosen URL in used_images
+            fresh_entries = {}
+            try:
+                image_url, image_credit = await perform_pixabay_request_async(
+                    get_api_url(), params, expanded_query, cache_key, fresh_entries, config, reserved
+                )
+            except Exception as e:
+                logger.error("Error processing query '%s': %s", expanded_query, e)
+                continue
+
+            await cache.aset_many(fresh_entries)
+            if image_url:
+                return image_url, image_credit
+    except asyncio.CancelledError:
+        # E.g. the losing side of a hedged lookup
+        for image_url in reserved:
+            release_image(image_url)
+        raise
 
     return None, None
 
+async def prefetch_pixabay_responses(query_counts, synonym_dict=None, config=None):
+    """
+    Warm the cache and the run's response memo for every distinct query up front.
+
+    Each query's primary lookup is checked against the cache in one bulk
+    read. A query used by a single row is done if it is cached; the others
+    are fetched once each, in parallel, so the rows that need them later
+    only pick images from responses already in memory.
+
+    Args:
+        query_counts (dict): Maps each normalized query to the number of rows using it.
+        synonym_dict (dict or SynonymIndex, optional): Synonyms for query expansion.
+        config (dict, optional): Configuration for feature toggles and settings.
+
+    Returns:
+        dict: ``queries``, ``cache_hits`` and ``fetched`` counts.
+    """
+    api_key = os.getenv("PIXABAY_API_KEY") or load_api_key()
+    config = resolve_config(config)
+    if not api_key or not query_counts:
+        return {"queries": len(query_counts), "cache_hits": 0, "fetched": 0}
+
+    if config["apply_nlp"]:
+        # Refine every expansion of the run in one batch, so the plans below are memo lookups
+        expansions = [
+            expanded
+            for query in query_counts
+            for expanded in (expand_with_synonyms(query, synonym_dict) if config["use_synonyms"] else [query])
+        ]
+        await asyncio.to_thread(refine_queries, expansions, config.get("nlp_workers"))
+
+    primary_lookups = {}
+    for query in query_counts:
+        params, lookups = build_lookup_plan(query, api_key, synonym_dict, config)
+        expanded_query, cache_key = lookups[0]
+        primary_lookups[query] = (dict(params, q=expanded_query), cache_key)
+
+    cached = await (await aget_cache(config)).aget_many([cache_key for _, cache_key in primary_lookups.values()])
+    to_fetch = [
+        params for query, (params, cache_key) in primary_lookups.items()
+        if cache_key not in cached or query_counts[query] > 1
+    ]
+
+    semaphore = asyncio.Semaphore(max(1, int(config.get("max_concurrency", http_client.DEFAULT_MAX_CONCURRENCY))))
+
+    async def warm(params):
+        async with semaphore:
+            try:
+                await get_pixabay_response(get_api_url(), params, config)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Prefetch failed for query '%s': %s", params["q"], e)
+
+    await asyncio.gather(*(warm(params) for params in to_fetch))
+    stats = {"queries": len(query_counts), "cache_hits": len(query_counts) - len(to_fetch), "fetched": len(to_fetch)}
+    logger.info(f"Prefetched Pixabay results: {stats}")
+    return stats
+
 def perform_pixabay_request(url, params, expanded_query, cache_key, cache, config):
-    session = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    session = http_client.get_sync_session()
 
     try:
         if not isinstance(params, dict):
             logger.error(f"Invalid params type: Expected dict, got {type(params).__name__}. Content: {params}")
             return None, None
-        response = session.get(url, params=params, timeout=5)
+        response = session.get(url, params=params, timeout=http_client.REQUEST_TIMEOUT)
         if response.status_code == 429:
             retry_after = int(response.headers.get("Retry-After", 60))
             logger.warning(f"Rate limit exceeded. Retrying after {retry_after} seconds...")
@@ -222,23 +416,23 @@ def perform_pixabay_request(url, params, expanded_query, cache_key, cache, confi
         if not isinstance(data, dict):
             logger.error(f"Unexpected response type: {type(data).__name__}. Content: {data}")
             return None, None
-        logger.debug(f"Query '{params['q']}' returned {len(data.get('hits', []))} results.")
+        logger.debug("Query '%s' returned %d results.", params["q"], len(data.get("hits", [])))
 
         if len(data.get("hits", [])) < 3 and config["strict_filters"]:
             logger.warning("Few results found. Relaxing strict filters...")
             params.pop("editors_choice", None)
-            response = session.get(url, params=params, timeout=5)
+            response = session.get(url, params=params, timeout=http_client.REQUEST_TIMEOUT)
             response.raise_for_status()
             data = response.json()
 
         if data.get("hits"):
             return process_pixabay_hits(data, expanded_query, cache_key, cache, config)
         else:
-            logger.warning(f"No results for query '{expanded_query}' after trying synonyms.")
+            logger.warning("No results for query '%s' after trying synonyms.", expanded_query)
             return None, None
 
     except requests.RequestException as e:
-        logger.error(f"Error fetching image for query '{expanded_query}': {e}")
+        logger.error("Error fetching image for query '%s': %s", expanded_query, e)
         return None, None
 
 def relax_metadata_criteria(config, factor=0.5):
@@ -253,6 +447,57 @@ def relax_metadata_criteria(config, factor=0.5):
     logger.info("Relaxed metadata criteria: %s", config["metadata_filter"])
 
 
+def select_image_source(hit, target_width=None):
+    """
+    Pick the smallest image URL of a hit that is at least ``target_width`` pixels wide.
+
+    Candidates are the preview, the ``_180``/``_340``/``_640``/``_960``
+    variants of ``webformatURL`` and ``largeImageURL``, with widths worked
+    out from the hit's ``previewWidth``, ``webformatWidth``/``webformatHeight``
+    and ``imageWidth``/``imageHeight``. If none is wide enough, the widest is used.
+
+    Args:
+        hit (dict): One entry of the response's ``hits``.
+        target_width (int, optional): Width the image will be shown at. Without it, ``webformatURL``.
+
+    Returns:
+        str: The chosen image URL.
+    """
+    webformat = hit.get("webformatURL")
+    if not target_width or not webformat:
+        return webformat
+
+    candidates = []
+    if hit.get("previewURL") and hit.get("previewWidth"):
+        candidates.append((hit["previewWidth"], hit["previewURL"]))
+    web_width, web_height = hit.get("webformatWidth") or 0, hit.get("webformatHeight") or 0
+    if web_width and "_640" in webformat:
+        longest = max(web_width, web_height)
+        candidates.extend(
+            (round(web_width * size / longest), webformat.replace("_640", f"_{size}")) for size in WEBFORMAT_SIZES
+        )
+    elif web_width:
+        candidates.append((web_width, webformat))
+    image_width, image_height = hit.get("imageWidth") or 0, hit.get("imageHeight") or 0
+    if hit.get("largeImageURL") and image_width:
+        scale = min(1.0, LARGE_IMAGE_SIZE / max(image_width, image_height))
+        candidates.append((round(image_width * scale), hit["largeImageURL"]))
+    if not candidates:
+        return webformat
+
+    candidates.sort(key=lambda candidate: candidate[0])
+    for width, url in candidates:
+        if width >= target_width:
+            return url
+    return candidates[-1][1]
+
+def preview_url_for(data, image_url, config):
+    """Return the preview of the hit whose chosen image is ``image_url``, a cheap rendition to hash."""
+    for hit in data.get("hits", []):
+        if select_image_source(hit, config.get("image_width")) == image_url:
+            return hit.get("previewURL")
+    return None
+
 def process_pixabay_hits(data, expanded_query, cache_key, cache, config):
     """
     Processes the hits returned from the Pixabay API, filters them based on metadata criteria,
@@ -270,6 +515,7 @@ def process_pixabay_hits(data, expanded_query, cache_key, cache, config):
                otherwise (None, None).
     """
     hits = data.get("hits", [])
+    target_width = config.get("image_width")
 
     # Rank images based on likes, downloads, and views
     ranked_images = sorted(
@@ -279,12 +525,13 @@ def process_pixabay_hits(data, expanded_query, cache_key, cache, config):
     )
 
     # Debug log to show why images failed criteria
-    for img in ranked_images:
-        logger.debug(
-            f"Image {img.get('id')} failed criteria: likes={img.get('likes', 0)}, "
-            f"downloads={img.get('downloads', 0)}, views={img.get('views', 0)}, "
-            f"used={img.get('webformatURL') in used_images}"
-        )
+    if logger.isEnabledFor(logging.DEBUG):
+        for img in ranked_images:
+            logger.debug(
+                "Image %s failed criteria: likes=%s, downloads=%s, views=%s, used=%s",
+                img.get("id"), img.get("likes", 0), img.get("downloads", 0), img.get("views", 0),
+                select_image_source(img, target_width) in used_images,
+            )
 
     # Filter images based on metadata and uniqueness
     filtered_images = [
@@ -292,16 +539,16 @@ def process_pixabay_hits(data, expanded_query, cache_key, cache, config):
         img.get("likes", 0) >= config["metadata_filter"].get("min_likes", 0) and
         img.get("downloads", 0) >= config["metadata_filter"].get("min_downloads", 0) and
         img.get("views", 0) >= config["metadata_filter"].get("min_views", 0) and
-        img.get("webformatURL") not in used_images
+        select_image_source(img, target_width) not in used_images
     ]
 
     if not filtered_images:
-        logger.warning(f"No images passed metadata filters for query '{expanded_query}'.")
+        logger.warning("No images passed metadata filters for query '%s'.", expanded_query)
         return None, None
 
     # Select the top filtered image
     image_info = filtered_images[0]
-    image_url = image_info.get("webformatURL")
+    image_url = select_image_source(image_info, target_width)
     image_credit = f"Image by {image_info.get('user')} from Pixabay"
 
     # Add the image URL to the used images set to avoid duplicates
@@ -313,6 +560,6 @@ def process_pixabay_hits(data, expanded_query, cache_key, cache, config):
         "image_credit": image_credit,
         "timestamp": time.time()
     }
-    logger.debug(f"Fetched and cached result for '{expanded_query}'.")
+    logger.debug("Fetched and cached result for '%s'.", expanded_query)
 
     return image_url, image_credit
@@ -0,0 +1,175 @@
+# query_refiner.py
+# Stop-word removal and lemmatization of search queries, memoized and batchable.
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+NLTK_CORPORA = {"stopwords": "corpora/stopwords", "wordnet": "corpora/wordnet"}
+REFINEMENT_MEMO_SIZE = 50000  # Refined queries kept in the in-process memo
+PARALLEL_THRESHOLD = 5000  # Uncached queries in one batch before a process pool is used
+PARALLEL_CHUNK_SIZE = 500  # Queries sent to a worker process at a time
+
+_resources = None  # (stop_words, lemmatize), built once per process by get_resources()
+_resources_lock = threading.Lock()
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def ensure_nltk_corpus(name):
+    """
+    Make sure an NLTK corpus is available, downloading it only if it is missing locally.
+
+    Checked once per process. Offline, a missing corpus is reported and the
+    caller carries on without it.
+
+    Args:
+        name (str): Corpus name, a key of ``NLTK_CORPORA``.
+
+    Returns:
+        bool: True if the corpus can be loaded.
+    """
+    import nltk
+    try:
+        nltk.data.find(NLTK_CORPORA[name])
+        return True
+    except LookupError:
+        pass
+
+    logger.info(f"NLTK corpus '{name}' not found locally. Downloading it...")
+    try:
+        if nltk.download(name, quiet=True):
+            return True
+    except Exception as e:
+        logger.warning(f"Could not download NLTK corpus '{name}': {e}")
+    logger.warning(f"NLTK corpus '{name}' is unavailable. Continuing without it.")
+    return False
+
+
+def get_resources():
+    """
+    Return the stop-word set and lemmatize function, building them on first use.
+
+    The corpora are loaded eagerly under a lock, so threads refining
+    concurrently never race on NLTK's lazy corpus loaders.
+
+    Returns:
+        tuple: ``(stop_words, lemmatize)``. Without a corpus, the stop-word set
+               is empty or ``lemmatize`` returns words unchanged.
+    """
+    global _resources
+    if _resources is None:
+        with _resources_lock:
+            if _resources is None:
+                stop_words = frozenset()
+                lemmatize = _identity
+                if ensure_nltk_corpus("stopwords"):
+                    from nltk.corpus import stopwords
+                    stop_words = frozenset(stopwords.words("english"))
+                if ensure_nltk_corpus("wordnet"):
+                    from nltk.stem import WordNetLemmatizer
+                    lemmatize = WordNetLemmatizer().lemmatize
+                    lemmatize("warmup")  # Loads WordNet now rather than in the first caller
+                _resources = (stop_words, lemmatize)
+    return _resources
+
+
+def _identity(word):
+    return word
+
+
+def _refine(query):
+    """Refine one query, bypassing the memo."""
+    stop_words, lemmatize = get_resources()
+    return " ".join(lemmatize(word) for word in query.split() if word.lower() not in stop_words)
+
+
+def _refine_chunk(queries):
+    """Worker-process entry point: refine a list of queries."""
+    return [_refine(query) for query in queries]
+
+
+def _remember(query, refined):
+    """Store a refinement, evicting the least recently used one if the memo is full. Hold ``_memo_lock``."""
+    _memo[query] = refined
+    _memo.move_to_end(query)
+    if len(_memo) > REFINEMENT_MEMO_SIZE:
+        _memo.popitem(last=False)
+
+
+def refine_query(query):
+    """
+    Refine a query by dropping English stop words and lemmatizing the rest.
+
+    Args:
+        query (str): The search query.
+
+    Returns:
+        str: Refined query.
+    """
+    with _memo_lock:
+        refined = _memo.get(query)
+        if refined is not None:
+            _memo.move_to_end(query)
+            return refined
+    refined = _refine(query)
+    with _memo_lock:
+        _remember(query, refined)
+    logger.debug("Refined query: %s", refined)
+    return refined
+
+
+def refine_queries(queries, workers=None, parallel_threshold=PARALLEL_THRESHOLD):
+    """
+    Refine many queries at once, e.g. every query of a run.
+
+    Each distinct query is refined once. Queries already in the memo are
+    answered from it; when more than ``parallel_threshold`` remain, they are
+    split into chunks and refined in a process pool, each worker loading the
+    NLTK resources once. Results are added to the memo, so later
+    ``refine_query`` calls for the same queries are lookups.
+
+    Args:
+        queries (iterable): Queries to refine.
+        workers (int, optional): Worker processes for large batches. Defaults to the CPU count.
+        parallel_threshold (int): Uncached queries needed before a process pool is used.
+
+    Returns:
+        dict: Maps each distinct query to its refinement.
+    """
+    results = {}
+    missing = []
+    with _memo_lock:
+        for query in dict.fromkeys(queries):
+            refined = _memo.get(query)
+            if refined is None:
+                missing.append(query)
+            else:
+                _memo.move_to_end(query)
+                results[query] = refined
+
+    workers = workers or os.cpu_count() or 1
+    if len(missing) > parallel_threshold and workers > 1:
+        chunks = [missing[start:start + PARALLEL_CHUNK_SIZE] for start in range(0, len(missing), PARALLEL_CHUNK_SIZE)]
+        logger.info(f"Refining {len(missing)} queries in {min(workers, len(chunks))} processes.")
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+            refined = [query for chunk in pool.map(_refine_chunk, chunks) for query in chunk]
+    else:
+        refined = [_refine(query) for query in missing]
+
+    with _memo_lock:
+        for query, refinement in zip(missing, refined):
+            _remember(query, refinement)
+            results[query] = refinement
+    return results
+
+
+def clear_memo():
+    """Forget all memoized refinements."""
+    with _memo_lock:
+        _memo.clear()
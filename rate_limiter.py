@@ -0,0 +1,237 @@
+# rate_limiter.py
+# Token-bucket pacing for the external APIs, shared between processes through SQLite.
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_FILE = "rate_limits.sqlite3"
+BUSY_TIMEOUT = 30  # Seconds to wait for another process holding the write lock
+DEFAULT_RETRY_AFTER = 60  # Seconds to back off on a 429 without a Retry-After header
+
+# Requests allowed per window, in seconds, before the API reports its own limits
+PROVIDER_LIMITS = {
+    "pixabay": (100, 60),
+    "pexels": (200, 60 * 60),
+    "datamuse": (1000, 60),
+}
+
+MAX_RETRIES = 5  # Retries of one request after transient errors
+MAX_RATE_LIMIT_RETRIES = 10  # Retries of one request after 429s, e.g. when the hourly quota is spent
+BACKOFF_BASE = 0.5  # Seconds before the first retry, doubled per attempt
+BACKOFF_CAP = 30  # Longest single backoff, in seconds
+RETRY_BUDGET_RATIO = 0.2  # Retries allowed per request sent, across the process
+RETRY_BUDGET_MIN = 10  # Retries always allowed, so a short run can still recover
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    capacity REAL NOT NULL,
+    refill_rate REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    blocked_until REAL NOT NULL DEFAULT 0
+);
+"""
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    Exponential backoff with full jitter.
+
+    Args:
+        attempt (int): Zero-based retry number.
+
+    Returns:
+        float: Seconds to sleep before the retry.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def parse_reset(value, now):
+    """
+    Convert an ``X-RateLimit-Reset`` header to seconds from ``now``.
+
+    Pixabay sends seconds until the window resets, Pexels sends a UNIX
+    timestamp; anything that looks like a timestamp is treated as one.
+    """
+    reset = float(value)
+    if reset > 1e9:
+        reset -= now
+    return max(0.0, reset)
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of the requests sent.
+
+    Keeps a struggling API from being hit with a storm of retries: once the
+    budget is spent, failing requests give up instead of retrying.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, minimum=RETRY_BUDGET_MIN):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.requests = 0
+        self.retries = 0
+
+    def record_request(self):
+        self.requests += 1
+
+    def try_spend(self):
+        """Take one retry from the budget. Returns False if it is exhausted."""
+        if self.retries >= self.minimum + self.requests * self.ratio:
+            return False
+        self.retries += 1
+        return True
+
+
+class RateLimiter:
+    """
+    Token bucket for one API whose state lives in a shared SQLite file.
+
+    Every process that builds decks against the same API reads and updates
+    the same row inside an immediate transaction, so together they stay
+    under the quota. The bucket refills at ``capacity / window`` tokens per
+    second and is corrected from the API's own rate-limit headers, so
+    requests are paced before the server has to answer with a 429.
+    """
+
+    def __init__(self, name, path=RATE_LIMIT_FILE, limit=None, window=None):
+        default_limit, default_window = PROVIDER_LIMITS.get(name, (100, 60))
+        self.name = name
+        self.path = path
+        self.window = window or default_window
+        self.retry_budget = RetryBudget()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        capacity = float(limit or default_limit)
+        self._conn.execute(
+            "INSERT OR IGNORE INTO rate_limits (name, tokens, capacity, refill_rate, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (name, capacity, capacity, capacity / self.window, time.time()),
+        )
+
+    def _update(self, change):
+        """
+        Apply ``change`` to the refilled bucket inside one write transaction.
+
+        Args:
+            change (callable): Receives ``(state, now)`` with ``state`` a dict of
+                the row's columns, mutates it and returns a value to pass back.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            tokens, capacity, refill_rate, updated_at, blocked_until = self._conn.execute(
+                "SELECT tokens, capacity, refill_rate, updated_at, blocked_until FROM rate_limits WHERE name = ?",
+                (self.name,),
+            ).fetchone()
+            now = time.time()
+            state = {
+                "tokens": min(capacity, tokens + max(0.0, now - updated_at) * refill_rate),
+                "capacity": capacity,
+                "refill_rate": refill_rate,
+                "blocked_until": blocked_until,
+            }
+            result = change(state, now)
+            self._conn.execute(
+                "UPDATE rate_limits SET tokens = ?, capacity = ?, refill_rate = ?, updated_at = ?, blocked_until = ? "
+                "WHERE name = ?",
+                (state["tokens"], state["capacity"], state["refill_rate"], now, state["blocked_until"], self.name),
+            )
+        return result
+
+    def reserve(self):
+        """
+        Take a token, or report how long to wait for one.
+
+        Returns:
+            float: 0 if a token was taken, otherwise seconds to wait before trying again.
+        """
+        def take(state, now):
+            if state["blocked_until"] > now:
+                return state["blocked_until"] - now
+            if state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return 0.0
+            return (1 - state["tokens"]) / state["refill_rate"]
+
+        return self._update(take)
+
+    def update_from_headers(self, headers):
+        """
+        Align the bucket with ``X-RateLimit-*`` response headers.
+
+        ``X-RateLimit-Limit`` sets the capacity and refill rate, and the
+        bucket never holds more tokens than ``X-RateLimit-Remaining``. With
+        no requests remaining, everyone waits for ``X-RateLimit-Reset``.
+        """
+        limit = headers.get("X-RateLimit-Limit")
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None and limit is None:
+            return
+
+        def align(state, now):
+            if limit is not None:
+                state["capacity"] = float(limit)
+                state["refill_rate"] = float(limit) / self.window
+            if remaining is not None:
+                state["tokens"] = min(state["tokens"], float(remaining))
+                if float(remaining) <= 0 and reset is not None:
+                    state["blocked_until"] = max(state["blocked_until"], now + parse_reset(reset, now))
+
+        try:
+            self._update(align)
+        except ValueError:
+            logger.debug("Ignoring malformed rate-limit headers from %s: %s", self.name, dict(headers))
+
+    def block_for(self, seconds):
+        """Stop all requests to this API for ``seconds``, e.g. after a 429."""
+        def block(state, now):
+            state["tokens"] = 0.0
+            state["blocked_until"] = max(state["blocked_until"], now + seconds)
+
+        self._update(block)
+
+    async def acquire(self):
+        """Wait until a request may be sent, then take its token."""
+        while True:
+            wait = await asyncio.to_thread(self.reserve)
+            if wait <= 0:
+                self.retry_budget.record_request()
+                return
+            logger.debug("%s rate limiter: waiting %.2fs for a token.", self.name, wait)
+            await asyncio.sleep(wait)
+
+    async def aupdate_from_headers(self, headers):
+        await asyncio.to_thread(self.update_from_headers, headers)
+
+    async def ablock_for(self, seconds):
+        await asyncio.to_thread(self.block_for, seconds)
+
+
+def get_rate_limiter(name, path=RATE_LIMIT_FILE):
+    """
+    Return the process-wide limiter for an API, creating it on first use.
+
+    Args:
+        name (str): Provider name, e.g. ``"pixabay"``.
+        path (str): SQLite file shared by all processes.
+
+    Returns:
+        RateLimiter: The shared limiter.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = _limiters[name] = RateLimiter(name, path)
+        return limiter
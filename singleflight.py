@@ -0,0 +1,70 @@
+# singleflight.py
+# Coalesces identical in-flight requests so only one reaches the API.
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_key(namespace, params, ignore=("key",)):
+    """
+    Build a stable key for a request so equivalent requests coalesce.
+
+    The query text is case- and whitespace-normalized, credentials are left
+    out, and the remaining parameters are serialized in sorted order.
+
+    Args:
+        namespace (str): Provider name, keeps providers apart.
+        params (dict): Request parameters.
+        ignore (tuple): Parameter names that do not affect the response.
+
+    Returns:
+        str: The canonical key.
+    """
+    normalized = {}
+    for name, value in params.items():
+        if name in ignore:
+            continue
+        if name in ("q", "query") and isinstance(value, str):
+            value = " ".join(value.lower().split())
+        normalized[name] = value
+    return f"{namespace}:{json.dumps(normalized, sort_keys=True)}"
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time and shares its result.
+
+    The first caller for a key starts the call; callers arriving while it is
+    running await the same result instead of starting their own. Once the
+    call finishes the key is forgotten, so later callers fetch fresh data.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.coalesced = 0
+        self._tasks = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        """
+        Await ``fn(*args, **kwargs)``, sharing the call with concurrent callers of the same key.
+
+        Callers are shielded from each other: one caller being cancelled (for
+        example by its row deadline) does not cancel the shared call.
+        """
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get(key)
+        if task is not None and task.get_loop() is loop:
+            self.coalesced += 1
+            logger.debug(f"{self.name}: joined in-flight request for {key}")
+            return await asyncio.shield(task)
+
+        task = loop.create_task(fn(*args, **kwargs))
+        self._tasks[key] = task
+        task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key, done):
+        if self._tasks.get(key) is done:
+            del self._tasks[key]
@@ -0,0 +1,158 @@
+# synonym_fetcher.py
+# Concurrent Datamuse synonym lookups with a persistent result cache.
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import aiohttp
+
+import http_client
+from rate_limiter import get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+DATAMUSE_API_URL = "https://api.datamuse.com/words"
+CACHE_FILE = "datamuse_cache.sqlite3"
+CACHE_EXPIRATION = 30 * 24 * 60 * 60  # 30 days in seconds
+DEFAULT_CONCURRENCY = 5
+MAX_RESULTS = 5
+BUSY_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS synonym_results (
+    word TEXT PRIMARY KEY,
+    synonyms TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+
+class SynonymResultCache:
+    """
+    Remembers every online synonym answer, including empty ones.
+
+    Caching "no synonyms" matters as much as caching hits: without it, every
+    run asks Datamuse again about each word it knows nothing for.
+    """
+
+    def __init__(self, path=CACHE_FILE, ttl=CACHE_EXPIRATION):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def get_many(self, words):
+        """
+        Return cached answers for the words that have a live entry.
+
+        Returns:
+            dict: Maps each cached word to its (possibly empty) synonym list.
+        """
+        words = list(dict.fromkeys(words))
+        found = {}
+        with self._lock:
+            for start in range(0, len(words), 500):
+                chunk = words[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT word, synonyms FROM synonym_results WHERE word IN ({', '.join('?' * len(chunk))}) "
+                    "AND fetched_at > ?",
+                    (*chunk, time.time() - self.ttl),
+                ).fetchall()
+                found.update((word, json.loads(synonyms)) for word, synonyms in rows)
+        return found
+
+    def set_many(self, results):
+        """Store answers, a dict of word to synonym list, in one transaction."""
+        if not results:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO synonym_results (word, synonyms, fetched_at) VALUES (?, ?, ?)",
+                [(word, json.dumps(synonyms), now) for word, synonyms in results.items()],
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_result_cache = None
+
+
+def get_result_cache():
+    """Return the process-wide synonym result cache, opening it on first use."""
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = SynonymResultCache()
+    return _result_cache
+
+
+def get_api_url():
+    """Return the Datamuse endpoint, which ``DATAMUSE_API_URL`` in the environment overrides, e.g. for a fake server."""
+    return os.getenv("DATAMUSE_API_URL") or DATAMUSE_API_URL
+
+
+async def datamuse_lookup(word, max_results=MAX_RESULTS):
+    """
+    Ask Datamuse for synonyms of one word over the shared HTTP session.
+
+    Returns:
+        list: The synonyms Datamuse returned.
+    """
+    params = {"rel_syn": word, "max": max_results}
+    results = await http_client.get_json(get_api_url(), get_rate_limiter("datamuse"), params=params)
+    return [entry["word"] for entry in results if "word" in entry]
+
+
+async def fetch_synonyms_batch(words, concurrency=DEFAULT_CONCURRENCY, lookup=None, cache=None):
+    """
+    Look up synonyms for many words at once.
+
+    Words with a cached answer are not looked up again. The rest are looked
+    up concurrently, at most ``concurrency`` at a time, and every answer -
+    empty ones included - is written to the cache in one transaction. A word
+    whose lookup fails is left out of the result and uncached, so the next
+    run tries again.
+
+    Args:
+        words (iterable): Words or phrases to look up.
+        concurrency (int): Most lookups in flight at once.
+        lookup (callable, optional): ``async lookup(word) -> list``. Defaults to
+            ``datamuse_lookup``; pass a local stand-in to run without the network.
+        cache (SynonymResultCache, optional): Defaults to the shared result cache.
+
+    Returns:
+        dict: Maps each resolved word to its synonym list.
+    """
+    lookup = lookup or datamuse_lookup
+    if cache is None:
+        cache = get_result_cache()
+    words = [word for word in dict.fromkeys(words) if word]
+    results = await asyncio.to_thread(cache.get_many, words)
+    missing = [word for word in words if word not in results]
+    if not missing:
+        return results
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def fetch(word):
+        async with semaphore:
+            try:
+                return word, await lookup(word)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Error fetching synonyms for '%s': %s", word, e)
+                return word, None
+
+    fetched = {word: synonyms for word, synonyms in await asyncio.gather(*(fetch(word) for word in missing))
+               if synonyms is not None}
+    await asyncio.to_thread(cache.set_many, fetched)
+    logger.info(f"Fetched synonyms online for {len(fetched)} of {len(missing)} uncached words.")
+    results.update(fetched)
+    return results
@@ -0,0 +1,107 @@
+# synonym_index.py
+# In-memory synonym index with phrase-aware matching over query tokens.
+import re
+
+_TOKEN_RE = re.compile(r"\w+")
+_END = object()  # Trie marker holding the normalized key that ends at a node
+EXPANSION_MEMO_SIZE = 10000  # Distinct queries whose expansions are kept
+
+
+def tokenize(text):
+    """Split text into lower-case word tokens, dropping punctuation."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+class SynonymIndex:
+    """
+    Synonym dictionary indexed by normalized, possibly multi-word keys.
+
+    Keys are stored in a token trie, so every key occurring in a query -
+    single words like "should" or phrases like "to close" - is found in one
+    left-to-right pass over the query's tokens. The work per token is bounded
+    by the longest key, which keeps matching linear in query length.
+    Expansions are computed once per distinct query and memoized.
+    """
+
+    def __init__(self, synonym_dict=None):
+        self._trie = {}
+        self._synonyms = {}
+        self._expansions = {}
+        for key, synonyms in (synonym_dict or {}).items():
+            self.add(key, synonyms)
+
+    def add(self, key, synonyms):
+        """Add or extend the synonyms of a key."""
+        tokens = tokenize(key)
+        if not tokens:
+            return
+        normalized = " ".join(tokens)
+        node = self._trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        node[_END] = normalized
+
+        existing = self._synonyms.setdefault(normalized, [])
+        existing.extend(s for s in synonyms if s not in existing)
+        self._expansions.clear()
+
+    def lookup(self, key):
+        """
+        Return the synonyms of an exact key.
+
+        Returns:
+            list: The synonyms, or None if the key is not in the index.
+        """
+        synonyms = self._synonyms.get(" ".join(tokenize(key)))
+        return list(synonyms) if synonyms is not None else None
+
+    def __contains__(self, key):
+        return " ".join(tokenize(key)) in self._synonyms
+
+    def __len__(self):
+        return len(self._synonyms)
+
+    def find_matches(self, tokens):
+        """
+        Find every key occurring in a token sequence.
+
+        Returns:
+            list: ``(start, end, key)`` spans, ``tokens[start:end]`` being the match.
+        """
+        matches = []
+        for start in range(len(tokens)):
+            node = self._trie
+            for end in range(start, len(tokens)):
+                node = node.get(tokens[end])
+                if node is None:
+                    break
+                if _END in node:
+                    matches.append((start, end + 1, node[_END]))
+        return matches
+
+    def expand(self, query):
+        """
+        Expand a query by substituting each matched key with each of its synonyms.
+
+        Keys match regardless of case and punctuation; the rest of the query
+        is kept as written.
+
+        Args:
+            query (str): The original query string.
+
+        Returns:
+            list: The original query followed by its distinct expansions.
+        """
+        expansions = self._expansions.get(query)
+        if expansions is None:
+            # Match on normalized tokens but substitute into the query as written
+            spans = [match.span() for match in _TOKEN_RE.finditer(query)]
+            tokens = [query[begin:finish].lower() for begin, finish in spans]
+            expanded = dict.fromkeys([query])
+            for start, end, key in self.find_matches(tokens):
+                for synonym in self._synonyms[key]:
+                    expanded[query[:spans[start][0]] + synonym + query[spans[end - 1][1]:]] = None
+            if len(self._expansions) >= EXPANSION_MEMO_SIZE:
+                self._expansions.clear()
+            expansions = self._expansions[query] = list(expanded)
+        return list(expansions)
@@ -1,61 +1,1068 @@
 import unittest
+import io
 from unittest.mock import patch, MagicMock
+import asyncio
+import contextlib
+import subprocess
+import sys
+from collections import Counter
 import os
 import json
-from main import get_pixabay_api_key, select_input_file, get_deck_name, validate_input_file, load_config
+import http_client
+import tempfile
+import time
+import threading
+from image_cache import ImageCache
+import pixabay_api
+import pexels_api
+import aiohttp
+from aiohttp import web
+from rate_limiter import RateLimiter
+from utils import expand_with_synonyms
+import query_refiner
+import synonym_fetcher
+import utils
+from synonym_index import SynonymIndex
+from fake_api_server import FakeApiProfile, start_fake_api_server
+from media_store import MediaStore, download_media
+from metrics import MetricsRegistry
+import logging
+import logging_utils
+from anki_utils import GLOBAL_MODEL
+from apkg_writer import ApkgWriter, field_checksum
+from image_processing import transcode_media
+from image_dedupe import BKTree, SimilarImageIndex, dhash, hamming, similar_images
+from file_utils import ParseReport, detect_input_format, iter_input_rows
+from synonym_fetcher import SynonymResultCache, fetch_synonyms_batch
+from hedging import LatencyTracker, hedged_call, MAX_TIMEOUT
+from concurrent.futures import ThreadPoolExecutor
+import benchmark
+import main
+from main import get_pixabay_api_key, select_input_file, get_deck_name, validate_input_file, load_config, enrich_rows
+
+@contextlib.asynccontextmanager
+async def local_server(route, handler):
+    """Serve ``handler`` for GET requests to ``route`` on a free local port, yielding the base URL."""
+    app = web.Application()
+    app.router.add_get(route, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        await runner.cleanup()
 
 class TestMainFunctions(unittest.TestCase):
 
     @patch('builtins.input', return_value='valid_api_key')
     @patch('main.save_config')
-    def pixabay_api_key_saved_to_config(self, mock_save_config, mock_input):
+    def test_pixabay_api_key_saved_to_config(self, mock_save_config, mock_input):
         config = {}
         api_key = get_pixabay_api_key(config)
         self.assertEqual(api_key, 'valid_api_key')
         mock_save_config.assert_called_once()
 
     @patch('builtins.input', return_value='')
-    def pixabay_api_key_missing_exits(self, mock_input):
+    def test_pixabay_api_key_missing_exits(self, mock_input):
         config = {}
         with self.assertRaises(SystemExit):
             get_pixabay_api_key(config)
 
     @patch('main.get_default_input_files', return_value=['file1.md', 'file2.md'])
     @patch('builtins.input', return_value='1')
-    def select_input_file_from_list(self, mock_input, mock_get_default_input_files):
+    def test_select_input_file_from_list(self, mock_input, mock_get_default_input_files):
         selected_file = select_input_file()
-        self.assertEqual(selected_file, os.path.join('input_files', 'file1.md'))
+        self.assertEqual(selected_file, os.path.join(main.INPUT_FILES_DIR, 'file1.md'))
 
-    @patch('main.filedialog.askopenfilename', return_value='selected_file.md')
-    def select_input_file_manually(self, mock_askopenfilename):
+    @patch('main.get_default_input_files', return_value=[])
+    @patch('tkinter.filedialog.askopenfilename', return_value='selected_file.md')
+    def test_select_input_file_manually(self, mock_askopenfilename, mock_get_default_input_files):
         selected_file = select_input_file()
         self.assertEqual(selected_file, 'selected_file.md')
 
     @patch('builtins.input', return_value='')
-    def deck_name_missing_exits(self, mock_input):
+    def test_deck_name_missing_exits(self, mock_input):
         with self.assertRaises(SystemExit):
             get_deck_name()
 
     @patch('builtins.input', return_value='valid_deck_name')
-    def deck_name_valid(self, mock_input):
+    def test_deck_name_valid(self, mock_input):
         deck_name = get_deck_name()
         self.assertEqual(deck_name, 'valid_deck_name')
 
-    def validate_input_file_valid(self):
-        self.assertTrue(validate_input_file('valid_file.md'))
+    def test_validate_input_file_valid(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'valid_file.md')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write("| WORD | MEANING |\n| --- | --- |\n| backen | to bake |\n")
+            self.assertTrue(validate_input_file(path))
 
-    def validate_input_file_invalid(self):
-        self.assertFalse(validate_input_file('invalid_file.txt'))
+    def test_validate_input_file_invalid(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'invalid_file.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write("no table here\n")
+            self.assertFalse(validate_input_file(path))
+            with self.assertRaises(FileNotFoundError):
+                validate_input_file(os.path.join(tmpdir, 'missing.md'))
 
     @patch('builtins.open', new_callable=unittest.mock.mock_open, read_data='{"pixabay_api_key": "key"}')
-    def load_config_valid(self, mock_open):
+    def test_load_config_valid(self, mock_open):
         config = load_config('config.json')
         self.assertEqual(config, {"pixabay_api_key": "key"})
 
     @patch('builtins.open', new_callable=unittest.mock.mock_open, read_data='invalid_json')
-    def load_config_invalid(self, mock_open):
+    def test_load_config_invalid(self, mock_open):
         config = load_config('config.json')
-        self.assertIsNone(config)
+        self.assertEqual(config, {})
+
+class TestInputParsing(unittest.TestCase):
+
+    def write_input(self, text, suffix=".md"):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_malformed_rows_are_reported_and_skipped(self):
+        path = self.write_input(
+            "# Verbs\n"
+            "| WORD | MEANING |\n"
+            "| --- | :---: |\n"
+            "| backen | to bake |\n"
+            "| beißen | to bite | extra |\n"
+            "| gehen | to go \\| to walk\n"
+        )
+        report = ParseReport(path)
+        rows = iter_input_rows(path, report)
+        self.assertEqual(next(rows), {"WORD": "backen", "MEANING": "to bake"})
+        self.assertEqual(list(rows), [{"WORD": "gehen", "MEANING": "to go | to walk"}])
+        self.assertEqual(report.rows, 2)
+        self.assertEqual(report.errors, [(5, "Expected 2 cells, found 3.")])
+        self.assertTrue(validate_input_file(path))
+
+    def test_file_without_table_fails_validation(self):
+        path = self.write_input("Just some notes.\n")
+        report = ParseReport(path)
+        self.assertEqual(list(iter_input_rows(path, report)), [])
+        self.assertEqual(report.errors, [(0, "No table header found.")])
+        self.assertFalse(validate_input_file(path))
+
+    def test_formats_are_detected_and_yield_the_same_rows(self):
+        expected = [{"WORD": "backen", "MEANING": "to bake, to roast"}, {"WORD": "gehen", "MEANING": "to go"}]
+        inputs = {
+            "csv": self.write_input('WORD,MEANING\nbacken,"to bake, to roast"\nbeißen\ngehen,to go\n', ".csv"),
+            "tsv": self.write_input("WORD\tMEANING\nbacken\tto bake, to roast\ngehen\tto go\n", ".txt"),
+            "blocks": self.write_input(
+                "## Vocabulary\n- Word: backen\n  - Meaning: to bake, to roast\n\n- Word: gehen\n  - Meaning: to go\n"
+                "## Settings\n- Enable Synonyms: True\n",
+                ".txt",
+            ),
+        }
+        for input_format, path in inputs.items():
+            with self.subTest(input_format):
+                self.assertEqual(detect_input_format(path), input_format)
+                report = ParseReport(path)
+                self.assertEqual(list(iter_input_rows(path, report)), expected)
+                self.assertEqual(report.rows, 2)
+        self.assertEqual(report.errors, [])
+
+        report = ParseReport(inputs["csv"])
+        list(iter_input_rows(inputs["csv"], report))
+        self.assertEqual(report.errors, [(3, "Expected 2 cells, found 1.")])
+
+class TestConcurrentEnrichment(unittest.TestCase):
+
+    @staticmethod
+    def collect(rows, config):
+        async def run():
+            return [note async for _, note in enrich_rows(rows, config, {})]
+        return asyncio.run(run())
+
+    @patch('main.get_synonyms', return_value=[])
+    def test_enrich_rows_keeps_input_order(self, mock_synonyms):
+        async def fake_fetch(query, synonym_dict=None, config=None):
+            await asyncio.sleep(0.001 * (20 - int(query.split()[-1])))  # later rows finish first
+            return f"https://img/{query}", None
+
+        rows = [{"WORD": f"w{i}", "MEANING": f"meaning {i}"} for i in range(20)]
+        with patch('main.fetch_pixabay_image', side_effect=fake_fetch):
+            notes = self.collect(rows, {"max_concurrency": 5})
+        self.assertEqual([note[0] for note in notes], [f"w{i}" for i in range(20)])
+        self.assertEqual(notes[3][2], "https://img/meaning 3")
+
+    @patch('main.get_synonyms', return_value=[])
+    def test_enrich_rows_row_timeout_keeps_note(self, mock_synonyms):
+        async def slow_fetch(query, synonym_dict=None, config=None):
+            await asyncio.sleep(1)
+            return "https://img/slow", None
+
+        rows = [{"WORD": "w", "MEANING": "slow"}, {"MEANING": "no front"}]
+        with patch('main.fetch_pixabay_image', side_effect=slow_fetch):
+            notes = self.collect(rows, {"row_timeout": 0.01})
+        self.assertEqual(notes[0][0], "w")
+        self.assertIsNone(notes[0][2])
+        self.assertIsNone(notes[1])
+
+class TestBatchMode(unittest.TestCase):
+
+    @patch('main.get_synonyms', return_value=[])
+    @patch('main.prefetch_synonyms', new_callable=unittest.mock.AsyncMock)
+    @patch('main.init_batch_worker')
+    def test_each_file_becomes_a_deck_and_failures_are_summarized(self, *mocks):
+        async def fake_fetch(query, config, synonym_dict=None):
+            return f"https://img/{query}", None
+
+        with tempfile.TemporaryDirectory() as tmp:
+            good = os.path.join(tmp, "Verbs.md")
+            with open(good, "w", encoding="utf-8") as f:
+                f.write("| WORD | MEANING |\n| --- | --- |\n| backen | to bake |\n| gehen | to go |\n")
+            bad = os.path.join(tmp, "notes.txt")
+            with open(bad, "w", encoding="utf-8") as f:
+                f.write("nothing to see\n")
+            self.assertEqual(main.resolve_batch_files([os.path.join(tmp, "*.md"), good]), [good])
+
+            with patch('main.OUTPUT_DIR', tmp), patch('main.fetch_image', side_effect=fake_fetch), \
+                    patch('main.ProcessPoolExecutor', ThreadPoolExecutor):
+                batch = main.run_batch([good, bad], {"prefetch": False}, workers=1)
+
+            self.assertEqual([result["input_file"] for result in batch["results"]], [good, bad])
+            self.assertEqual(batch["results"][0]["notes"], 2)
+            self.assertTrue(os.path.exists(os.path.join(tmp, "Verbs.apkg")))
+            self.assertIn("error", batch["results"][1])
+            self.assertEqual(
+                {key: batch["summary"][key] for key in ("files", "built", "failed", "notes")},
+                {"files": 2, "built": 1, "failed": 1, "notes": 2},
+            )
+
+class TestIncrementalBuild(unittest.TestCase):
+
+    @patch('main.get_synonyms', return_value=[])
+    @patch('main.prefetch_synonyms', new_callable=unittest.mock.AsyncMock)
+    def test_unchanged_rows_reuse_their_notes(self, *mocks):
+        lookups = []
+
+        async def fake_fetch(query, config, synonym_dict=None):
+            lookups.append(query)
+            return f"https://img/{query}", None
+
+        def build(text):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            with patch('main.OUTPUT_DIR', tmp), patch('main.fetch_image', side_effect=fake_fetch):
+                return asyncio.run(main.build_deck(path, "Verbs", {"prefetch": False}, show_progress=False))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "Verbs.md")
+            table = "| WORD | MEANING |\n| --- | --- |\n| backen | to bake |\n| gehen | to go |\n"
+            first = build(table)
+            self.assertEqual((first["notes"], first["reused"], len(lookups)), (2, 0, 2))
+            manifest = main.BuildManifest.load(main.manifest_path_for(first["output_path"]))
+            guids = sorted(entry["guid"] for entry in manifest.entries.values())
+
+            lookups.clear()
+            built_at = os.path.getmtime(first["output_path"])
+            second = build(table)
+            self.assertEqual((second["reused"], lookups), (2, []))
+            self.assertEqual(os.path.getmtime(second["output_path"]), built_at)
+
+            third = build(table.replace("to go", "to walk"))
+            self.assertEqual((third["reused"], lookups), (1, ["to walk"]))
+            manifest = main.BuildManifest.load(main.manifest_path_for(third["output_path"]))
+            self.assertEqual(sorted(entry["guid"] for entry in manifest.entries.values()), guids)
+
+    @patch('main.get_synonyms', return_value=[])
+    @patch('main.prefetch_synonyms', new_callable=unittest.mock.AsyncMock)
+    def test_duplicate_rows_keep_their_own_notes(self, *mocks):
+        async def fake_fetch(query, config, synonym_dict=None):
+            return f"https://img/{query}", None
+
+        def build():
+            with patch('main.OUTPUT_DIR', tmp), patch('main.fetch_image', side_effect=fake_fetch):
+                result = asyncio.run(main.build_deck(path, "Verbs", {"prefetch": False}, show_progress=False))
+            manifest = main.BuildManifest.load(main.manifest_path_for(result["output_path"]))
+            return result, {key: entry["guid"] for key, entry in manifest.entries.items()}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "Verbs.md")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("| WORD | MEANING |\n| --- | --- |\n| backen | to bake |\n| backen | to bake |\n| gehen | to go |\n")
+            first, guids = build()
+            self.assertEqual((first["notes"], len(set(guids.values()))), (3, 3))
+            built_at = os.path.getmtime(first["output_path"])
+
+            second, guids_again = build()
+            self.assertEqual(second["reused"], 3)
+            self.assertEqual(guids_again, guids)
+            self.assertEqual(os.path.getmtime(second["output_path"]), built_at)
+
+    @patch('main.get_synonyms', return_value=[])
+    @patch('main.prefetch_synonyms', new_callable=unittest.mock.AsyncMock)
+    def test_rebuilt_rows_do_not_take_images_of_reused_rows(self, *mocks):
+        async def fake_fetch(query, config, synonym_dict=None):
+            # Like the providers: the best-ranked image not yet in the deck
+            image_url = next(url for url in (f"https://img/{query}/{i}" for i in range(5))
+                             if url not in pixabay_api.used_images)
+            pixabay_api.used_images.add(image_url)
+            return image_url, None
+
+        def build(text):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            with patch('main.OUTPUT_DIR', tmp), patch('main.fetch_image', side_effect=fake_fetch):
+                result = asyncio.run(main.build_deck(path, "Verbs", {"prefetch": False}, show_progress=False))
+            manifest = main.BuildManifest.load(main.manifest_path_for(result["output_path"]))
+            return result, sorted(entry["fields"][2] for entry in manifest.entries.values())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "Verbs.md")
+            table = "| WORD | MEANING |\n| --- | --- |\n| fragen | to ask |\n| bitten | to ask |\n"
+            _, images = build(table)
+            self.assertEqual(len(set(images)), 2)
+
+            result, images = build(table.replace("bitten", "erfragen"))
+            self.assertEqual(result["reused"], 1)
+            self.assertEqual(len(set(images)), 2)
+
+class TestApkgWriter(unittest.TestCase):
+
+    def test_notes_are_streamed_into_a_package_genanki_can_read(self):
+        import sqlite3
+        import zipfile
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_path = os.path.join(tmpdir, "Verbs.apkg")
+            image_path = os.path.join(tmpdir, "abc.jpg")
+            with open(image_path, "wb") as f:
+                f.write(b"jpeg")
+            with ApkgWriter(output_path, "Verbs", 1234, batch_size=2, timestamp=1000) as writer:
+                writer.add_note(["<b>backen</b>", "to bake", "https://img/bake.jpg"], guid="g1")
+                writer.add_note(["gehen", "to go", ""], guid="g2")
+                writer.add_note(["laufen", "to run", "https://img/run.jpg"])
+                writer.replace_field(2, {"https://img/bake.jpg": "abc.jpg"})
+                writer.finish([image_path])
+            self.assertEqual(sorted(os.listdir(tmpdir)), ["Verbs.apkg", "abc.jpg"])
+
+            with zipfile.ZipFile(output_path) as archive:
+                self.assertEqual(json.loads(archive.read("media")), {"0": "abc.jpg"})
+                self.assertEqual(archive.read("0"), b"jpeg")
+                db_path = os.path.join(tmpdir, "collection.anki2")
+                with open(db_path, "wb") as f:
+                    f.write(archive.read("collection.anki2"))
+            conn = sqlite3.connect(db_path)
+            notes = conn.execute("SELECT guid, flds, sfld, csum FROM notes ORDER BY id").fetchall()
+            self.assertEqual(notes[0], ("g1", "<b>backen</b>\x1fto bake\x1fabc.jpg", "<b>backen</b>", field_checksum("backen")))
+            self.assertEqual(notes[1][:2], ("g2", "gehen\x1fto go\x1f"))
+            self.assertEqual(conn.execute("SELECT COUNT(*), MIN(did), MAX(did) FROM cards").fetchone(), (3, 1234, 1234))
+            decks, models = conn.execute("SELECT decks, models FROM col").fetchone()
+            self.assertEqual(json.loads(decks)["1234"]["name"], "Verbs")
+            self.assertIn(str(GLOBAL_MODEL.model_id), json.loads(models))
+            conn.close()
+
+    def test_unfinished_writer_leaves_nothing_behind(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with ApkgWriter(os.path.join(tmpdir, "Verbs.apkg"), "Verbs", 1234) as writer:
+                writer.add_note(["gehen", "to go", ""])
+            self.assertEqual(os.listdir(tmpdir), [])
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_every_stage_is_timed_on_a_generated_table(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results = benchmark.run_benchmarks(sizes=[40], repeat=1, workdir=tmpdir)
+            json.dumps(results)
+        stages = results["results"]["40"]
+        self.assertEqual(stages["parse"]["items"], 40)
+        self.assertEqual(stages["export_streaming"]["items"], 40)
+        self.assertTrue(all(stage["seconds"] >= 0 for stage in stages.values()))
+
+    def test_only_slowdowns_beyond_the_tolerance_are_regressions(self):
+        def run(**stages):
+            return {"results": {"1000": {name: {"seconds": seconds} for name, seconds in stages.items()}}}
+
+        baseline = run(parse=1.0, export=2.0, notes=0.001)
+        current = run(parse=1.2, export=2.6, notes=0.004, expand_cold=9.0)
+        self.assertEqual(benchmark.compare_results(current, baseline, tolerance=0.25), [("1000", "export", 2.0, 2.6)])
+
+class TestFakeApiServer(unittest.TestCase):
+
+    def test_bursts_of_429s_are_retried_and_images_are_served(self):
+        from PIL import Image
+
+        async def run(limiter):
+            profile = FakeApiProfile(latency=0, latency_distribution="fixed", hits=3, burst_every=1, retry_after=0)
+            api, runner, base_url = await start_fake_api_server(profile)
+            try:
+                async with http_client.session_scope():
+                    first = await http_client.get_json(f"{base_url}/api/", limiter, params={"q": "to bake"})
+                    second = await http_client.get_json(f"{base_url}/api/", limiter, params={"q": "to bake"})
+                    image, _ = await http_client.get_bytes(first["hits"][0]["webformatURL"].replace("_640", "_340"), limiter.retry_budget)
+            finally:
+                await runner.cleanup()
+            return api.stats, first, second, image
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stats, first, second, image = asyncio.run(run(RateLimiter("fake", os.path.join(tmpdir, "limits.sqlite3"))))
+        self.assertEqual((stats["pixabay_requests"], stats["rate_limited"]), (3, 1))
+        self.assertEqual(first, second)
+        self.assertEqual(len(first["hits"]), 3)
+        with Image.open(io.BytesIO(image)) as decoded:
+            self.assertEqual(decoded.width, 340)
+
+    def test_fake_api_switch_redirects_every_client_and_isolates_state(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                patch.dict(os.environ, {"PIXABAY_API_KEY": "real-key"}, clear=False), \
+                patch.object(main, 'OUTPUT_DIR', main.OUTPUT_DIR), patch.object(main, '_fake_api_state', None):
+            state_dir = os.path.realpath(os.path.join(tmpdir, "state"))
+            main.use_fake_api("http://127.0.0.1:9999/", state_dir)
+            self.assertEqual(pixabay_api.get_api_url(), "http://127.0.0.1:9999/api/")
+            self.assertEqual(pexels_api.get_api_url(), "http://127.0.0.1:9999/v1/search")
+            self.assertEqual(synonym_fetcher.get_api_url(), "http://127.0.0.1:9999/words")
+            self.assertEqual(os.environ["PIXABAY_API_KEY"], "fake")
+            self.assertEqual(os.path.realpath(os.getcwd()), state_dir)
+            self.assertEqual(main.OUTPUT_DIR, os.path.join(state_dir, "ANKI"))
+            self.assertTrue(os.path.exists(os.path.join(state_dir, "synonyms.json")))
+            config = main.isolate_fake_api_config({"media_dir": "/srv/anki-media", "max_concurrency": 4})
+            self.assertEqual(config["media_dir"], os.path.join(state_dir, "media"))
+            self.assertEqual(config["max_concurrency"], 4)
+            os.chdir(tmpdir)  # Leave the state directory before it is removed
+        self.assertEqual(pixabay_api.get_api_url(), pixabay_api.PIXABAY_API_URL)
+
+class TestMetrics(unittest.TestCase):
+
+    def test_worker_snapshots_merge_into_prometheus_text(self):
+        worker = MetricsRegistry()
+        worker.inc("api_requests_total", 3, provider="pixabay")
+        worker.observe("api_latency_seconds", 0.07, provider="pixabay")
+        worker.observe("api_latency_seconds", 3.0, provider="pixabay")
+        registry = MetricsRegistry()
+        registry.inc("api_requests_total", provider="pixabay")
+        registry.merge(json.loads(json.dumps(worker.snapshot())))
+
+        text = registry.to_prometheus()
+        self.assertIn('# TYPE txt_to_anki_api_requests_total counter\ntxt_to_anki_api_requests_total{provider="pixabay"} 4\n', text)
+        self.assertIn('txt_to_anki_api_latency_seconds_bucket{provider="pixabay",le="0.1"} 1\n', text)
+        self.assertIn('txt_to_anki_api_latency_seconds_bucket{provider="pixabay",le="2.5"} 1\n', text)
+        self.assertIn('txt_to_anki_api_latency_seconds_bucket{provider="pixabay",le="+Inf"} 2\n', text)
+        self.assertIn('txt_to_anki_api_latency_seconds_count{provider="pixabay"} 2\n', text)
+        self.assertEqual(registry.summary()["apis"]["pixabay"]["latency"]["p50"], 0.1)
+
+    def test_cache_lookups_are_counted_per_tier(self):
+        registry = MetricsRegistry()
+        with tempfile.TemporaryDirectory() as tmpdir, patch('image_cache.metrics', registry):
+            cache = ImageCache(os.path.join(tmpdir, "pixabay.sqlite3"), name="pixabay")
+            cache.set("a", "https://img/a", None)
+            cache.get("a")
+            cache.get("b")
+            cache.close()
+            cache = ImageCache(os.path.join(tmpdir, "pixabay.sqlite3"), name="pixabay")
+            cache.get_many(["a", "b"])
+            cache.close()
+            with patch('metrics.datetime') as fake_datetime:
+                fake_datetime.now.return_value.strftime.return_value = "20250101_000000"
+                fake_datetime.fromtimestamp.return_value.isoformat.return_value = "2025-01-01T00:00:00"
+                json_path, _ = registry.write(tmpdir)
+            with open(json_path, encoding="utf-8") as f:
+                caches = json.load(f)["caches"]
+        self.assertEqual(caches["pixabay"]["hits"], {"memory": 1, "sqlite": 1})
+        self.assertEqual(caches["pixabay"]["misses"], 2)
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self):
+        root = logging.getLogger()
+        self.saved = (root.handlers[:], root.level, logging.getLogger("pixabay_api").level)
+        self.addCleanup(self.restore)
+
+    def restore(self):
+        logging_utils.stop_logging()
+        root = logging.getLogger()
+        root.handlers[:] = self.saved[0]
+        root.setLevel(self.saved[1])
+        logging.getLogger("pixabay_api").setLevel(self.saved[2])
+
+    def test_queued_records_respect_levels_and_repeats_are_dropped_from_the_console_only(self):
+        console = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch('sys.stderr', console):
+                logging_utils.setup_logging(tmpdir, "WARNING", {"pixabay_api": "DEBUG"}, repeat_interval=60)
+            logging.getLogger("pixabay_api").debug("Query '%s' returned %d results.", "to eat", 3)
+            logging.getLogger("main").info("Not written at WARNING.")
+            words = ["to eat"]
+            for word in ("to run", "to fly", "to swim"):
+                logging.getLogger("main").warning("No image for %s after %s.", word, words)
+                words.append(word)  # Mutated after logging; the record must not change
+            logging.getLogger("main").error("Errors are never dropped.")
+            logging.getLogger("main").error("Errors are never dropped.")
+            logging_utils.stop_logging()
+            [log_file] = os.listdir(tmpdir)
+            with open(os.path.join(tmpdir, log_file), encoding="utf-8") as f:
+                lines = [line.split(" - ", 2)[2] for line in f.read().splitlines()]
+
+        self.assertEqual(lines, [
+            "Query 'to eat' returned 3 results.",
+            "No image for to run after ['to eat'].",
+            "No image for to fly after ['to eat', 'to run'].",
+            "No image for to swim after ['to eat', 'to run', 'to fly'].",
+            "Errors are never dropped.",
+            "Errors are never dropped.",
+        ])
+        shown = [line.split(" - ", 2)[2] for line in console.getvalue().splitlines()]
+        self.assertEqual(shown, [
+            "Query 'to eat' returned 3 results.",
+            "No image for to run after ['to eat'].",
+            "Errors are never dropped.",
+            "Errors are never dropped.",
+        ])
+
+    def test_repeat_count_is_reported_once_the_interval_passes(self):
+        warning_filter = logging_utils.RepeatedWarningFilter(interval=10)
+        record = lambda: logging.LogRecord("main", logging.WARNING, __file__, 1, "No results for '%s'.", ("x",), None)
+        with patch('logging_utils.time.monotonic', side_effect=[0, 1, 2, 11]):
+            allowed = [warning_filter.filter(r) for r in (record(), record(), record())]
+            later = record()
+            self.assertTrue(warning_filter.filter(later))
+        self.assertEqual(allowed, [True, False, False])
+        self.assertEqual(later.getMessage(), "No results for 'x'.")
+        self.assertEqual(
+            logging.Formatter(logging_utils.CONSOLE_FORMAT).format(later).split(" - ", 2)[2],
+            "No results for 'x'. (repeated 2 more times in the last 10s)",
+        )
+
+    def test_module_levels_from_the_command_line(self):
+        args = main.parse_args(["--log-level", "debug", "--log-module", "pixabay_api=WARNING"])
+        self.assertEqual((args.log_level, args.log_module), ("DEBUG", {"pixabay_api": logging.WARNING}))
+        with patch('sys.stderr', io.StringIO()), self.assertRaises(SystemExit):
+            main.parse_args(["--log-module", "pixabay_api"])
+
+class TestHttpClient(unittest.TestCase):
+
+    def test_session_scope_shares_and_closes_session(self):
+        async def run():
+            async with http_client.session_scope({"http_limit_per_host": 2}) as session:
+                self.assertIs(http_client.get_session(), session)
+                self.assertEqual(session.connector.limit_per_host, 2)
+            return session
+        session = asyncio.run(run())
+        self.assertTrue(session.closed)
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache.sqlite3")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_expired_entries_are_misses_and_purged(self):
+        cache = ImageCache(self.path, ttl=-1)
+        cache.set("k", "https://img/1", "credit")
+        self.assertIsNone(cache.get("k"))
+        self.assertEqual(cache.purge_expired(), 1)
+        cache.close()
+
+    def test_size_limit_evicts_least_recently_used(self):
+        cache = ImageCache(self.path, max_entries=2)
+        for key in ("a", "b", "c"):
+            cache.set(key, f"https://img/{key}", None)
+            time.sleep(0.001)
+        cache.get("a")
+        self.assertEqual(cache.enforce_size_limit(), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a")["image_url"], "https://img/a")
+        cache.close()
+
+    def test_memory_tier_is_bounded_and_counts_hits(self):
+        cache = ImageCache(self.path, memory_entries=1)
+        cache.set_many({"a": {"image_url": "https://img/a"}, "b": {"image_url": "https://img/b"}})
+        self.assertEqual(list(cache._memory), ["b"])
+        self.assertEqual(cache.get("a")["image_url"], "https://img/a")
+        self.assertIsNone(cache.get("missing"))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "hit_ratio": 0.5})
+        cache.close()
+
+    def test_entries_visible_to_second_connection(self):
+        writer, reader = ImageCache(self.path), ImageCache(self.path)
+        asyncio.run(writer.aset_many({"k": {"image_url": "https://img/1", "image_credit": "c"}}))
+        self.assertEqual(asyncio.run(reader.aget("k"))["image_credit"], "c")
+        writer.close()
+        reader.close()
+
+    def test_shared_caches_are_opened_off_the_event_loop(self):
+        threads = []
+        maintain = ImageCache.maintain
+
+        def record_thread(cache):
+            threads.append(threading.current_thread())
+            return maintain(cache)
+
+        for provider in (pixabay_api, pexels_api):
+            with patch.object(ImageCache, 'maintain', record_thread), \
+                    patch.object(provider, 'cache', None), patch.object(provider, 'CACHE_FILE', self.path), \
+                    patch.object(pixabay_api, 'LEGACY_CACHE_FILE', os.path.join(self.tmpdir.name, "none.db")):
+                cache = asyncio.run(provider.aget_cache())
+                self.assertIs(asyncio.run(provider.aget_cache()), cache)
+                cache.close()
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_old_shelve_cache_is_imported_once(self):
+        import shelve
+        legacy_path = os.path.join(self.tmpdir.name, "pixabay_cache.db")
+        with shelve.open(legacy_path) as legacy:
+            legacy["fresh"] = {"image_url": "https://img/fresh", "image_credit": "c", "timestamp": time.time() - 60}
+            legacy["stale"] = {"image_url": "https://img/stale", "image_credit": "c", "timestamp": time.time() - 2 * 86400}
+        cache = ImageCache(self.path, ttl=pixabay_api.CACHE_EXPIRATION)
+        self.assertEqual(pixabay_api.migrate_legacy_cache(cache, legacy_path), 1)
+        self.assertEqual(cache.get("fresh")["image_url"], "https://img/fresh")
+        self.assertIsNone(cache.get("stale"))
+        self.assertEqual(pixabay_api.migrate_legacy_cache(cache, legacy_path), 0)
+        cache.close()
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        pixabay_api.used_images.clear()
+
+    def test_identical_queries_share_one_request_and_pick_unique_images(self):
+        calls = []
+
+        async def fake_request(url, params, config):
+            calls.append(params["q"])
+            await asyncio.sleep(0.01)
+            return {"hits": [{"id": i, "webformatURL": f"https://img/{i}", "user": "u"} for i in range(3)]}
+
+        config = {"strict_filters": False, "metadata_filter": {}}
+        params = {"key": "secret", "q": "to ask"}
+
+        async def run():
+            return await asyncio.gather(*(
+                pixabay_api.perform_pixabay_request_async("url", dict(params, q=q), q, "k", {}, config)
+                for q in ("to ask", "To  Ask", "to ask")
+            ))
+
+        with patch('pixabay_api.request_pixabay_hits_async', side_effect=fake_request):
+            results = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len({url for url, _ in results}), 3)
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "limits.sqlite3")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_bucket_state_is_shared_and_follows_headers(self):
+        first = RateLimiter("pixabay", self.path, limit=2, window=60)
+        second = RateLimiter("pixabay", self.path, limit=2, window=60)
+        self.assertEqual(first.reserve(), 0)
+        self.assertEqual(second.reserve(), 0)
+        self.assertGreater(first.reserve(), 0)
+
+        second.update_from_headers({"X-RateLimit-Limit": "100", "X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "30"})
+        self.assertGreater(first.reserve(), 25)
+
+    def test_get_json_retries_after_429(self):
+        responses = [web.json_response({}, status=429, headers={"Retry-After": "0"}), web.json_response({"hits": [1]})]
+
+        async def handler(request):
+            return responses.pop(0)
+
+        async def run():
+            async with local_server("/api/", handler) as base_url, http_client.session_scope():
+                limiter = RateLimiter("pixabay", self.path)
+                return await http_client.get_json(f"{base_url}/api/", limiter)
+
+        self.assertEqual(asyncio.run(run()), {"hits": [1]})
+        self.assertEqual(responses, [])
+
+    def test_get_json_gives_up_after_repeated_429s(self):
+        requests_seen = []
+
+        async def handler(request):
+            requests_seen.append(request.path)
+            return web.json_response({}, status=429, headers={"Retry-After": "0"})
+
+        async def run():
+            async with local_server("/api/", handler) as base_url, http_client.session_scope():
+                limiter = RateLimiter("pixabay", self.path)
+                return await http_client.get_json(f"{base_url}/api/", limiter)
+
+        with patch('http_client.MAX_RATE_LIMIT_RETRIES', 2), self.assertLogs('http_client', 'WARNING'):
+            with self.assertRaises(aiohttp.ClientResponseError) as raised:
+                asyncio.run(run())
+        self.assertEqual(raised.exception.status, 429)
+        self.assertEqual(len(requests_seen), 3)
+
+class TestMediaStore(unittest.TestCase):
+
+    def test_downloads_are_deduplicated_and_reused(self):
+        requested = []
+
+        async def handler(request):
+            requested.append(request.path)
+            body = b"cat" if request.path in ("/a.jpg", "/b.jpg") else b"dog"
+            return web.Response(body=body, content_type="image/jpeg")
+
+        async def run(store, urls_for):
+            async with local_server("/{name}", handler) as base_url, http_client.session_scope():
+                return await download_media(urls_for(base_url), store)
+
+        def urls_for(base_url):
+            return [f"{base_url}/{name}" for name in ("a.jpg", "b.jpg", "c.jpg")]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = MediaStore(tmpdir)
+            first = asyncio.run(run(store, urls_for))
+            self.assertEqual(sorted(requested), ["/a.jpg", "/b.jpg", "/c.jpg"])
+            paths = list(first.values())
+            self.assertEqual(paths[0], paths[1])
+            self.assertNotEqual(paths[0], paths[2])
+            self.assertTrue(os.path.basename(paths[0]).endswith(".jpg"))
+            with open(paths[2], "rb") as f:
+                self.assertEqual(f.read(), b"dog")
+
+            self.assertEqual(store.lookup(first), first)
+            store.close()
+
+    def test_error_pages_and_empty_bodies_are_not_stored(self):
+        async def handler(request):
+            if request.path == "/portal.jpg":
+                return web.Response(text="<html>Log in to continue</html>", content_type="text/html")
+            if request.path == "/empty.jpg":
+                return web.Response(body=b"", content_type="image/jpeg")
+            return web.Response(body=b"\x89PNG\r\n\x1a\nrest", content_type="application/octet-stream")
+
+        async def run(store):
+            async with local_server("/{name}", handler) as base_url, http_client.session_scope():
+                urls = [f"{base_url}/{name}" for name in ("portal.jpg", "empty.jpg", "untyped.png")]
+                return await download_media(urls, store)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = MediaStore(tmpdir)
+            with self.assertLogs('media_store', 'WARNING'):
+                paths = asyncio.run(run(store))
+            store.close()
+        self.assertEqual([os.path.basename(url) for url in paths], ["untyped.png"])
+
+class TestImageProcessing(unittest.TestCase):
+
+    def test_smallest_source_meeting_the_target_is_chosen(self):
+        hit = {
+            "previewURL": "https://cdn/p_150.jpg", "previewWidth": 150,
+            "webformatURL": "https://cdn/w_640.jpg", "webformatWidth": 640, "webformatHeight": 427,
+            "largeImageURL": "https://cdn/l_1280.jpg", "imageWidth": 4000, "imageHeight": 2667,
+        }
+        self.assertEqual(pixabay_api.select_image_source(hit), "https://cdn/w_640.jpg")
+        self.assertEqual(pixabay_api.select_image_source(hit, 120), "https://cdn/p_150.jpg")
+        self.assertEqual(pixabay_api.select_image_source(hit, 300), "https://cdn/w_340.jpg")
+        self.assertEqual(pixabay_api.select_image_source(hit, 1000), "https://cdn/l_1280.jpg")
+        self.assertEqual(pixabay_api.select_image_source(hit, 5000), "https://cdn/l_1280.jpg")
+
+    def test_images_are_resized_in_a_pool_and_cached_by_settings(self):
+        from PIL import Image
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = MediaStore(tmpdir)
+            sources = []
+            for i in range(5):
+                buffer = io.BytesIO()
+                Image.new("RGBA", (800, 400), (i * 40, 0, 0, 128)).save(buffer, "PNG")
+                sources.append(store.put(f"https://cdn/{i}.png", buffer.getvalue(), "image/png"))
+            settings = {"width": 200, "format": "jpeg", "quality": 70}
+
+            first = asyncio.run(transcode_media(sources, store, settings, workers=2))
+            for source in sources:
+                self.assertTrue(first[source].endswith(".jpg"))
+                with Image.open(first[source]) as image:
+                    self.assertEqual((image.format, image.size), ("JPEG", (200, 100)))
+
+            with patch('image_processing.transcode_image', side_effect=AssertionError("not cached")):
+                self.assertEqual(asyncio.run(transcode_media(sources, store, settings)), first)
+            store.close()
+
+class TestImageDedupe(unittest.TestCase):
+
+    def test_bk_tree_matches_linear_scan(self):
+        import random
+        rng = random.Random(7)
+        hashes = [rng.getrandbits(64) for _ in range(2000)]
+        tree = BKTree()
+        for i, value in enumerate(hashes):
+            tree.add(value, i)
+        for query in hashes[:20] + [hashes[0] ^ 0b1011]:
+            expected = sorted(i for i, value in enumerate(hashes) if hamming(query, value) <= 6)
+            self.assertEqual(sorted(i for _, i in tree.search(query, 6)), expected)
+
+    def test_removed_items_are_no_longer_found(self):
+        tree = BKTree()
+        for i, value in enumerate([0b0000, 0b0001, 0b0011, 0b0000]):
+            tree.add(value, i)
+        self.assertTrue(tree.remove(0b0000, 3))
+        self.assertFalse(tree.remove(0b0000, 3))
+        self.assertTrue(tree.remove(0b0001, 1))
+        self.assertEqual(sorted(i for _, i in tree.search(0b0000, 4)), [0, 2])
+        self.assertEqual(len(tree), 2)
+
+    def test_resized_copy_is_rejected_but_other_images_are_not(self):
+        from PIL import Image
+
+        def encode(image, image_format):
+            buffer = io.BytesIO()
+            image.save(buffer, image_format)
+            return buffer.getvalue()
+
+        photo = Image.linear_gradient("L").rotate(30).convert("RGB")
+        other = Image.radial_gradient("L").convert("RGB")
+        hashes = {
+            "https://pixabay/photo_640.jpg": dhash(encode(photo, "JPEG")),
+            "https://pexels/photo-small.png": dhash(encode(photo.resize((64, 64)), "PNG")),
+            "https://pixabay/other.jpg": dhash(encode(other, "JPEG")),
+        }
+        index = SimilarImageIndex()
+        index.configure({"dedupe_similar_images": True})
+
+        async def claim_all():
+            with patch.object(index, "hash_of", side_effect=hashes.get):
+                return [await index.claim(url) for url in hashes]
+
+        self.assertEqual(asyncio.run(claim_all()), [True, False, True])
+        self.assertEqual(index.rejected, 1)
+
+class TestPexelsClient(unittest.TestCase):
+
+    def setUp(self):
+        pexels_api.used_images.clear()
+
+    def test_sync_wrapper_runs_async_client(self):
+        async def fake_request(params):
+            return {"photos": [{"src": {"medium": f"https://pexels/{i}"}, "photographer": "p", "url": "u"} for i in range(2)]}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ImageCache(os.path.join(tmpdir, "pexels.sqlite3"))
+            with patch('pexels_api.request_pexels_photos_async', side_effect=fake_request):
+                first = pexels_api.fetch_pexels_images("cat", "k1", cache)
+                second = pexels_api.fetch_pexels_images("cat", "k2", cache)
+            self.assertEqual(cache.get("k2")["image_url"], "https://pexels/1")
+            cache.close()
+        self.assertEqual(first[0], "https://pexels/0")
+        self.assertEqual(second[0], "https://pexels/1")
+
+class TestHedging(unittest.TestCase):
+
+    def test_slow_primary_is_hedged_and_cancelled(self):
+        started = []
+
+        async def slow_primary():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                started.append("primary cancelled")
+                raise
+            return "https://pixabay/1", None
+
+        async def fast_secondary():
+            started.append("secondary")
+            return "https://pexels/1", None
+
+        result = asyncio.run(hedged_call(slow_primary(), fast_secondary, 0.01, accept=lambda r: bool(r[0])))
+        self.assertEqual(result[0], "https://pexels/1")
+        self.assertEqual(started, ["secondary", "primary cancelled"])
+
+    def test_fast_primary_is_not_hedged(self):
+        async def primary():
+            return "https://pixabay/1", None
+
+        secondary = MagicMock()
+        result = asyncio.run(hedged_call(primary(), secondary, 1, accept=lambda r: bool(r[0])))
+        self.assertEqual(result[0], "https://pixabay/1")
+        secondary.assert_not_called()
+
+    def test_cancelled_loser_gives_back_its_images(self):
+        pexels_api.used_images.clear()
+        similar_images.configure({"dedupe_similar_images": True})
+        self.addCleanup(similar_images.configure, {})
+
+        async def fake_request(params):
+            return {"photos": [{"src": {"medium": "https://pexels/1"}, "photographer": "p", "url": "u"}]}
+
+        async def stalled_write(entries):
+            await asyncio.sleep(10)
+
+        async def lose_race(cache):
+            lookup = asyncio.create_task(pexels_api.fetch_pexels_images_async("cat", "k", cache))
+            while "https://pexels/1" not in pexels_api.used_images:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.01)  # Claimed, now stalled writing the cache
+            lookup.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await lookup
+            return await similar_images.claim("https://pixabay/1")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ImageCache(os.path.join(tmpdir, "pexels.sqlite3"))
+            with patch('pexels_api.request_pexels_photos_async', side_effect=fake_request), \
+                 patch.object(similar_images, "hash_of", side_effect=lambda url: 0xF0F0), \
+                 patch.object(cache, "aset_many", side_effect=stalled_write):
+                self.assertTrue(asyncio.run(lose_race(cache)))
+            cache.close()
+        self.assertNotIn("https://pexels/1", pexels_api.used_images)
+
+    def test_timeout_adapts_to_observed_p95(self):
+        tracker = LatencyTracker()
+        for _ in range(50):
+            tracker.record("pixabay", 0.5)
+        self.assertEqual(tracker.timeout_for("pixabay"), 1.5)
+        for _ in range(50):
+            tracker.record("pixabay", 30)
+        self.assertEqual(tracker.timeout_for("pixabay"), MAX_TIMEOUT)
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        pixabay_api.used_images.clear()
+        pixabay_api.response_memo.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ImageCache(os.path.join(self.tmpdir.name, "pixabay.sqlite3"))
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    @patch.dict(os.environ, {"PIXABAY_API_KEY": "secret"})
+    def test_duplicate_meanings_cost_one_request_each(self):
+        calls = []
+
+        async def fake_request(url, params, config):
+            calls.append(params["q"])
+            return {"hits": [{"id": i, "webformatURL": f"https://img/{params['q']}/{i}", "user": "u"} for i in range(5)]}
+
+        config = {"use_synonyms": False, "apply_nlp": False, "strict_filters": False, "tags": [], "metadata_filter": {}}
+        queries = ["to ask", "to bake", "to ask", "to ask"]
+
+        async def run():
+            await pixabay_api.prefetch_pixabay_responses(Counter(queries), {}, config)
+            return [await pixabay_api.fetch_pixabay_image(q, {}, config) for q in queries]
+
+        with patch('pixabay_api.request_pixabay_hits_async', side_effect=fake_request), \
+                patch.object(pixabay_api, 'cache', self.cache):
+            results = asyncio.run(run())
+        self.assertEqual(sorted(calls), ["to ask", "to bake"])
+        self.assertEqual(len({url for url, _ in results}), 4)
+
+class TestSynonymIndex(unittest.TestCase):
+
+    def test_phrase_keys_match_inside_queries(self):
+        synonyms = {"to close": ["to shut"], "should": ["had better"], "door": ["gate"]}
+        self.assertEqual(
+            expand_with_synonyms("to close the Door", synonyms),
+            ["to close the Door", "to shut the Door", "to close the gate"],
+        )
+        self.assertEqual(expand_with_synonyms("you should", synonyms), ["you should", "you had better"])
+        self.assertEqual(expand_with_synonyms("to closet", synonyms), ["to closet"])
+
+    def test_shared_index_follows_synonym_file_updates(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "synonyms.json")
+            index = SynonymIndex({"door": ["gate"]})
+            with patch('utils.SYNONYMS_FILE', path), patch('utils._synonym_index', index):
+                self.assertEqual(expand_with_synonyms("Door", utils.get_synonym_index()), ["Door", "gate"])
+                utils.update_synonyms_file_many({"window": ["pane"]})
+                self.assertEqual(expand_with_synonyms("Window", utils.get_synonym_index()), ["Window", "pane"])
+
+        self.assertEqual(expand_with_synonyms("door", {"door": ["portal"]}), ["door", "portal"])
+        with patch('utils.SynonymIndex') as index:
+            self.assertEqual(expand_with_synonyms("door", None), ["door"])
+            self.assertEqual(expand_with_synonyms("door", {}), ["door"])
+        index.assert_not_called()
+
+class TestQueryRefiner(unittest.TestCase):
+
+    def setUp(self):
+        query_refiner.clear_memo()
+        self.addCleanup(query_refiner.clear_memo)
+        resources = (frozenset({"the", "a"}), lambda word: word.rstrip("s"))
+        patcher = patch.object(query_refiner, "_resources", resources)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_batch_matches_single_refinement_and_fills_memo(self):
+        queries = [f"the dogs {i}" for i in range(30)] + ["A houses", "the dogs 0"]
+        batch = query_refiner.refine_queries(queries, workers=2, parallel_threshold=10)
+        self.assertEqual(len(batch), 31)
+        self.assertEqual(batch["A houses"], "house")
+        self.assertEqual(batch["the dogs 3"], "dog 3")
+
+        with patch.object(query_refiner, "_refine", side_effect=AssertionError("memo miss")):
+            self.assertEqual(query_refiner.refine_query("the dogs 3"), "dog 3")
+            self.assertEqual(query_refiner.refine_queries(queries), batch)
+
+class TestSynonymFetcher(unittest.TestCase):
+
+    def test_batch_lookups_cache_empty_answers(self):
+        looked_up = []
+
+        async def fake_lookup(word):
+            looked_up.append(word)
+            return ["to inquire"] if word == "to ask" else []
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = SynonymResultCache(os.path.join(tmpdir, "synonyms.sqlite3"))
+            first = asyncio.run(fetch_synonyms_batch(["to ask", "to bake", "to ask"], lookup=fake_lookup, cache=cache))
+            second = asyncio.run(fetch_synonyms_batch(["to ask", "to bake"], lookup=fake_lookup, cache=cache))
+            cache.close()
+        self.assertEqual(first, {"to ask": ["to inquire"], "to bake": []})
+        self.assertEqual(second, first)
+        self.assertEqual(sorted(looked_up), ["to ask", "to bake"])
+
+    def test_concurrent_synonym_file_updates_keep_every_entry(self):
+        words = [f"to word{i}" for i in range(16)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "synonyms.json")
+            with patch('utils.SYNONYMS_FILE', path), patch('utils._synonym_index', SynonymIndex()):
+                with ThreadPoolExecutor(max_workers=8) as pool:
+                    list(pool.map(lambda word: utils.update_synonyms_file_many({word: ["to other"]}), words))
+                self.assertEqual(sorted(utils.load_synonym_dict(path)), sorted(words))
+            self.assertFalse(os.path.exists(f"{path}.tmp"))
+
+    def test_row_lookups_read_only_the_in_memory_index(self):
+        with patch('utils._synonym_index', SynonymIndex({"to ask": ["to inquire"]})), \
+                patch('utils.get_result_cache') as result_cache:
+            self.assertEqual(utils.get_synonyms("to ask", fetch_online=False), ["to inquire"])
+            self.assertEqual(utils.get_synonyms("to bake", fetch_online=False), [])
+        result_cache.assert_not_called()
+
+class TestStartup(unittest.TestCase):
+
+    IMPORT_TIME_BUDGET = 1.5  # Seconds allowed for a cold `import main`
+
+    def test_import_is_fast_and_side_effect_free(self):
+        repo_dir = os.path.dirname(os.path.abspath(__file__))
+        script = (
+            "import sys, time; start = time.perf_counter(); import main; "
+            "print(time.perf_counter() - start); "
+            "print(','.join(m for m in ('nltk', 'tkinter', 'datamuse') if m in sys.modules))"
+        )
+        with tempfile.TemporaryDirectory() as workdir:
+            result = subprocess.run(
+                [sys.executable, "-c", script], cwd=workdir, capture_output=True, text=True,
+                env={**os.environ, "PYTHONPATH": repo_dir},
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(os.listdir(workdir), [])
+        elapsed, heavy_modules = result.stdout.splitlines()
+        self.assertLess(float(elapsed), self.IMPORT_TIME_BUDGET)
+        self.assertEqual(heavy_modules, "")
+        self.assertEqual(result.stderr, "")
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
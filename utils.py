@@ -1,23 +1,31 @@
-from datamuse import Datamuse
 import os
 import json
 import logging
+from contextlib import contextmanager
 from typing import Dict, Any
 
-import nltk
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-
-nltk.download('stopwords')
-nltk.download('wordnet')
+from query_refiner import refine_query
+from synonym_fetcher import DEFAULT_CONCURRENCY, fetch_synonyms_batch, get_result_cache
+from synonym_index import SynonymIndex
 
 # Configure logger for the utils module
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
 
 CONFIG_FILE = "config.json"
-datamuse_api = Datamuse()
 SYNONYMS_FILE = "synonyms.json"
+_datamuse_api = None  # Created by get_datamuse_api() on first use
+_synonym_index = None  # Built from SYNONYMS_FILE on first use
+_EMPTY_INDEX = SynonymIndex()  # Shared by callers without a dictionary
+
+def get_datamuse_api():
+    """
+    Return the shared Datamuse client, importing and creating it on first use.
+    """
+    global _datamuse_api
+    if _datamuse_api is None:
+        from datamuse import Datamuse
+        _datamuse_api = Datamuse()
+    return _datamuse_api
 
 def save_api_key(api_key):
     """
@@ -90,13 +98,13 @@ def fetch_synonyms_online(word, max_results=5):
     import requests
     try:
         # Set a timeout for the request to prevent hanging indefinitely
-        results = datamuse_api.words(rel_syn=word, max=max_results, timeout=5)  # Timeout set to 5 seconds
+        results = get_datamuse_api().words(rel_syn=word, max=max_results, timeout=5)  # Timeout set to 5 seconds
         return [entry['word'] for entry in results]
     except requests.exceptions.Timeout:
-        logger.warning(f"Request to Datamuse API timed out for word: '{word}'.")
+        logger.warning("Request to Datamuse API timed out for word: '%s'.", word)
         return []
     except requests.exceptions.RequestException as e:
-        logger.warning(f"Error fetching synonyms for '{word}': {e}")
+        logger.warning("Error fetching synonyms for '%s': %s", word, e)
         return []
     except Exception as e:
         logger.error(f"Unexpected error fetching synonyms for '{word}': {e}")
@@ -107,36 +115,107 @@ def update_synonyms_file(word, new_synonyms):
     """
     Update the synonyms.json file with new synonyms for a given word.
     """
-    try:
-        if os.path.exists(SYNONYMS_FILE):
-            with open(SYNONYMS_FILE, "r") as file:
-                synonyms = json.load(file)
-        else:
-            synonyms = {}
+    update_synonyms_file_many({word: new_synonyms})
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on ``<path>.lock`` while the block runs.
 
-        if word not in synonyms:
-            synonyms[word] = new_synonyms
+    Serializes read-modify-write cycles of a file across processes, e.g.
+    batch workers that update synonyms.json at the same time.
+    """
+    with open(f"{path}.lock", "a+") as lock_file:
+        if os.name == "nt":
+            import msvcrt
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
         else:
-            synonyms[word] = list(set(synonyms[word] + new_synonyms))  # Avoid duplicates
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-        with open(SYNONYMS_FILE, "w") as file:
-            json.dump(synonyms, file, indent=4)
-        logger.info(f"Updated synonyms.json with new synonyms for '{word}'.")
+def update_synonyms_file_many(new_entries):
+    """
+    Update the synonyms.json file with new synonyms for several words in one write.
+
+    The file is re-read and replaced atomically under a lock, so concurrent
+    batch workers keep each other's entries and readers never see a partly
+    written file.
+
+    Args:
+        new_entries (dict): Maps words to lists of new synonyms.
+    """
+    if not new_entries:
+        return
+    try:
+        with file_lock(SYNONYMS_FILE):
+            if os.path.exists(SYNONYMS_FILE):
+                with open(SYNONYMS_FILE, "r") as file:
+                    synonyms = json.load(file)
+            else:
+                synonyms = {}
+
+            for word, new_synonyms in new_entries.items():
+                if word not in synonyms:
+                    synonyms[word] = new_synonyms
+                else:
+                    synonyms[word] = list(set(synonyms[word] + new_synonyms))  # Avoid duplicates
+
+            temp_path = f"{SYNONYMS_FILE}.tmp"
+            with open(temp_path, "w") as file:
+                json.dump(synonyms, file, indent=4)
+            os.replace(temp_path, SYNONYMS_FILE)
+        index = get_synonym_index()
+        for word, new_synonyms in new_entries.items():
+            index.add(word, new_synonyms)
+        logger.info(f"Updated synonyms.json with new synonyms for {', '.join(repr(w) for w in new_entries)}.")
     except Exception as e:
         logger.error(f"Error updating synonyms file: {e}")
 
 def validate_synonyms(word, synonyms):
     valid_synonyms = [syn for syn in synonyms if len(syn.split()) == 1]  # Example: Exclude multi-word synonyms
-    logger.debug(f"Validated synonyms for '{word}': {valid_synonyms}")
+    logger.debug("Validated synonyms for '%s': %s", word, valid_synonyms)
     return valid_synonyms
 
-def get_synonyms(word):
+def get_synonym_index(file_path=SYNONYMS_FILE):
+    """
+    Return the process-wide synonym index, reading the synonyms file only once.
+    """
+    global _synonym_index
+    if _synonym_index is None:
+        _synonym_index = SynonymIndex(load_synonym_dict(file_path))
+        logger.debug(f"Loaded synonym index with {len(_synonym_index)} keys from {file_path}.")
+    return _synonym_index
+
+def get_synonyms(word, fetch_online=True):
     """
     Get synonyms for a word, combining online lookups and local storage.
+
+    Args:
+        word (str): Word or phrase to look up.
+        fetch_online (bool): Ask Datamuse when neither synonyms.json nor the
+            result cache knows the word. Async callers pass False and resolve
+            misses up front with ``prefetch_synonyms``, which adds every word
+            with synonyms to the index, so only the in-memory index is read.
     """
-    synonyms = load_synonym_dict()
-    if word in synonyms:
-        return synonyms[word]
+    index = get_synonym_index()
+    synonyms = index.lookup(word)
+    if synonyms is not None:
+        return synonyms
+    if not fetch_online:
+        return []
+
+    cached = get_result_cache().get_many([word])
+    if word in cached:
+        return validate_synonyms(word, cached[word])
 
     online_synonyms = validate_synonyms(word, fetch_synonyms_online(word))
     if online_synonyms:
@@ -144,39 +223,60 @@ def get_synonyms(word):
         return online_synonyms
     return []
 
+async def prefetch_synonyms(words, concurrency=DEFAULT_CONCURRENCY, lookup=None):
+    """
+    Resolve online synonyms for every word of a run that synonyms.json does not know.
+
+    Lookups run concurrently through ``synonym_fetcher.fetch_synonyms_batch``
+    and new synonyms are written to synonyms.json in a single update.
+
+    Args:
+        words (iterable): Words or phrases used by the run.
+        concurrency (int): Most Datamuse lookups in flight at once.
+        lookup (callable, optional): Stand-in for the Datamuse lookup, see ``fetch_synonyms_batch``.
+
+    Returns:
+        dict: Maps each looked-up word to its validated synonyms.
+    """
+    index = get_synonym_index()
+    missing = [word for word in words if word and word not in index]
+    results = await fetch_synonyms_batch(missing, concurrency=concurrency, lookup=lookup)
+    validated = {word: validate_synonyms(word, synonyms) for word, synonyms in results.items()}
+    update_synonyms_file_many({word: synonyms for word, synonyms in validated.items() if synonyms})
+    return validated
+
 def expand_with_synonyms(query, synonym_dict):
     """
     Expands a query dynamically using synonyms from a provided dictionary.
 
+    Multi-word keys such as "to close" are matched as phrases. A plain
+    dictionary is indexed on every call; pass a ``SynonymIndex``, such as
+    the one from ``get_synonym_index``, to reuse its index and memo.
+
     Parameters:
         query (str): The original query string.
-        synonym_dict (dict): Dictionary of synonyms where keys are words and values are lists of synonyms.
+        synonym_dict (dict or SynonymIndex): Synonyms where keys are words or phrases and values are lists of synonyms.
+            None or an empty dictionary leaves the query as it is.
 
     Returns:
         list: A list of expanded queries including synonyms.
     """
-    words = query.split()
-    expanded_queries = [query]  # Include the original query
-
-    for i, word in enumerate(words):
-        if word in synonym_dict:
-            for synonym in synonym_dict[word]:
-                new_query = words[:i] + [synonym] + words[i + 1:]
-                expanded_queries.append(" ".join(new_query))
-
-    return expanded_queries
+    if not synonym_dict:
+        return _EMPTY_INDEX.expand(query)
+    if isinstance(synonym_dict, SynonymIndex):
+        return synonym_dict.expand(query)
+    return SynonymIndex(synonym_dict).expand(query)
 
 def apply_nlp_refinement(query):
     """
     Refines the query using NLP techniques such as lemmatization or stemming.
+
+    Refinements are memoized by ``query_refiner``; ``query_refiner.refine_queries``
+    refines all queries of a run in one batch.
+
     Args:
         query (str): The search query.
     Returns:
         str: Refined query.
     """
-    from nltk.stem import WordNetLemmatizer
-    lemmatizer = WordNetLemmatizer()
-    stop_words = set(stopwords.words('english'))
-    refined_query = " ".join(lemmatizer.lemmatize(word) for word in query.split() if word.lower() not in stop_words)
-    logger.debug(f"Refined query: {refined_query}")
-    return refined_query
+    return refine_query(query)